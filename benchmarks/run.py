@@ -0,0 +1,244 @@
+import argparse
+import csv
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from os.path import join, dirname, abspath, isfile
+from urllib.parse import urlparse
+
+import yaml
+
+benchmarks_path = abspath(dirname(__file__))
+repo_path = dirname(benchmarks_path)
+sys.path.insert(0, repo_path)
+
+import sqlschema
+import synthetic
+from standins import Postgres, HttpStubs, FtpServer, Slapd
+
+with open(join(repo_path, 'settings_nosecrets'), 'r') as f:
+    settings = yaml.load(f, Loader=yaml.BaseLoader)
+
+# The stand-ins' credentials, and the id of the one synthetic spreadsheet all of the gsheetsRanges are read from.
+password = 'bench'
+spreadsheet_id = 'benchmark-spreadsheet'
+# The OAuth credentials establishGSheetsCredentials loads, with a token that doesn't expire, as the stand-in
+# accepts any token.
+gsheets_credentials = {
+    '_module': 'oauth2client.client', '_class': 'OAuth2Credentials', 'access_token': password, 'client_id': password,
+    'client_secret': password, 'refresh_token': password, 'token_expiry': '2100-01-01T00:00:00Z',
+    'token_uri': 'https://oauth2.googleapis.com/token', 'user_agent': 'malobs', 'revoke_uri': None, 'id_token': None,
+    'id_token_jwt': None, 'token_response': None, 'token_info_uri': None, 'invalid': False,
+    'scopes': ['https://www.googleapis.com/auth/spreadsheets.readonly', 'https://www.googleapis.com/auth/drive.metadata.readonly'],
+}
+
+
+def run_scale(scale, seed, directory, pg_bin):
+    # Run create_files.py and load.py against stand-ins serving a synthetic dataset of the scale, and return the
+    # stages of the metrics report of each run, by run.
+    shutil.rmtree(directory, ignore_errors=True)
+    print('Generating the data at ' + str(scale) + 'x Pf6')
+    dataset = synthetic.Dataset(scale, seed)
+    ftp_directory = join(directory, 'ftp')
+    for name, content in dataset.sanger_files().items():
+        path = ftp_directory + urlparse(settings["sangerFtpFiles"][name]).path
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+    for name in ['postgres', 'slapd', 'run']:
+        os.makedirs(join(directory, name), exist_ok=True)
+
+    results = OrderedDict()
+    with Postgres(join(directory, 'postgres'), pg_bin) as postgres, \
+            HttpStubs(dataset.alfresco_studies(), dataset.gsheets_ranges(), dataset.admin_relations) as http, \
+            FtpServer(ftp_directory) as ftp, \
+            Slapd(join(directory, 'slapd'), settings["ldapUserDN"], password, dataset.ldap_entries(Slapd.base_dn)) as slapd:
+        print('Loading the Observatory stand-in')
+        load_observatory(postgres, dataset)
+        postgres.create_database(settings["mergedDbServerDatabase"])
+
+        run_directory = join(directory, 'run')
+        write_settings(run_directory, dataset, postgres, http, ftp, slapd)
+        # A run rebuilding everything, a run with nothing changed since, which only probes the sources, and a load.
+        results['create_files'] = run_script(run_directory, 'create_files.py', ['--force'], settings["metricsPath"])
+        results['create_files:unchanged'] = run_script(run_directory, 'create_files.py', [], settings["metricsPath"])
+        results['load'] = run_script(run_directory, 'load.py', [], settings["mergedDbLoadMetricsPath"])
+        results['overpass'] = run_overpass(directory, dataset, http)
+    return results
+
+
+def load_observatory(postgres, dataset):
+    # The Observatory views as tables of the same names, typed as the datatables they become in schema.sql, the
+    # studies view, and the table of the countries' GeoJSON.
+    tables = sqlschema.parse()
+    schema = settings["observatoryDbServerDbSchema"]
+    datatable_for_view = dict(zip(settings["observatoryDbViews"], settings["panoptesObsTables"]))
+    postgres.create_database(settings["observatoryDbServerDatabase"])
+    connection = postgres.connect(settings["observatoryDbServerDatabase"])
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('CREATE SCHEMA "' + schema + '"')
+            relations = dataset.observatory_tables()
+            relations[settings["panoptesObsCountriesTable"]] = ([settings["panoptesObsCountriesTableCountryField"], settings["panoptesObsCountriesTableGeoJsonField"]],
+                                                                dataset.countries_geojson())
+            for relation, (columns, rows) in relations.items():
+                if relation in datatable_for_view:
+                    types = tables[datatable_for_view[relation]].columns
+                else:
+                    types = {column: 'Text' for column in columns}
+                    types[settings["panoptesObsCountriesTableGeoJsonField"]] = 'json'
+                cursor.execute('CREATE TABLE "' + schema + '"."' + relation + '" (' + ', '.join('"' + column + '" ' + types[column] for column in columns) + ')')
+                data = io.StringIO()
+                csv.writer(data, delimiter='\t', lineterminator='\n').writerows(rows)
+                data.seek(0)
+                cursor.copy_expert('COPY "' + schema + '"."' + relation + '" (' + ', '.join('"' + column + '"' for column in columns) +
+                                   ") FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '')", data)
+                cursor.execute('ANALYZE "' + schema + '"."' + relation + '"')
+    finally:
+        connection.close()
+
+
+def write_settings(run_directory, dataset, postgres, http, ftp, slapd):
+    # settings_nosecrets as it is, and a settings_local pointing everything at the stand-ins.
+    shutil.copy(join(repo_path, 'settings_nosecrets'), join(run_directory, 'settings_nosecrets'))
+    credentials_path = join(run_directory, 'gsheets_credentials.json')
+    with open(credentials_path, 'w') as f:
+        json.dump(gsheets_credentials, f)
+    local = {
+        'observatoryDbServerHost': '127.0.0.1',
+        'observatoryDbServerPort': postgres.port,
+        'observatoryDbServerSSL': 'disable',
+        'observatoryDbServerUser': postgres.user,
+        'observatoryDbServerPass': '',
+        'alfrescoStudiesURL': http.url('/alfresco/service/cggh/collaborations'),
+        'alfrescoUserId': postgres.user,
+        'alfrescoUserPass': password,
+        'ldapServerURL': slapd.url(),
+        'ldapUserPass': password,
+        'gsheetsApiDiscoveryUrl': http.url('/discovery/sheets'),
+        'gdriveApiDiscoveryUrl': http.url('/discovery/drive'),
+        'gsheetsClientSecretPath': credentials_path,
+        'gsheetsCredentialsPath': credentials_path,
+        'gsheetsIds': [spreadsheet_id] * len(settings["gsheetsIds"]),
+        'sangerFtpFiles': {name: ftp.url(urlparse(url).path) for name, url in settings["sangerFtpFiles"].items()},
+        'panoptesObsRegionsAdditionalCountries': {region_id: country_ids for region_id, country_ids in dataset.additional_countries.items()},
+        'mergedDbServerHost': '127.0.0.1',
+        'mergedDbServerPort': postgres.port,
+        'mergedDbServerSSL': 'disable',
+        'mergedDbServerUser': postgres.user,
+        'mergedDbServerPass': '',
+    }
+    with open(join(run_directory, 'settings_local'), 'w') as f:
+        yaml.safe_dump(local, f, default_flow_style=False)
+
+
+def run_script(run_directory, script, arguments, metrics_path):
+    # Run one of the scripts in the run directory, with its output in <script>.log there, and return the stages of
+    # its metrics report.
+    print('Running ' + ' '.join([script] + arguments))
+    if isfile(join(run_directory, metrics_path)):
+        os.remove(join(run_directory, metrics_path))
+    with open(join(run_directory, script + '.log'), 'a') as log:
+        status = subprocess.call([sys.executable, join(repo_path, script)] + arguments, cwd=run_directory, stdout=log, stderr=subprocess.STDOUT)
+    if status != 0:
+        raise RuntimeError(script + ' failed with status ' + str(status) + ', see ' + join(run_directory, script + '.log'))
+    with open(join(run_directory, metrics_path), 'r') as f:
+        return json.load(f)['stages']
+
+
+def run_overpass(directory, dataset, http):
+    # Look the sites up in the Overpass stand-in, with nothing cached and then with everything cached. The rate limit
+    # is lifted, so what is measured is making the admin level records rather than waiting.
+    import pandas
+    from diskcache import Cache
+    import landmass
+    import overpass
+    from metrics import metrics
+
+    print('Looking up the sites in the Overpass stand-in')
+    with open(join(directory, 'landmass.wkb'), 'wb') as f:
+        f.write(dataset.landmass().wkb)
+    landmass.build(join(directory, 'landmass.wkb'), join(directory, 'landmass.tiles'))
+    overpass.landmass = landmass.Landmass(join(directory, 'landmass.tiles'), join(directory, 'landmass.wkb'))
+    overpass.cache = Cache(join(directory, 'overpass_cache'))
+    overpass.relation_records.clear()
+    sites = pandas.DataFrame([OrderedDict([('site_id', site['site_id']), ('lat', site['lat']), ('lng', site['lng'])]) for site in dataset.sites])
+
+    metrics.stages.clear()
+    with metrics.stage('admin_levels_for_sites'):
+        overpass.admin_levels_for_sites(sites, url=http.url('/api/interpreter'), concurrency=4, per_second=1000)
+    overpass.relation_records.clear()
+    with metrics.stage('admin_levels_for_sites:cached'):
+        overpass.admin_levels_for_sites(sites, url=http.url('/api/interpreter'))
+    return metrics.report()['stages']
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    # Print the wall time of every stage against the baseline, and return the stages that have become more than
+    # tolerance slower, by more than min_seconds so that the noise in short stages is ignored.
+    regressions = []
+    print('\n%-6s %-24s %-40s %10s %10s %8s' % ('scale', 'run', 'stage', 'baseline', 'seconds', 'change'))
+    for scale, runs in results.items():
+        for run, stages in runs.items():
+            for stage, record in stages.items():
+                seconds = record['wall_seconds']
+                before = baseline.get(scale, {}).get(run, {}).get(stage)
+                if before is None:
+                    print('%-6s %-24s %-40s %10s %10.2f %8s' % (scale, run, stage, '-', seconds, '-'))
+                    continue
+                before = before['wall_seconds']
+                change = (seconds - before) / before if before > 0 else 0.0
+                regressed = seconds > before * (1 + tolerance) and seconds - before > min_seconds
+                print('%-6s %-24s %-40s %10.2f %10.2f %+7.0f%%%s' % (scale, run, stage, before, seconds, change * 100, ' REGRESSION' if regressed else ''))
+                if regressed:
+                    regressions.append((scale, run, stage))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark create_files.py and load.py on synthetic data at multiples of the Pf6 size, served by local stand-ins for their sources.')
+    parser.add_argument('--scale', type=int, action='append', help='Multiple of the Pf6 size to run at, which can be given more than once (default 1, 10 and 100).')
+    parser.add_argument('--seed', type=int, default=6, help='Seed for generating the synthetic data.')
+    parser.add_argument('--baseline', default=join(benchmarks_path, 'baseline.json'), help='Results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline, rather than comparing against it.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='How much slower than the baseline, as a fraction, a stage can be.')
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='How many seconds slower than the baseline a stage can be regardless.')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results.')
+    parser.add_argument('--directory', help='Where to run, by default a temporary directory that is removed afterwards.')
+    parser.add_argument('--pg-bin', help='The directory of initdb and pg_ctl, if not on the PATH.')
+    args = parser.parse_args()
+
+    directory = args.directory or tempfile.mkdtemp(prefix='pf_benchmark_')
+    results = OrderedDict()
+    try:
+        for scale in args.scale or [1, 10, 100]:
+            results[str(scale)] = run_scale(scale, args.seed, join(directory, 'scale_' + str(scale)), args.pg_bin)
+    finally:
+        if not args.directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = OrderedDict([('time', time.time()), ('seed', args.seed), ('scales', results)])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('Saved the baseline to ' + args.baseline)
+        sys.exit(0)
+
+    baseline = {}
+    if isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['scales']
+    else:
+        print('There is no baseline at ' + args.baseline + ' to compare against, save one with --save-baseline')
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    if len(regressions) > 0:
+        print('\n' + str(len(regressions)) + ' stages are slower than the baseline')
+        sys.exit(1)
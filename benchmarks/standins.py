@@ -0,0 +1,290 @@
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join, isdir
+from urllib.parse import urlparse, parse_qs, unquote
+
+import psycopg2
+
+# Stand-ins for the services create_files.py and load.py talk to, all on 127.0.0.1, for benchmarking without the real
+# Observatory, Alfresco, LDAP, Google Sheets, Sanger FTP and Overpass. Each is a context manager that starts the
+# service on entry and stops it on exit.
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def find_program(name, candidates):
+    # The program on the PATH, or else the newest of the candidate paths that exists.
+    path = shutil.which(name)
+    if path is None:
+        found = sorted(glob.glob(candidates))
+        path = found[-1] if len(found) > 0 else None
+    if path is None:
+        raise LookupError('Can not find ' + name + ', which the benchmarks need installed')
+    return path
+
+
+class Postgres:
+    """A throwaway Postgres cluster in a directory, for the Observatory and the merged database.
+
+    The cluster is created with initdb, which won't run as root, and trusts every connection from 127.0.0.1.
+    """
+
+    user = 'bench'
+
+    def __init__(self, directory, bin_directory=None):
+        self.directory = directory
+        self.bin_directory = bin_directory
+        self.port = free_port()
+
+    def _program(self, name):
+        if self.bin_directory:
+            return join(self.bin_directory, name)
+        return find_program(name, '/usr/lib/postgresql/*/bin/' + name)
+
+    def __enter__(self):
+        data = join(self.directory, 'data')
+        subprocess.run([self._program('initdb'), '-D', data, '-U', self.user, '-A', 'trust', '-E', 'UTF8'], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._program('pg_ctl'), '-D', data, '-l', join(self.directory, 'postgres.log'), '-w', 'start',
+                        '-o', '-p ' + str(self.port) + ' -k ' + self.directory + ' -c listen_addresses=127.0.0.1'], check=True, stdout=subprocess.DEVNULL)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        subprocess.run([self._program('pg_ctl'), '-D', join(self.directory, 'data'), '-m', 'fast', 'stop'], check=True, stdout=subprocess.DEVNULL)
+
+    def connect(self, database='postgres'):
+        return psycopg2.connect(**self.connection_params(database))
+
+    def connection_params(self, database):
+        return dict(host='127.0.0.1', port=str(self.port), sslmode='disable', database=database, user=self.user, password='')
+
+    def create_database(self, name):
+        connection = self.connect()
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE DATABASE "' + name + '"')
+        finally:
+            connection.close()
+
+
+class HttpStubs:
+    """One HTTP server standing in for Alfresco, the Google Sheets and Drive APIs and Overpass.
+
+    alfresco_studies is the JSON of the Alfresco collaborations, sheets the rows of each sheet of every spreadsheet
+    by sheet name, and admin_relations a function giving the Overpass relations containing a (lat, lng).
+    """
+
+    def __init__(self, alfresco_studies, sheets, admin_relations):
+        self.alfresco_studies = json.dumps(alfresco_studies).encode()
+        self.sheets = sheets
+        self.admin_relations = admin_relations
+        # The Drive version of the spreadsheets, which would change whenever they are edited.
+        self.sheets_version = '1'
+
+    def url(self, path):
+        return 'http://127.0.0.1:' + str(self.server.server_address[1]) + path
+
+    def discovery_document(self, name):
+        # Just enough of the discovery documents of the Sheets and Drive APIs for the calls gsheets.py makes.
+        standard_parameters = {name: {'type': 'string', 'location': 'query'} for name in ['fields', 'alt', 'key']}
+        if name == 'sheets':
+            resources = {'spreadsheets': {'resources': {'values': {'methods': {'batchGet': {
+                'id': 'sheets.spreadsheets.values.batchGet',
+                'path': 'v4/spreadsheets/{spreadsheetId}/values:batchGet',
+                'httpMethod': 'GET',
+                'parameters': {'spreadsheetId': {'type': 'string', 'location': 'path', 'required': True},
+                               'ranges': {'type': 'string', 'location': 'query', 'repeated': True}},
+                'parameterOrder': ['spreadsheetId'],
+                'response': {'$ref': 'BatchGetValuesResponse'},
+            }}}}}}
+        else:
+            resources = {'files': {'methods': {'get': {
+                'id': 'drive.files.get',
+                'path': 'files/{fileId}',
+                'httpMethod': 'GET',
+                'parameters': {'fileId': {'type': 'string', 'location': 'path', 'required': True}},
+                'parameterOrder': ['fileId'],
+                'response': {'$ref': 'File'},
+            }}}}
+        return {'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'name': name, 'version': 'v4' if name == 'sheets' else 'v3',
+                'rootUrl': self.url('/sheets/' if name == 'sheets' else '/'), 'servicePath': '' if name == 'sheets' else 'drive/v3/',
+                'parameters': standard_parameters, 'resources': resources,
+                # (Without a response schema the client returns the raw bytes rather than the parsed JSON.)
+                'schemas': {'BatchGetValuesResponse': {'id': 'BatchGetValuesResponse', 'type': 'object'}, 'File': {'id': 'File', 'type': 'object'}}}
+
+    def __enter__(self):
+        stubs = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, body, content_type='application/json', status=200, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/alfresco/service/cggh/collaborations':
+                    etag = '"' + str(len(stubs.alfresco_studies)) + '"'
+                    if self.headers.get('If-None-Match') == etag:
+                        return self.respond(b'', status=304, headers={'ETag': etag})
+                    return self.respond(stubs.alfresco_studies, headers={'ETag': etag})
+                if url.path in ['/discovery/sheets', '/discovery/drive']:
+                    return self.respond(json.dumps(stubs.discovery_document(url.path.split('/')[-1])).encode())
+                if url.path.startswith('/drive/v3/files/'):
+                    return self.respond(json.dumps({'version': stubs.sheets_version}).encode())
+                if url.path.startswith('/sheets/v4/spreadsheets/') and url.path.endswith('/values:batchGet'):
+                    value_ranges = []
+                    for sheet_range in query.get('ranges', []):
+                        # (The API leaves out the empty cells at the end of a row.)
+                        rows = [row[:max([i + 1 for i, value in enumerate(row) if value != ''] or [0])]
+                                for row in stubs.sheets[sheet_range.split('!')[0]]]
+                        value_ranges.append({'range': sheet_range, 'majorDimension': 'ROWS', 'values': rows})
+                    return self.respond(json.dumps({'spreadsheetId': unquote(url.path.split('/')[4]), 'valueRanges': value_ranges}).encode())
+                self.respond(b'Not found', 'text/plain', 404)
+
+            def do_POST(self):
+                # An Overpass query of points made by overpass.query_points.
+                if urlparse(self.path).path != '/api/interpreter':
+                    return self.respond(b'Not found', 'text/plain', 404)
+                query = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())['data'][0]
+                elements = []
+                for statement in query.split('is_in(')[1:]:
+                    (lat, lng) = [float(value) for value in statement.split(')')[0].split(',')]
+                    index = statement.split('index="')[1].split('"')[0]
+                    elements += stubs.admin_relations(lat, lng)
+                    elements.append({'type': 'point', 'id': int(index) + 1, 'tags': {'index': index}})
+                self.respond(json.dumps({'version': 0.6, 'elements': elements}).encode())
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FtpServer:
+    """An anonymous, read only FTP server of a directory, standing in for the Sanger FTP server (needs pyftpdlib)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def url(self, path):
+        return 'ftp://127.0.0.1:' + str(self.server.address[1]) + path
+
+    def __enter__(self):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(self.directory)
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.close_all()
+
+
+class Slapd:
+    """An OpenLDAP server of the people, loaded from LDIF with slapadd before it starts.
+
+    The schema has the attributes of the MalariaGEN people as ldapPeopleFields names them, on an OpenLDAPperson
+    object class. The OIDs under 1.3.6.1.4.1.99999 are made up, for this stand-in only.
+    """
+
+    base_dn = 'dc=malariagen,dc=net'
+
+    def __init__(self, directory, user_dn, password, ldif):
+        self.directory = directory
+        self.user_dn = user_dn
+        self.password = password
+        self.ldif = ldif
+        self.port = free_port()
+
+    def url(self):
+        return 'ldap://127.0.0.1:' + str(self.port)
+
+    def _schema(self):
+        attributes = ['malariagenUID', 'jobTitle1', 'jobTitle2', 'jobTitle3', 'o1', 'o2', 'o3', 'oProfile1', 'oProfile2', 'oProfile3',
+                      'linkedInURL', 'twitterURL', 'researchGateURL', 'scholarURL', 'ORCID']
+        schema = ''
+        for i, attribute in enumerate(attributes):
+            schema += ("attributetype ( 1.3.6.1.4.1.99999.1." + str(i + 1) + " NAME '" + attribute + "' EQUALITY caseIgnoreMatch " +
+                       "SUBSTR caseIgnoreSubstringsMatch SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 SINGLE-VALUE )\n")
+        schema += ("objectclass ( 1.3.6.1.4.1.99999.2.1 NAME 'OpenLDAPperson' SUP inetOrgPerson STRUCTURAL MUST ( uid $ cn ) MAY ( " +
+                   ' $ '.join(attributes) + " ) )\n")
+        return schema
+
+    def _config(self):
+        schema_directory = [d for d in ['/etc/ldap/schema', '/etc/openldap/schema', '/usr/local/etc/openldap/schema'] if isdir(d)]
+        if len(schema_directory) == 0:
+            raise LookupError('Can not find the OpenLDAP schema directory')
+        config = ''.join('include ' + join(schema_directory[0], name + '.schema') + '\n' for name in ['core', 'cosine', 'inetorgperson'])
+        config += 'include ' + join(self.directory, 'malariagen.schema') + '\n'
+        config += 'pidfile ' + join(self.directory, 'slapd.pid') + '\n'
+        # Some distributions build the backends as modules.
+        modules = glob.glob('/usr/lib/ldap/back_mdb.la') + glob.glob('/usr/lib*/openldap/back_mdb.la')
+        if len(modules) > 0:
+            config += 'modulepath ' + os.path.dirname(modules[0]) + '\nmoduleload back_mdb\n'
+        config += 'sizelimit unlimited\n'
+        config += ('database mdb\nmaxsize 4294967296\nsuffix "' + self.base_dn + '"\nrootdn "' + self.user_dn + '"\nrootpw ' + self.password + '\n' +
+                   'directory ' + join(self.directory, 'data') + '\nindex objectClass,malariagenUID eq\n')
+        return config
+
+    def __enter__(self):
+        os.makedirs(join(self.directory, 'data'), exist_ok=True)
+        with open(join(self.directory, 'malariagen.schema'), 'w') as f:
+            f.write(self._schema())
+        with open(join(self.directory, 'slapd.conf'), 'w') as f:
+            f.write(self._config())
+        with open(join(self.directory, 'people.ldif'), 'w') as f:
+            f.write(self.ldif)
+        slapd = find_program('slapd', '/usr/sbin/slapd')
+        subprocess.run([find_program('slapadd', '/usr/sbin/slapadd'), '-f', join(self.directory, 'slapd.conf'), '-l', join(self.directory, 'people.ldif')],
+                       check=True, stdout=subprocess.DEVNULL)
+        # slapd stays in the foreground while debugging, so it can be stopped by terminating it.
+        self.process = subprocess.Popen([slapd, '-f', join(self.directory, 'slapd.conf'), '-h', self.url(), '-d', '0'],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(self.port, self.process)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.process.terminate()
+        self.process.wait()
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Stand-in exited with status ' + str(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Stand-in did not start listening on port ' + str(port))
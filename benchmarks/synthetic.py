@@ -0,0 +1,488 @@
+import base64
+import csv
+import io
+import json
+import math
+import random
+from collections import OrderedDict
+
+import prevalence
+import sqlschema
+
+# The size of the Pf6 release, which a scale of 1 mimics: 7,113 samples from 73 sites in 29 countries, in 8 regions,
+# from 49 studies. The other countries are those added to the regions by panoptesObsRegionsAdditionalCountries, and
+# the people are about five per study in the studies' groups, with as many again in LDAP who aren't in any study.
+pf6_sizes = OrderedDict([
+    ('samples', 7113),
+    ('sites', 73),
+    ('countries', 29),
+    ('additional_countries', 15),
+    ('studies', 49),
+    ('people', 490),
+])
+# These don't grow with the number of samples.
+regions = 8
+drugs = 12
+resgenes = 10
+genes = 5500
+features = 40
+
+# The columns of pf_samples that come from the Sanger marker genotypes and Fws files rather than the Observatory.
+marker_columns = ['crt_76[K]', 'crt_72-76[CVMNK]', 'dhfr_51[N]', 'dhfr_59[C]', 'dhfr_108[S]', 'dhfr_164[I]', 'dhps_437[G]',
+                  'dhps_540[K]', 'dhps_581[A]', 'dhps_613[A]', 'k13_class', 'k13_alleles', 'cn_mdr1', 'cn_pm2', 'cn_gch1',
+                  'breakpoint_mdr1', 'breakpoint_pm2', 'breakpoint_gch1']
+fws_columns = ['Fws']
+
+# Each country's outline has this many vertices along each side, and some have small islands off their coast.
+vertices_per_side = 250
+vertices_per_island = 40
+
+# The area of the world the countries are laid out in, as (west, south, east, north).
+world = (-170.0, -50.0, 170.0, 60.0)
+
+first_names = ['Abdoulaye', 'Amélie', 'Chanaki', 'Dominic', 'Olivo', 'Rintis', 'Kesara', 'Nguyễn', 'Sónia', 'Tobias',
+               'Ogobara', 'Mayfong', 'Zbyněk', 'Kwame', 'Ifeoma', 'Lucas']
+last_names = ['Djimde', 'Amaratunga', 'Kwiatkowski', 'Miotto', 'Noedl', 'Ashley', 'Dondorp', 'Nosten', 'Ménard', 'Conway',
+              'Kamau', 'Oyola', 'Pearson', 'Goncalves', 'Mayxay', 'Newton']
+
+
+def country_code(i, count):
+    # Codes of two upper case letters, or more when there are too many countries for that.
+    width = max(2, int(math.ceil(math.log(max(count, 2), 26))))
+    code = ''
+    for j in range(width):
+        code = chr(ord('A') + i % 26) + code
+        i //= 26
+    return code
+
+
+class Dataset:
+    """Synthetic inputs for a run of create_files.py at a multiple of the Pf6 release's size.
+
+    The countries are laid out in a grid of rows separated by sea, each with a ragged outline of many vertices that
+    it shares exactly with its neighbours to the east and west, and some with islands in the sea to their south, so
+    that making the region outlines is as much work as for real countries. The regions are strips of neighbouring
+    countries. Everything is generated from the seed, so the same scale and seed always give the same data.
+    """
+
+    def __init__(self, scale, seed=6):
+        self.scale = scale
+        self.seed = seed
+        self.random = random.Random(str(seed) + ':' + str(scale))
+        self.sizes = OrderedDict((name, size * scale) for name, size in pf6_sizes.items())
+        self.tables = sqlschema.parse()
+        self._make_countries()
+        self._make_sites()
+        self._make_studies()
+        self._make_samples()
+        self._make_reference_data()
+
+    ### Countries, regions and sites
+
+    def _make_countries(self):
+        count = self.sizes['countries'] + self.sizes['additional_countries']
+        (west, south, east, north) = world
+        self.columns = int(math.ceil(math.sqrt(count * 2)))
+        self.rows = int(math.ceil(count / float(self.columns)))
+        self.cell_width = (east - west) / self.columns
+        self.row_pitch = (north - south) / self.rows
+        self.cell_height = self.row_pitch * 0.8
+
+        self.region_ids = ['R' + str(r + 1).zfill(2) for r in range(regions)]
+        self.countries = []
+        for i in range(count):
+            (column, row) = (i % self.columns, i // self.columns)
+            country_id = country_code(i, count)
+            self.countries.append(OrderedDict([
+                ('country_id', country_id),
+                ('column', column),
+                ('row', row),
+                ('region_id', self.region_ids[column * regions // self.columns]),
+                ('west', west + column * self.cell_width),
+                ('south', south + row * self.row_pitch),
+                ('name', 'Country ' + country_id),
+                ('alpha_3_code', (country_id + 'X')[:3]),
+            ]))
+
+        # Every region has countries with samples in, and the rest of its countries are added to it by
+        # panoptesObsRegionsAdditionalCountries, as for the real regions.
+        countries_by_region = OrderedDict((region_id, []) for region_id in self.region_ids)
+        for country in self.countries:
+            countries_by_region[country['region_id']].append(country)
+        candidates = [country for region_countries in countries_by_region.values() for country in region_countries[1:]]
+        additional = set(country['country_id'] for country in self.random.sample(candidates, min(len(candidates), self.sizes['additional_countries'])))
+        self.additional_countries = OrderedDict((region_id, []) for region_id in self.region_ids)
+        for country in self.countries:
+            country['has_samples'] = country['country_id'] not in additional
+            if not country['has_samples']:
+                self.additional_countries[country['region_id']].append(country['country_id'])
+            country['geojson'] = self._country_feature(country)
+
+    def _edge(self, key, start, end):
+        # A ragged line between two points, the same every time for the same key, so neighbours share their border.
+        rng = random.Random(str(self.seed) + ':' + key)
+        amplitude = 0.1 * min(self.cell_width, self.cell_height)
+        (x0, y0) = start
+        (x1, y1) = end
+        (dx, dy) = (x1 - x0, y1 - y0)
+        length = math.hypot(dx, dy)
+        (nx, ny) = (-dy / length, dx / length)
+        points = []
+        for k in range(vertices_per_side):
+            t = k / float(vertices_per_side)
+            offset = amplitude * math.sin(math.pi * t) * rng.uniform(-1, 1)
+            points.append([round(x0 + dx * t + nx * offset, 6), round(y0 + dy * t + ny * offset, 6)])
+        return points
+
+    def _country_feature(self, country):
+        (west, south) = (country['west'], country['south'])
+        (east, north) = (west + self.cell_width, south + self.cell_height)
+        (column, row) = (country['column'], country['row'])
+        # Counter-clockwise: the south coast, the border to the east, the north coast and the border to the west.
+        # The east border of one country is the west border of the next, traversed the other way.
+        ring = (self._edge('south:' + str(column) + ':' + str(row), (west, south), (east, south))
+                + self._edge('border:' + str(column + 1) + ':' + str(row), (east, south), (east, north))
+                + self._edge('north:' + str(column) + ':' + str(row), (east, north), (west, north))
+                + [[round(west, 6), round(north, 6)]]
+                + list(reversed(self._edge('border:' + str(column) + ':' + str(row), (west, south), (west, north))[1:])))
+        ring.append(ring[0])
+        polygons = [[ring]]
+
+        # Islands, in the sea between this row of countries and the one to the south.
+        sea = self.row_pitch - self.cell_height
+        for i in range(self.random.choice([0, 0, 1, 2, 3])):
+            (cx, cy) = (west + self.cell_width * self.random.uniform(0.1, 0.9), south - sea * self.random.uniform(0.3, 0.7))
+            radius = sea * 0.1
+            island = [[round(cx + radius * math.cos(2 * math.pi * k / vertices_per_island), 6),
+                       round(cy + radius * math.sin(2 * math.pi * k / vertices_per_island), 6)] for k in range(vertices_per_island)]
+            island.append(island[0])
+            polygons.append([island])
+
+        geometry = {'type': 'MultiPolygon', 'coordinates': polygons} if len(polygons) > 1 else {'type': 'Polygon', 'coordinates': polygons[0]}
+        return {'type': 'Feature', 'properties': {'country_id': country['country_id']}, 'geometry': geometry}
+
+    def _point_in(self, country):
+        # A point well inside the country's mainland, clear of its ragged outline.
+        return (round(country['south'] + self.cell_height * self.random.uniform(0.2, 0.8), 5),
+                round(country['west'] + self.cell_width * self.random.uniform(0.2, 0.8), 5))
+
+    def _make_sites(self):
+        sample_countries = [country for country in self.countries if country['has_samples']]
+        self.sites = []
+        for i in range(self.sizes['sites']):
+            # Every country with samples has at least one site.
+            country = sample_countries[i] if i < len(sample_countries) else self.random.choice(sample_countries)
+            (lat, lng) = self._point_in(country)
+            self.sites.append(OrderedDict([
+                ('site_id', 'S' + str(i + 1).zfill(5)),
+                ('name', 'Site ' + str(i + 1)),
+                ('country', country),
+                ('lat', lat),
+                ('lng', lng),
+            ]))
+
+    ### Studies and people
+
+    def _make_studies(self):
+        people_count = self.sizes['people']
+        self.people = []
+        for i in range(people_count):
+            (given_name, sn) = (self.random.choice(first_names), self.random.choice(last_names))
+            uid = 'person' + str(i + 1)
+            self.people.append(OrderedDict([
+                ('uid', uid),
+                ('malariagenUID', str(100000 + i)),
+                ('givenName', given_name),
+                ('sn', sn),
+                ('cn', given_name + ' ' + sn),
+                ('mail', uid + '@example.org'),
+                ('jobTitle1', self.random.choice(['Professor', 'Research Fellow', 'Lecturer', 'Scientist'])),
+                ('o1', 'Institute ' + str(self.random.randint(1, max(1, people_count // 10)))),
+                ('oProfile1', 'https://example.org/profiles/' + uid),
+                ('ORCID', '0000-0002-' + str(1000 + i % 9000) + '-' + str(1000 + i // 9000)),
+            ]))
+            if self.random.random() < 0.3:
+                self.people[-1].update([('jobTitle2', 'Honorary Fellow'), ('o2', 'University ' + str(self.random.randint(1, 50)))])
+            if self.random.random() < 0.2:
+                self.people[-1]['researchGateURL'] = 'https://www.researchgate.net/profile/' + uid
+
+        # Half of the people are in the studies' groups, the rest only in LDAP.
+        study_people = self.people[:max(1, people_count // 2)]
+        sample_countries = [country for country in self.countries if country['has_samples']]
+        self.studies = []
+        for i in range(self.sizes['studies']):
+            country = sample_countries[i % len(sample_countries)]
+            name = str(1001 + i) + '-PF-' + country['country_id'] + '-' + self.random.choice(last_names).upper()
+            group_contact = self.random.sample(study_people, min(len(study_people), self.random.randint(1, 2)))
+            group_public = self.random.sample(study_people, min(len(study_people), self.random.randint(2, 6)))
+            self.studies.append(OrderedDict([
+                ('name', name),
+                ('country', country),
+                ('webTitle', 'Genomic epidemiology of malaria in ' + country['name']),
+                ('webTitleApproved', 'true' if self.random.random() < 0.95 else 'false'),
+                ('description', 'Samples collected at ' + str(self.random.randint(1, 6)) + ' sites in ' + country['name'] + ' between ' +
+                    str(self.random.randint(2002, 2010)) + ' and ' + str(self.random.randint(2011, 2015)) + '.'),
+                ('descriptionApproved', 'true'),
+                ('groupContact', [{'malariagenUID': person['malariagenUID']} for person in group_contact]),
+                ('groupPublic', [{'malariagenUID': person['malariagenUID']} for person in group_public]),
+                ('publications', [OrderedDict([
+                    ('doi', '10.0000/bench.' + str(i) + '.' + str(j)),
+                    ('name', 'Publication ' + str(j + 1)),
+                    ('title', 'A genomic study of resistance ' + str(j + 1)),
+                    ('citation', 'Bench et al. (' + str(2010 + j) + ')'),
+                    ('pmid', str(20000000 + i * 10 + j)),
+                ]) for j in range(self.random.randint(0, 3))]),
+            ]))
+        # Some studies masquerade as another on the web, and Alfresco has a few studies the Observatory hasn't.
+        for i, study in enumerate(self.studies):
+            if i % 20 == 19:
+                study['webStudy'] = {'name': self.studies[i - 1]['name']}
+        self.alfresco_only_studies = [OrderedDict([
+            ('name', str(9001 + i) + '-PF-XX-UNRELEASED'), ('webTitle', 'Unreleased'), ('webTitleApproved', 'false'),
+            ('description', ''), ('descriptionApproved', 'false'), ('groupContact', []), ('groupPublic', []), ('publications', []),
+        ]) for i in range(max(1, self.sizes['studies'] // 10))]
+
+    ### Samples
+
+    def _make_samples(self):
+        statuses = ['Resistant', 'Sensitive', 'Sensitive', 'Undetermined', '']
+        deletion_statuses = ['Deletion', 'No deletion', 'No deletion', 'Undetermined']
+        studies_by_country = {}
+        for study in self.studies:
+            studies_by_country.setdefault(study['country']['country_id'], []).append(study)
+        # Some sites have many more samples than others, but every site, and so every region, has some.
+        weights = [1.0 / (i + 1) for i in range(len(self.sites))]
+        self.random.shuffle(weights)
+        sites = self.sites + self.random.choices(self.sites, weights=weights, k=self.sizes['samples'] - len(self.sites))
+
+        # The samples are kept as rows of these columns rather than as dicts, as there are so many of them.
+        self.sample_columns = [column for column, prevalence_column in prevalence.classifications] + [
+            'country', 'country_id', 'country_lat', 'country_lng', 'mean_coverage', 'pc_genome_callable', 'qc_pass', 'region',
+            'region_id', 'region_lat', 'region_lng', 'run_accessions', 'sample_id', 'site', 'site_id', 'site_lat', 'site_lng',
+            'study_id', 'year']
+        self.samples = []
+        for i, site in enumerate(sites):
+            country = site['country']
+            study = self.random.choice(studies_by_country.get(country['country_id']) or self.studies)
+            (region_lat, region_lng) = self._region_centre(country['region_id'])
+            self.samples.append(tuple(
+                [self.random.choice(deletion_statuses if column.endswith('deletion') else statuses) for column, prevalence_column in prevalence.classifications] + [
+                country['name'],
+                country['country_id'],
+                country['south'] + self.cell_height / 2,
+                country['west'] + self.cell_width / 2,
+                round(self.random.uniform(5, 150), 2),
+                round(self.random.uniform(40, 95), 2),
+                'true' if self.random.random() < 0.85 else 'false',
+                'Region ' + country['region_id'],
+                country['region_id'],
+                region_lat,
+                region_lng,
+                ', '.join('ERR' + str(1000000 + i * 3 + j) for j in range(self.random.randint(1, 3))),
+                'PF' + str(i + 1).zfill(7),
+                site['name'],
+                site['site_id'],
+                site['lat'],
+                site['lng'],
+                study['name'],
+                self.random.randint(2002, 2015),
+            ]))
+
+    def sample_values(self, column):
+        index = self.sample_columns.index(column)
+        return [sample[index] for sample in self.samples]
+
+    def _region_centre(self, region_id):
+        (west, south, east, north) = world
+        r = self.region_ids.index(region_id)
+        return ((south + north) / 2, west + (east - west) * (r + 0.5) / regions)
+
+    ### The rest of the Observatory, the Google Sheets and the Sanger files
+
+    def _make_reference_data(self):
+        self.drug_ids = ['D' + str(i + 1).zfill(2) for i in range(drugs)]
+        self.gene_ids = ['PF3D7_' + str(100000 + i * 17).zfill(7) for i in range(genes)]
+        self.resgene_ids = self.random.sample(self.gene_ids, resgenes)
+        self.feature_ids = ['F' + str(i + 1).zfill(3) for i in range(features)]
+
+    def _prevalences(self, names):
+        return [(name, round(self.random.uniform(0, 100), 1) if self.random.random() < 0.9 else '') for name in names]
+
+    def observatory_tables(self):
+        # The columns and rows of each Observatory view, and of the studies view, by view.
+        tables = OrderedDict()
+        prevalence_columns = lambda table: [column for column, sql_type in self.tables[table].columns.items()
+                                            if column.endswith('resistance') or column.endswith('deletion')]
+
+        num_samples = {}
+        for column in ['region_id', 'country_id', 'site_id']:
+            for value in self.sample_values(column):
+                num_samples[value] = num_samples.get(value, 0) + 1
+
+        rows = []
+        for region_id in self.region_ids:
+            (lat, lng) = self._region_centre(region_id)
+            row = OrderedDict(self._prevalences(prevalence_columns('pf_regions')))
+            row.update([('description', 'The countries of region ' + region_id), ('lat', lat), ('lng', lng),
+                        ('name', 'Region ' + region_id), ('num_samples', num_samples.get(region_id, 0)),
+                        ('region_id', region_id), ('web_colour', '#' + ''.join('%02x' % self.random.randint(0, 255) for k in range(3)))])
+            rows.append(row)
+        tables['regions_view'] = rows
+
+        rows = []
+        for country in self.countries:
+            row = OrderedDict(self._prevalences(prevalence_columns('countries')))
+            row.update([('alpha_3_code', country['alpha_3_code']), ('country_id', country['country_id']),
+                        ('geojson', json.dumps(country['geojson'])), ('lat', country['south'] + self.cell_height / 2),
+                        ('lng', country['west'] + self.cell_width / 2), ('name', country['name']),
+                        ('num_samples', num_samples.get(country['country_id'], 0))])
+            rows.append(row)
+        tables['countries_view'] = rows
+
+        rows = []
+        for site in self.sites:
+            row = OrderedDict(self._prevalences(prevalence_columns('pf_sites')))
+            row.update([('country_id', site['country']['country_id']), ('lat', site['lat']), ('lng', site['lng']),
+                        ('name', site['name']), ('num_samples', num_samples.get(site['site_id'], 0)),
+                        ('pf_region_id', site['country']['region_id']), ('site_id', site['site_id'])])
+            rows.append(row)
+        tables['sites_view'] = rows
+
+        tables['features_view'] = [OrderedDict([('category', self.random.choice(['gene', 'marker', 'drug'])),
+                                                ('description', 'Feature ' + feature_id), ('feature_id', feature_id),
+                                                ('name', 'Feature ' + feature_id)]) for feature_id in self.feature_ids]
+        tables['featuretypes_view'] = [OrderedDict([('description', 'Type ' + str(t) + ' of ' + feature_id), ('feature', 'Feature ' + feature_id),
+                                                    ('feature_id', feature_id), ('type_id', 'T' + str(t))])
+                                       for feature_id in self.feature_ids for t in range(self.random.randint(1, 3))]
+        tables['drug_regions_view'] = [OrderedDict([('drug_id', drug_id), ('drug_region_id', drug_id + '_' + region_id), ('region_id', region_id),
+                                                    ('resistance', round(self.random.uniform(0, 100), 1))])
+                                       for drug_id in self.drug_ids for region_id in self.region_ids]
+        tables['studies_view'] = [OrderedDict([('study_id', study['name'])]) for study in self.studies]
+
+        tables = OrderedDict((view, (list(rows[0].keys()), [list(row.values()) for row in rows])) for view, rows in tables.items())
+        tables['samples_view'] = (self.sample_columns, self.samples)
+        return tables
+
+    def countries_geojson(self):
+        # The countries table, with each country's GeoJSON.
+        return [(country['country_id'], json.dumps(country['geojson'])) for country in self.countries]
+
+    def alfresco_studies(self):
+        studies = []
+        for study in self.studies + self.alfresco_only_studies:
+            studies.append(OrderedDict((key, value) for key, value in study.items() if key != 'country'))
+        return {'collaborationNodes': studies}
+
+    def ldap_entries(self, base_dn):
+        # LDIF for the base entries and every person. Values that aren't plain ASCII are base64 encoded.
+        def attribute(name, value):
+            if all(32 <= ord(c) < 127 for c in value) and not value.startswith((' ', ':', '<')):
+                return name + ': ' + value + '\n'
+            return name + ':: ' + base64.b64encode(value.encode()).decode() + '\n'
+
+        (first, rest) = base_dn.split(',', 1)
+        ldif = ('dn: ' + base_dn + '\nobjectClass: dcObject\nobjectClass: organization\no: MalariaGEN\ndc: ' + first.split('=')[1] + '\n\n')
+        for ou in ['people', 'system']:
+            ldif += 'dn: ou=' + ou + ',' + base_dn + '\nobjectClass: organizationalUnit\nou: ' + ou + '\n\n'
+        ldif += 'dn: ou=users,ou=system,' + base_dn + '\nobjectClass: organizationalUnit\nou: users\n\n'
+        for person in self.people:
+            ldif += 'dn: uid=' + person['uid'] + ',ou=people,' + base_dn + '\nobjectClass: OpenLDAPperson\n'
+            ldif += ''.join(attribute(name, value) for name, value in person.items())
+            ldif += '\n'
+        return ldif
+
+    def gsheets_ranges(self):
+        # The rows of each sheet of the spreadsheet, by sheet name, as the Sheets API returns them.
+        drug_names = ['Artemisinin', 'Chloroquine', 'Mefloquine', 'Piperaquine', 'Pyrimethamine', 'Sulfadoxine', 'Amodiaquine',
+                      'Lumefantrine', 'Atovaquone', 'Quinine', 'Primaquine', 'Tafenoquine']
+        return OrderedDict([
+            ('Drugs', [['drug_id', 'name', 'is_combination', 'short_description', 'description']] +
+                [[drug_id, drug_names[i % len(drug_names)] + ('' if i < len(drug_names) else ' ' + str(i)), 'FALSE' if i % 4 else 'TRUE',
+                  'Short description of ' + drug_id, 'A longer description of ' + drug_id + ', as written for the web site.']
+                 for i, drug_id in enumerate(self.drug_ids)]),
+            ('Genes', [['gene_id', 'name', 'long_name', 'short_description', 'description', 'marker_name']] +
+                [[gene_id, 'gene' + str(i), 'Resistance gene ' + str(i), 'Gene ' + gene_id, 'About ' + gene_id] + ([] if i % 3 else ['marker' + str(i)])
+                 for i, gene_id in enumerate(self.resgene_ids)]),
+            ('DrugRegion', [['drug_region_id', 'text']] +
+                [[drug_id + '_' + region_id, 'Resistance to ' + drug_id + ' in ' + region_id] for drug_id in self.drug_ids for region_id in self.region_ids
+                 if self.random.random() < 0.7]),
+            ('DrugGene', [['gene_id', 'drug_id']] +
+                [[gene_id, drug_id] for gene_id in self.resgene_ids for drug_id in self.random.sample(self.drug_ids, 2)]),
+        ])
+
+    def sanger_files(self):
+        # The content of each of the Sanger FTP files, by name as in sangerFtpFiles. The marker genotypes and Fws
+        # cover most of the samples, and some samples the Observatory doesn't have.
+        sample_ids = [sample_id for sample_id in self.sample_values('sample_id') if self.random.random() < 0.95]
+        sample_ids += ['PX' + str(i + 1).zfill(7) for i in range(len(self.samples) // 50)]
+        alleles = ['K', 'T', 'K,T', '-', 'N', 'I', 'C', 'S', 'G', 'A']
+        files = OrderedDict()
+
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+        writer.writerow(['Sample'] + marker_columns)
+        for sample_id in sample_ids:
+            row = [sample_id]
+            for column in marker_columns:
+                if column.startswith('cn_'):
+                    row.append(self.random.choice(['1', '1', '2', '-1']))
+                elif column.startswith('breakpoint_'):
+                    row.append(self.random.choice(['-', '-', '+', '']))
+                elif column == 'k13_class':
+                    row.append(self.random.choice(['WT', 'WT', 'K13 resistant', 'other']))
+                elif column == 'k13_alleles':
+                    row.append(self.random.choice(['-', '-', 'C580Y', 'R539T', 'Y493H']))
+                else:
+                    row.append(self.random.choice(alleles))
+            writer.writerow(row)
+        files['markers'] = out.getvalue()
+
+        files['fws'] = 'Sample\tFws\n' + ''.join(sample_id + '\t' + str(round(self.random.uniform(0.3, 1.0), 4)) + '\n' for sample_id in sample_ids)
+
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter='\t', lineterminator='\n')
+        writer.writerow(list(self.tables['gene_diff'].columns))
+        for i, gene_id in enumerate(self.gene_ids):
+            start = 1000 + i * 4000
+            writer.writerow([gene_id, 'gene' + str(i), 'Pf3D7_' + str(1 + i * 14 // genes).zfill(2) + '_v3', start, start + self.random.randint(300, 8000),
+                             round(self.random.random(), 4), round(self.random.random(), 4), self.random.randint(0, 500000)])
+        files['gene_diff'] = out.getvalue()
+        return files
+
+    def landmass(self):
+        # The rows of countries, roughly, for clipping admin boundaries to as landmass.wkb is.
+        import shapely.geometry
+        rows = []
+        for row in range(self.rows):
+            countries = [country for country in self.countries if country['row'] == row]
+            south = world[1] + row * self.row_pitch
+            rows.append(shapely.geometry.box(world[0], south, world[0] + len(countries) * self.cell_width, south + self.cell_height))
+        return shapely.geometry.MultiPolygon(rows)
+
+    def admin_relations(self, lat, lng):
+        # The admin boundaries containing a point, as Overpass returns them: a province (admin_level 4) of a
+        # quarter of the country and a district (admin_level 6) of a sixteenth, each a square made of two ways.
+        relations = []
+        for (admin_level, divisions) in [('4', 2), ('6', 4)]:
+            (width, height) = (self.cell_width / divisions, self.row_pitch / divisions)
+            (column, row) = (int(math.floor((lng - world[0]) / width)), int(math.floor((lat - world[1]) / height)))
+            (west, south) = (world[0] + column * width, world[1] + row * height)
+            corners = [(west, south), (west + width, south), (west + width, south + height), (west, south + height)]
+            outline = []
+            for (start, end) in zip(corners, corners[1:] + corners[:1]):
+                outline += [(start[0] + (end[0] - start[0]) * k / 50.0, start[1] + (end[1] - start[1]) * k / 50.0) for k in range(50)]
+            outline.append(outline[0])
+            half = len(outline) // 2
+            relation_id = int(admin_level) * 10 ** 9 + column * 10 ** 5 + row
+            name = ('Province ' if admin_level == '4' else 'District ') + str(column) + '-' + str(row)
+            relations.append({
+                'type': 'relation',
+                'id': relation_id,
+                'version': 1,
+                'tags': {'boundary': 'administrative', 'admin_level': admin_level, 'name': name, 'name:en': name},
+                'members': [{'type': 'way', 'ref': relation_id * 10 + k, 'role': 'outer',
+                             'geometry': [{'lat': y, 'lon': x} for (x, y) in part]}
+                            for k, part in enumerate([outline[:half + 1], outline[half:]])],
+            })
+        return relations
+
@@ -1,30 +1,43 @@
 import pandas
 import yaml
-from collections import OrderedDict
-from os.path import join, isdir, isfile
+from collections import OrderedDict, deque
+from os.path import join
 
 ## For data fetching
 import psycopg2
+import psycopg2.pool
 import csv
 import requests
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 from base64 import b64encode
 import httplib2
-from apiclient import discovery
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
 ## For data processing
 import geojson
-import shapely.geometry
-import shapely.ops
-from shapely.geometry import JOIN_STYLE, Point
+from diskcache import Cache
 
-import sys # For: csv.field_size_limit(sys.maxsize)
+import sys
+import argparse
+import hashlib
+import json
 import os # For: os.rename('data.tmp', 'data')
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import overpass
+import geometry
+import prevalence
+import merge
+import topology
+from manifest import Manifest
+from fetch_cache import FetchCache
+from tablestore import TableStore
+from gsheets import GSheets
+from metrics import metrics
 
 with open('settings_nosecrets', 'r') as f:
     settings = yaml.load(f, Loader=yaml.BaseLoader)
@@ -37,322 +50,269 @@ csv_row_separator = "\n"
 csv_list_separator = "; "
 
 
-def run():
+def run(force=False, offline=False, export_tsv=False):
 
     # Determine the paths to the datatable directories.
     datatables_path = join('output')
 
-    #####################################################################
-    ### Observatory db server
-
-    # Try to connect to the database,
-    # http://initd.org/psycopg/docs/
-    conn = psycopg2.connect(
-        host = settings["observatoryDbServerHost"],
-        port = str(settings["observatoryDbServerPort"]),
-        sslmode = settings["observatoryDbServerSSL"],
-        database = settings["observatoryDbServerDatabase"],
-        user = settings["observatoryDbServerUser"],
-        password = settings["observatoryDbServerPass"]
-    )
-    cur = conn.cursor()
-
-    # Get the authoritative list of studies from the Observatory.
-    study_list_query = "SELECT \"" + settings["observatoryDbStudyField"] + "\" FROM \"" + settings["observatoryDbServerDbSchema"] + "\".\"" + settings["observatoryDbStudiesView"] + "\""
-    cur.execute(study_list_query)
-    obsStudies = [row[0] for row in cur.fetchall()]
-
-    if len(obsStudies) == 0:
-        raise ValueError('observatoryDbStudiesView returned zero obsStudies')
-
-    for observatoryDbView_index, observatoryDbView in enumerate(settings["observatoryDbViews"]):
-        datatable = settings["panoptesObsTables"][observatoryDbView_index]
-        datatable_path = join(datatables_path, datatable)
-        data_file_path = join(datatable_path, "data")
+    # The datatables, as TSV or as typed Arrow files.
+    store = TableStore(datatables_path, settings["intermediateFormat"], csv_value_separator, csv_row_separator)
 
-        if not isdir(datatable_path):
-            os.mkdir(datatable_path)
+    # Local copies of the files on the Sanger FTP server.
+    fetch_cache = FetchCache(settings["fetchCachePath"], offline=offline, timeout=float(settings["fetchTimeout"]))
 
-        # Open the data file for writing.
-        data_file = open(data_file_path, 'w')
+    # The Google Sheets, only authorized once needed, with the values of each version of a spreadsheet cached.
+    gsheets = GSheets(authorizeGSheets, Cache(settings["gsheetsCachePath"]), settings["gsheetsApiDiscoveryUrl"], settings["gdriveApiDiscoveryUrl"])
 
-        # http://initd.org/psycopg/docs/cursor.html#cursor.copy_expert
-        ## Mogrify throws a syntax error when I try to interpolate the params.
-        # http://initd.org/psycopg/docs/cursor.html#cursor.mogrify
-        # https://www.postgresql.org/docs/9.5/static/sql-copy.html
-        ## Such queries can be checked first using the psql CLI, e.g.
-        # COPY (SELECT * FROM observatory."Samples with types") TO STDOUT (FORMAT csv, HEADER TRUE, DELIMITER E'\t');
-        copy_data_query = "COPY (SELECT * FROM \"" + settings["observatoryDbServerDbSchema"] + "\".\"" + observatoryDbView + "\") TO STDOUT (FORMAT csv, HEADER TRUE, DELIMITER E'\t', QUOTE E'\b', ESCAPE E'\b', NULL '')"''
-        cur.copy_expert(copy_data_query, data_file)
-
-        # Close the data file.
-        data_file.close()
-
-    #Get all countries JSON polygons
-    geoJSON_for_country = {}
-    query = 'SELECT "'+settings["panoptesObsCountriesTableCountryField"] + '","' + settings["panoptesObsCountriesTableGeoJsonField"] + \
-            '" FROM "'+ settings["observatoryDbServerDbSchema"] + '"."' + settings["panoptesObsCountriesTable"] + '"'
-    cur.execute(query)
-    result = cur.fetchall()
-    for (country_id, geoJSON) in result:
-        geoJSON_for_country[country_id] = geoJSON
+    #####################################################################
+    ### Work out which datatables need rebuilding
+    metrics.begin('probe')
+
+    # Each datatable is only rebuilt if the markers of the sources it is built from have changed since the
+    # last run, as recorded in the manifest.
+    manifest = Manifest(settings["manifestPath"])
+    sources_by_datatable = datatableSources()
+
+    # Probe every source for its marker, without fetching the data itself.
+    probed = runFetchStage(OrderedDict([
+        ('Observatory db server', probeObservatory),
+        ('Alfresco server', lambda: probeAlfrescoStudies(manifest.source_marker('alfresco'))),
+        ('LDAP server', lambda: probeLdapPeople(manifest.source_marker('ldap'))),
+        ('Google Sheets', lambda: probeGSheets(gsheets)),
+        ('Sanger FTP', lambda: probeSangerFiles(fetch_cache)),
+    ]), int(settings["fetchConcurrency"]), 'probe')
+
+    # The Alfresco probe is a conditional GET, so it already has the studies if they have changed.
+    (alfresco_marker, alfStudies) = probed['Alfresco server']
+    source_markers = {'alfresco': alfresco_marker, 'ldap': probed['LDAP server']}
+    source_markers.update(probed['Observatory db server'])
+    source_markers.update(probed['Google Sheets'])
+    source_markers.update(probed['Sanger FTP'])
+    source_markers.update({'settings:' + name: settingMarker(name) for name in [
+        'panoptesObsRegionsAdditionalCountries', 'prevalenceDatatables', 'gsheetsMerge', 'geometryLevels', 'alfrescoStudiesFields',
+        'alfrescoStudyPublicationsFields', 'ldapPeopleFields', 'panoptesAlfStudyLdapPeopleFields', 'panoptesAlfStudyLdapPeopleGroups']})
+
+    def datatableMarkers(datatable):
+        return {source: source_markers[source] for source in sources_by_datatable[datatable]}
+
+    dirty = [datatable for datatable in sources_by_datatable if force
+             or not store.exists(datatable)
+             or not manifest.is_current(datatable, datatableMarkers(datatable))]
+
+    manifest.record_sources(source_markers)
+    if len(dirty) == 0:
+        print("No sources have changed, nothing to rebuild")
+        manifest.save()
+        if export_tsv:
+            store.export_tsv(sources_by_datatable.keys())
+        return
+    print("Rebuilding: " + ", ".join(dirty))
+
+    studies_datatables = [settings["panoptesAlfStudiesTable"], settings["panoptesAlfStudyPublicationsTable"], settings["panoptesAlfStudyLdapPeopleTable"]]
+    rebuild_studies = any(datatable in dirty for datatable in studies_datatables)
+    rebuild_samples = settings["panoptesObsSamplesTable"] in dirty
+    rebuild_regions = settings["panoptesObsRegionsTable"] and settings["panoptesObsRegionsTable"] in dirty
 
 
-    # Close the db cursor and connection.
-    cur.close()
-    conn.close()
-
     #####################################################################
-    ### Alfresco server (studies)
-    data = requests.get(settings["alfrescoStudiesURL"], auth=(settings["alfrescoUserId"], settings["alfrescoUserPass"])).json()
-    alfStudies = data["collaborationNodes"]
+    ### Fetch from every source concurrently
+    metrics.begin('fetch')
+
+    # The sources are independent of each other, so fetch them all at once and only move on to
+    # the processing below once every fetch has finished. Only what the dirty datatables need is fetched.
+    observatoryDbViews = [observatoryDbView for observatoryDbView, datatable in zip(settings["observatoryDbViews"], settings["panoptesObsTables"]) if datatable in dirty]
+    gsheets_indexes = [gsheetsId_index for gsheetsId_index, datatable in enumerate(settings["panoptesGsheetsTables"]) if datatable in dirty]
+    sanger_files_needed = (['markers', 'fws'] if rebuild_samples else []) + (['gene_diff'] if 'gene_diff' in dirty else [])
+
+    fetches = OrderedDict()
+    if len(observatoryDbViews) > 0 or rebuild_studies or rebuild_samples or rebuild_regions:
+        fetches['Observatory db server'] = lambda: fetchObservatory(store, observatoryDbViews, rebuild_regions)
+    if (rebuild_studies or rebuild_samples) and alfStudies is None:
+        fetches['Alfresco server'] = fetchAlfrescoStudies
+    # Only the people in the studies' groups are fetched from LDAP, so if the studies still have to be fetched
+    # the people are fetched afterwards.
+    def fetchStudyLdapPeople(alfStudies):
+        return fetchLdapPeople(
+            ldapServer=settings["ldapServerURL"]
+            , ldapUserDN=settings["ldapUserDN"]
+            , ldapUserPass=settings["ldapUserPass"]
+            , ldapPeopleBaseDN=settings["ldapPeopleBaseDN"]
+            , ldapPeopleFilterString=settings["ldapPeopleFilterString"]
+            , ldapPeopleFields=settings["ldapPeopleFields"]
+            , malariagenUIDs=getAlfStudiesMalariagenUIDs(alfStudies, settings["panoptesAlfStudyLdapPeopleGroups"])
+            , ldapCache=Cache(settings["ldapCachePath"])
+            , ldapPageSize=int(settings["ldapPageSize"])
+        )
+    if rebuild_studies and alfStudies is not None:
+        fetches['LDAP server'] = lambda alfStudies=alfStudies: fetchStudyLdapPeople(alfStudies)
+    if len(gsheets_indexes) > 0:
+        fetches['Google Sheets'] = lambda: fetchGSheets(gsheets, gsheets_indexes, source_markers)
+    if len(sanger_files_needed) > 0:
+        fetches['Sanger FTP'] = lambda: fetchSangerFiles(fetch_cache, sanger_files_needed)
 
-    if len(alfStudies) == 0:
-        raise ValueError('fetchAlfrescoStudies returned zero collaborationNodes')
+    fetched = runFetchStage(fetches, int(settings["fetchConcurrency"]), 'fetch')
 
-    # Collect the studies by name, to facilitate a subsequent parse.
-    studiesByName = {}
-    for study in alfStudies:
-      if study["name"] not in studiesByName:
-        studiesByName[study["name"]] = study
-      else:
-        raise ValueError('Duplicate study name: ', str(study['name']))
+    (obsStudies, geoJSON_for_country) = fetched.get('Observatory db server', (None, None))
+    alfStudies = fetched.get('Alfresco server', alfStudies)
+    ldapPeople = fetched.get('LDAP server')
+    if rebuild_studies and ldapPeople is None:
+        ldapPeople = runFetchStage(OrderedDict([('LDAP server', lambda: fetchStudyLdapPeople(alfStudies))]), 1, 'fetch')['LDAP server']
+    gsheets_rows = fetched.get('Google Sheets', {})
+    sanger_files = fetched.get('Sanger FTP', {})
 
+    if rebuild_studies or rebuild_samples:
+        webStudies = getWebStudies(alfStudies, obsStudies)
 
-    #####################################################################
-    ### LDAP server (people)
-
-    ldapPeople = fetchLdapPeople(
-        ldapServer=settings["ldapServerURL"]
-        , ldapUserDN=settings["ldapUserDN"]
-        , ldapUserPass=settings["ldapUserPass"]
-        , ldapPeopleBaseDN=settings["ldapPeopleBaseDN"]
-        , ldapPeopleFilterString=settings["ldapPeopleFilterString"]
-        , ldapPeopleFields=settings["ldapPeopleFields"]
-    )
+    # The samples are post-processed straight from the COPY output below, the other views are ready as they are.
+    for observatoryDbView in observatoryDbViews:
+        datatable = dict(zip(settings["observatoryDbViews"], settings["panoptesObsTables"]))[observatoryDbView]
+        if datatable != settings["panoptesObsSamplesTable"]:
+            store.import_tsv(datatable, store.staging_path(datatable))
 
 
     #####################################################################
     ### Google Sheets (genes)
+    metrics.begin('gsheets')
 
-    gsheets_service = discovery.build(
-        settings["gsheetsApiServiceName"],
-        settings["gsheetsApiServiceVersion"],
-        http=establishGSheetsCredentials(
-            settings["gsheetsClientSecretPath"],
-            settings["gsheetsCredentialsPath"],
-            settings["gsheetsAuthHost"],
-            settings["gsheetsAuthPort"]
-        ).authorize(httplib2.Http()),
-        discoveryServiceUrl=settings["gsheetsApiDiscoveryUrl"]
-    )
-
-    for gsheetsId_index, gsheet_id in enumerate(settings["gsheetsIds"]):
+    for gsheetsId_index in gsheets_indexes:
 
         datatable = settings["panoptesGsheetsTables"][gsheetsId_index]
-        datatable_path = join(datatables_path, datatable)
-        data_file_path = join(datatable_path, "data")
 
-        gsheet_range = settings["gsheetsRanges"][gsheetsId_index]
-
-        if not isdir(datatable_path):
-            os.mkdir(datatable_path)
-
-        # Read in the data.
-        gsheet_rows = gsheets_service.spreadsheets().values().get(spreadsheetId=gsheet_id, range=gsheet_range).execute().get('values', [])
+        gsheet_rows = gsheets_rows[gsheetsId_index]
 
         # Merge with data fetched from observatoryDb - observatoryDb rows are used and gsheet rows merged in, such that only primary keys from observatoryDb persist
         if datatable in settings["panoptesObsTables"]:
             print("Merging google sheet for " + datatable)
-            with open(data_file_path, 'r') as data_file:
-                exisiting_rows = list(csv.DictReader(data_file, delimiter=csv_value_separator))
-
-            #Transform the google sheet rows to dicts
-            gsheet_columns = gsheet_rows[0]
-            gsheet_rows = [{key: (row[i] if i < len(row) else '') for i, key in enumerate(gsheet_columns)} for row in gsheet_rows[1:]]
-            #Find the index column
-            exisiting_columns = set(exisiting_rows[0].keys())
-            matching_columns = set(gsheet_columns).intersection(exisiting_columns)
-            all_columns = set(gsheet_columns).union(exisiting_columns)
-            if len(matching_columns) != 1:
-                raise ValueError('When merging a gsheet there should be one and only one column to match on, we got:', str(matching_columns))
-            index_column = list(matching_columns)[0]
-            #Index the gsheet data
-            indexed_gsheet_rows = {row[index_column]:row for row in gsheet_rows}
-            # Write out the data.
-            with open(data_file_path, 'w') as data_file:
-                writer = csv.DictWriter(data_file, all_columns, delimiter=csv_value_separator, lineterminator=csv_row_separator)
-                writer.writeheader()
-                for row in exisiting_rows:
-                    row.update(indexed_gsheet_rows.get(row[index_column], {}))
-                    writer.writerow(row)
+            merge_settings = settings["gsheetsMerge"].get(datatable, {})
+            (columns, rows) = store.reader(datatable)
+            # The datatable is streamed through the merge and written straight back, in the column order of schema.sql.
+            (merged_columns, merged_rows) = merge.merge(
+                columns, rows, gsheet_rows[0], gsheet_rows[1:],
+                key=merge_settings.get('key'),
+                conflict=merge_settings.get('conflict', 'overlay'),
+                schema_columns=list(store.schema[datatable].columns) if datatable in store.schema else []
+            )
+            with store.writer(datatable, merged_columns) as writer:
+                writer.writerows(merged_rows)
 
         else:
             # Write out the data.
-            with open(data_file_path, 'w') as data_file:
-                writer = csv.writer(data_file, delimiter=csv_value_separator, lineterminator=csv_row_separator)
-                for line in gsheet_rows:
-                    writer.writerow(line)
+            # (The Sheets API leaves out empty cells at the end of a row.)
+            with store.writer(datatable, gsheet_rows[0]) as writer:
+                writer.writerows(row + [''] * (len(gsheet_rows[0]) - len(row)) for row in gsheet_rows[1:])
 
 
     #####################################################################
     ### Process the Alfresco and LDAP data
+    metrics.begin('studies')
 
-    # Determine the paths to the datatable directories.
-    alf_studies_datatable_dir_path = join(datatables_path, settings["panoptesAlfStudiesTable"])
-    alf_study_publications_datatable_dir_path = join(datatables_path, settings["panoptesAlfStudyPublicationsTable"])
-    alf_study_ldap_people_datatable_dir_path = join(datatables_path, settings["panoptesAlfStudyLdapPeopleTable"])
-
-
-    if not isdir(alf_studies_datatable_dir_path):
-        os.mkdir(alf_studies_datatable_dir_path)
-    if not isdir(alf_study_publications_datatable_dir_path):
-        os.mkdir(alf_study_publications_datatable_dir_path)
-    if not isdir(alf_study_ldap_people_datatable_dir_path):
-        os.mkdir(alf_study_ldap_people_datatable_dir_path)
-
-    # Determine the paths to the data files.
-    alf_studies_data_file_path = join(alf_studies_datatable_dir_path, "data")
-    alf_study_publications_data_file_path = join(alf_study_publications_datatable_dir_path, "data")
-    alf_study_ldap_people_data_file_path = join(alf_study_ldap_people_datatable_dir_path, "data")
-
-    # Print a warning if any of the data files already exist.
-    if isfile(alf_studies_data_file_path):
-        print("Warning: Overwriting file: " + alf_studies_data_file_path)
-    if isfile(alf_study_publications_data_file_path):
-        print("Warning: Overwriting file: " + alf_study_publications_data_file_path)
-    if isfile(alf_study_ldap_people_data_file_path):
-        print("Warning: Overwriting file: " + alf_study_ldap_people_data_file_path)
-
-    # Open the CSV files for writing.
-    alf_studies_data_file = open(alf_studies_data_file_path, 'w')
-    alf_study_publications_data_file = open(alf_study_publications_data_file_path, 'w')
-    alf_study_ldap_people_data_file = open(alf_study_ldap_people_data_file_path, 'w')
-
-    # Append the heading lines.
-    alf_studies_data_file.write(csv_value_separator.join(["study"] + settings["alfrescoStudiesFields"]) + csv_row_separator)
-    alf_study_publications_data_file.write(csv_value_separator.join(["study"] + settings["alfrescoStudyPublicationsFields"]) + csv_row_separator)
-    alf_study_ldap_people_data_file.write(csv_value_separator.join(["study"] + settings["panoptesAlfStudyLdapPeopleFields"]) + csv_row_separator)
+    if rebuild_studies:
+        # Print a warning if any of the datatables already exist.
+        for datatable in studies_datatables:
+            if store.exists(datatable):
+                print("Warning: Overwriting datatable: " + datatable)
 
-    webStudies = {}
-    for study in alfStudies:
-        if study['name'] not in obsStudies:
-            continue
-        if "webStudy" in study:
-            webStudies[study['name']] = study['webStudy']['name']
-            print("appending", study['webStudy']['name'])
-            if study['webStudy']['name'] not in obsStudies:
-                obsStudies.append(study['webStudy']['name'])
+        # The files are written as TSV and then moved into the store.
+        alf_studies_data_file_path = store.staging_path(settings["panoptesAlfStudiesTable"])
+        alf_study_publications_data_file_path = store.staging_path(settings["panoptesAlfStudyPublicationsTable"])
+        alf_study_ldap_people_data_file_path = store.staging_path(settings["panoptesAlfStudyLdapPeopleTable"])
 
-    studiesNotProcessed = list(obsStudies)
-    for study in alfStudies:
+        # Open the CSV files for writing.
+        alf_studies_data_file = open(alf_studies_data_file_path, 'w')
+        alf_study_publications_data_file = open(alf_study_publications_data_file_path, 'w')
+        alf_study_ldap_people_data_file = open(alf_study_ldap_people_data_file_path, 'w')
 
-        alf_study_name = study['name']
-        study_number = getStudyNumber(study['name'], csv_value_separator)
+        # Append the heading lines.
+        alf_studies_data_file.write(csv_value_separator.join(["study"] + settings["alfrescoStudiesFields"]) + csv_row_separator)
+        alf_study_publications_data_file.write(csv_value_separator.join(["study"] + settings["alfrescoStudyPublicationsFields"]) + csv_row_separator)
+        alf_study_ldap_people_data_file.write(csv_value_separator.join(["study"] + settings["panoptesAlfStudyLdapPeopleFields"]) + csv_row_separator)
 
-        # Skip this study if the alf_study_name is not in the list of obsStudies.
-        if alf_study_name not in obsStudies:
-            continue
+        study_rows = []
+        study_publication_rows = []
+        study_ldap_people_rows = []
+        studiesNotProcessed = list(obsStudies)
+        for study in alfStudies:
 
-        if studiesNotProcessed is not None:
-          studiesNotProcessed.remove(alf_study_name)
+            alf_study_name = study['name']
+            study_number = getStudyNumber(study['name'], csv_value_separator)
 
-        # Skip anything with a webStudy.
-        if "webStudy" in study:
-            continue
+            # Skip this study if the alf_study_name is not in the list of obsStudies.
+            if alf_study_name not in obsStudies:
+                continue
 
-        # Compose the study row, which will be appended to the CSV file
-        # study	study_number    webTitle    description
+            if studiesNotProcessed is not None:
+              studiesNotProcessed.remove(alf_study_name)
 
-        study_row = [alf_study_name, study_number]
+            # Skip anything with a webStudy.
+            if "webStudy" in study:
+                continue
 
-        if study["webTitleApproved"] == "false":
-            print("Warning: webTitle not approved for:" + study['name'])
-        study_row.append(study["webTitle"].replace(csv_value_separator, ""))
+            # Compose the study row, which will be appended to the CSV file
+            # study	study_number    webTitle    description
 
-        if study["descriptionApproved"] == "false":
-            print("Warning: description not approved for:" + study['name'])
-        study_row.append(study["description"].replace(csv_value_separator, ""))
+            study_row = [alf_study_name, study_number]
 
-        alfStudyLdapPeople = getAlfStudyLdapPeople(
-            ldapPeople=ldapPeople
-            , alfStudy=study
-            , panoptesAlfStudyLdapPeopleGroups=settings["panoptesAlfStudyLdapPeopleGroups"]
-        )
+            if study["webTitleApproved"] == "false":
+                print("Warning: webTitle not approved for:" + study['name'])
+            study_row.append(study["webTitle"].replace(csv_value_separator, ""))
 
-        # Write the related records: people and publications.
-        writeRelatedRecords(study["publications"], alf_study_name, settings["alfrescoStudyPublicationsFields"], alf_study_publications_data_file, csv_list_separator, csv_row_separator, csv_value_separator)
-        writeRelatedRecords(alfStudyLdapPeople, alf_study_name, settings["panoptesAlfStudyLdapPeopleFields"], alf_study_ldap_people_data_file, csv_list_separator, csv_row_separator, csv_value_separator)
+            if study["descriptionApproved"] == "false":
+                print("Warning: description not approved for:" + study['name'])
+            study_row.append(study["description"].replace(csv_value_separator, ""))
 
-        # Write the study to the CSV file
-        alf_studies_data_file.write((csv_value_separator.join(study_row).replace("\n", " ").replace("\r", " ") + csv_row_separator).encode('ascii', 'xmlcharrefreplace').decode())
+            alfStudyLdapPeople = getAlfStudyLdapPeople(
+                ldapPeople=ldapPeople
+                , alfStudy=study
+                , panoptesAlfStudyLdapPeopleGroups=settings["panoptesAlfStudyLdapPeopleGroups"]
+            )
 
-    if studiesNotProcessed is not None and len(studiesNotProcessed) > 0:
-        raise ValueError('These studies were not found', str(studiesNotProcessed))
+            # The related records: people and publications.
+            study_publication_rows += relatedRows(study["publications"], alf_study_name, settings["alfrescoStudyPublicationsFields"], csv_list_separator)
+            study_ldap_people_rows += relatedRows(alfStudyLdapPeople, alf_study_name, settings["panoptesAlfStudyLdapPeopleFields"], csv_list_separator)
 
-    # Close the CSV files.
-    alf_studies_data_file.close()
-    alf_study_publications_data_file.close()
-    alf_study_ldap_people_data_file.close()
+            study_rows.append(study_row)
 
+        if studiesNotProcessed is not None and len(studiesNotProcessed) > 0:
+            raise ValueError('These studies were not found', str(studiesNotProcessed))
 
-    #####################################################################
-    ### Determine the paths to the datatable directories and data files.
+        # Write each CSV file in one go.
+        writeRows(study_rows, alf_studies_data_file, csv_row_separator, csv_value_separator)
+        writeRows(study_publication_rows, alf_study_publications_data_file, csv_row_separator, csv_value_separator)
+        writeRows(study_ldap_people_rows, alf_study_ldap_people_data_file, csv_row_separator, csv_value_separator)
 
-    # Determine the paths to the datatable directories.
-    if settings["panoptesObsRegionsTable"]:
-        obs_regions_datatable_dir_path = join(datatables_path, settings["panoptesObsRegionsTable"])
-    obs_samples_datatable_dir_path = join(datatables_path, settings["panoptesObsSamplesTable"])
-    obs_countries_datatable_dir_path = join(datatables_path, settings["panoptesObsCountriesTable"])
-    obs_locations_datatable_dir_path = join(datatables_path, settings["panoptesObsLocationsTable"])
+        # Close the CSV files.
+        alf_studies_data_file.close()
+        alf_study_publications_data_file.close()
+        alf_study_ldap_people_data_file.close()
+
+        store.import_tsv(settings["panoptesAlfStudiesTable"], alf_studies_data_file_path)
+        store.import_tsv(settings["panoptesAlfStudyPublicationsTable"], alf_study_publications_data_file_path)
+        store.import_tsv(settings["panoptesAlfStudyLdapPeopleTable"], alf_study_ldap_people_data_file_path)
 
-    # Create dirs if the datatable directories are missing.
-    if settings["panoptesObsRegionsTable"]:
-        if not isdir(obs_regions_datatable_dir_path):
-            os.mkdir(obs_regions_datatable_dir_path)
-    if not isdir(obs_samples_datatable_dir_path):
-        os.mkdir(obs_samples_datatable_dir_path)
-    if not isdir(obs_countries_datatable_dir_path):
-        os.mkdir(obs_countries_datatable_dir_path)
-
-    # Determine the paths to the data files.
-    if settings["panoptesObsRegionsTable"]:
-        obs_regions_data_file_path = join(obs_regions_datatable_dir_path, "data")
-    obs_samples_data_file_path = join(obs_samples_datatable_dir_path, "data")
-    obs_locations_data_file_path = join(obs_locations_datatable_dir_path, "data")
-    obs_countries_data_file_path = join(obs_countries_datatable_dir_path, "data")
 
-    # Raise errors if the data files do not exist.
+    #####################################################################
+    ### Check the datatables needed below exist.
+
+    # Raise errors if the datatables do not exist.
     if settings["panoptesObsRegionsTable"]:
-        if not isfile(obs_regions_data_file_path):
-            raise ValueError('panoptesObsRegionsTable data file does not exist at path: ', str(obs_regions_data_file_path))
-    if not isfile(obs_samples_data_file_path):
-        raise ValueError('panoptesObsSamplesTable data file does not exist at path: ', str(obs_samples_data_file_path))
-    if not isfile(obs_countries_data_file_path):
-        raise ValueError('panoptesObsCountriesTable data file does not exist at path: ', str(obs_countries_data_file_path))
+        if not store.exists(settings["panoptesObsRegionsTable"]):
+            raise ValueError('panoptesObsRegionsTable datatable does not exist at path: ', store.path(settings["panoptesObsRegionsTable"]))
+    if not store.exists(settings["panoptesObsSamplesTable"]) and not rebuild_samples:
+        raise ValueError('panoptesObsSamplesTable datatable does not exist at path: ', store.path(settings["panoptesObsSamplesTable"]))
+    if not store.exists(settings["panoptesObsCountriesTable"]):
+        raise ValueError('panoptesObsCountriesTable datatable does not exist at path: ', store.path(settings["panoptesObsCountriesTable"]))
 
 
     #####################################################################
-    ### Modify the studies table to make studies with a "webStudy" masquerade as that study
-
-    with open(obs_samples_data_file_path, 'r') as data_file:
-        samples = list(csv.DictReader(data_file, delimiter=csv_value_separator))
-    sample_columns = samples[0].keys()
-    study_column = settings["panoptesObsSamplesTableStudyField"]
-    with open(obs_samples_data_file_path, 'w') as data_file:
-        writer = csv.DictWriter(data_file, sample_columns, delimiter=csv_value_separator, lineterminator=csv_row_separator)
-        writer.writeheader()
-        for row in samples:
-            #Hack around postgres outputing bools as t/f (WTF?)
-            if 'qc_pass' in row:
-                row['qc_pass'] = 'True' if row['qc_pass'] == 't' else 'False'
-            #Rewrite web studies
-            if row[study_column] in webStudies:
-                print(row[study_column], webStudies.get(row[study_column], row[study_column]))
-                row[study_column] = webStudies[row[study_column]]
-            writer.writerow(row)
-
-    samples = pandas.read_csv(obs_samples_data_file_path, delimiter=csv_value_separator)
+    ### Post-process the samples in a single pass
+    metrics.begin('samples')
+
+    # Stream the samples exported from the Observatory once: make studies with a "webStudy" masquerade as that
+    # study, join the marker genotypes and Fws, and collect what the region GeoJSON needs.
+    if rebuild_samples:
+        region_aggregates = processSamples(store, webStudies, sanger_files['markers'], sanger_files['fws'])
+    elif rebuild_regions:
+        region_aggregates = readRegionAggregates(store)
 
    #PROVINCE AND DISTRICT NOT NEEDED FOR NOW WITH PF6 AS SITES ARE USUALLY LARGE AREAS
    # locations = pandas.read_csv(obs_locations_data_file_path, delimiter=csv_value_separator)
@@ -373,100 +333,502 @@ def run():
     #provinces.to_csv(join(datatables_path, 'provinces', 'data'), delimiter=csv_value_separator)
     #locations.to_csv(obs_locations_data_file_path, delimiter=csv_value_separator)
 
-    markers = pandas.read_csv(
-        'ftp://ngs.sanger.ac.uk/production/malaria/pfcommunityproject/Pf6/Pf_6_drug_resistance_marker_genotypes.txt',
-        delimiter='\t')
-    markers = markers.rename(columns={"Sample": "sample_id"})
-    markers = markers.set_index('sample_id')
+    if 'gene_diff' in dirty:
+        metrics.begin('gene_diff')
+        store.write_frame('gene_diff', sanger_files['gene_diff'])
 
-    fws = pandas.read_csv(
-        'ftp://ngs.sanger.ac.uk/production/malaria/pfcommunityproject/Pf6/Pf_6_fws.txt',
-        delimiter='\t'
-    )
-    fws = fws.rename(columns={"Sample": "sample_id"})
-    fws = fws.set_index('sample_id')
-
-    samples = samples.join(markers)
-    samples = samples.join(fws)
-
-    samples.to_csv(obs_samples_data_file_path, index=True, sep=csv_value_separator)
+    #####################################################################
+    ### Compute the prevalence datatables from the samples
+    metrics.begin('prevalence')
 
-    gene_diff = pandas.read_csv('ftp://ngs.sanger.ac.uk/production/malaria/pfcommunityproject/Pf6/Pf_6_genes_data.txt',
-                delimiter='\t')
-    if not isdir(join(datatables_path, 'gene_diff')):
-        os.mkdir(join(datatables_path, 'gene_diff'))
-    gene_diff.to_csv(join(datatables_path, 'gene_diff', 'data'), sep=csv_value_separator)
+    prevalence_datatables = [datatable for datatable in settings["prevalenceDatatables"] if datatable in dirty]
+    if len(prevalence_datatables) > 0:
+        samples = store.read_frame(settings["panoptesObsSamplesTable"])
+        for datatable in prevalence_datatables:
+            store.write_frame(datatable, prevalence.prevalence(samples, settings["prevalenceDatatables"][datatable]))
 
     #####################################################################
     ### Generate the region GeoJSON
+    metrics.begin('regions')
 
-    if settings["panoptesObsRegionsTable"]:
-        # Collect all of the distinct countries for each distinct region appearing in the obs_samples data.
-        countries_by_region = {}
-        sample_points = set()
-        obs_samples_data_file_reader = csv.DictReader(open(obs_samples_data_file_path, 'r'), delimiter=csv_value_separator, lineterminator=csv_row_separator)
-        i = 0
-        countries = {}
-        for row in obs_samples_data_file_reader:
-            i += 1
-            if settings["panoptesObsSamplesTableRegionField"] in row and settings["panoptesObsSamplesTableCountryField"] in row:
-                region_id = row[settings["panoptesObsSamplesTableRegionField"]]
-                country_id = row[settings["panoptesObsSamplesTableCountryField"]]
-                countries.setdefault(country_id, {}).setdefault(region_id, 0)
-                countries[country_id][region_id] += 1
-                sample_points.add((float(row[settings["panoptesObsSamplesTableLngField"]]), float(row[settings["panoptesObsSamplesTableLatField"]])))
-                if region_id in countries_by_region:
-                    countries_by_region[region_id].add(country_id)
-                else:
-                    countries_by_region[region_id] = {country_id}
-            else:
-                raise ValueError('panoptesObsSamplesTableRegionField and panoptesObsSamplesTableCountryField are not in data at line: ', str(i))
-
-        #If a country is in more than one region then just keep it in the modal region
-        for country, region_counts in countries.items():
-            bad_regions = sorted(region_counts.keys(),key=lambda r: region_counts[r])[:-1]
-            for region in bad_regions:
-                countries_by_region[region].remove(country)
+    if rebuild_regions:
+        countries_by_region = region_aggregates.countries_by_region()
+        # Index the sample points once, for finding the polygons of every region that contain samples.
+        sample_point_index = geometry.PointIndex(region_aggregates.sample_points)
 
         # Combine all of the GeoJSON for every country in each region.
-        geojson_by_region = {}
+        country_shapes = geometry.CountryShapes(geoJSON_for_country)
+        country_ids_by_region = {}
         for region_id in countries_by_region:
-            region_shape = None
+            country_ids_by_region[region_id] = []
             for country_id in countries_by_region[region_id].union(settings["panoptesObsRegionsAdditionalCountries"].get(region_id, [])):
-                if geoJSON_for_country[country_id] is None or geoJSON_for_country[country_id] == '':
+                if not country_shapes.has_shape(country_id):
                     print('Ignoring ' + country_id + ' for polygon as no data')
                     continue
-                new_region = shapely.geometry.asShape(geoJSON_for_country[country_id]['geometry'])
-                if region_shape is None:
-                    region_shape = new_region
-                else:
-                    region_shape = region_shape.union(new_region)
+                country_ids_by_region[region_id].append(country_id)
+        metrics.begin('regions:outlines')
+        region_shapes = geometry.region_outlines(country_ids_by_region, country_shapes, Cache(settings["geometryCachePath"]), int(settings["geometryProcesses"]))
+
+        metrics.begin('regions:filter and write')
+        geojson_by_region = {}
+        for region_id, region_shape in region_shapes.items():
             if region_shape is not None:
-                region_shape = region_shape.buffer(0.001, join_style=JOIN_STYLE.mitre).buffer(-0.001, join_style=JOIN_STYLE.mitre).simplify(0.1)
                 #Filter the polygons in the shape that don't have samples in (ie islands without samples)
-                region_shape = shapely.ops.cascaded_union([poly for poly in region_shape if any(poly.contains(Point(lng, lat)) for (lng, lat) in sample_points)])
+                region_shape = geometry.polygons_containing_points(region_shape, sample_point_index)
             geojson_by_region[region_id] = geojson.Feature(geometry=region_shape, properties={})
 
-        # Add the geojson to the region data file. (We have to write to a temporary file first.)
-        with open(obs_regions_data_file_path, 'r') as obs_regions_data_in, open(obs_regions_data_file_path + '.tmp', 'w') as obs_regions_data_out:
-            obs_regions_data_file_reader = csv.DictReader(obs_regions_data_in, delimiter=csv_value_separator, lineterminator=csv_row_separator)
-            obs_regions_data_file_fieldnames = obs_regions_data_file_reader.fieldnames + [settings["panoptesObsRegionsTableGeoJsonField"]]
-            obs_regions_data_file_writer = csv.DictWriter(obs_regions_data_out, fieldnames=obs_regions_data_file_fieldnames, delimiter=csv_value_separator, lineterminator=csv_row_separator, quoting=csv.QUOTE_NONE, escapechar="\\", quotechar="'")
-            obs_regions_data_file_writer.writeheader()
-            for obs_regions_data_file_line in obs_regions_data_file_reader:
-                region_id = obs_regions_data_file_line[settings["panoptesObsRegionsTableRegionField"]]
-                obs_regions_data_file_line['geojson'] = geojson_by_region[region_id]
-                obs_regions_data_file_writer.writerow(obs_regions_data_file_line)
+        # Add the geojson to the region datatable.
+        (obs_regions_columns, obs_regions_rows) = store.reader(settings["panoptesObsRegionsTable"])
+        obs_regions_rows = list(obs_regions_rows)
+        region_index = obs_regions_columns.index(settings["panoptesObsRegionsTableRegionField"])
+        with store.writer(settings["panoptesObsRegionsTable"], obs_regions_columns + [settings["panoptesObsRegionsTableGeoJsonField"]], quoting=csv.QUOTE_NONE, escapechar="\\", quotechar="'") as obs_regions_writer:
+            for obs_regions_row in obs_regions_rows:
+                obs_regions_writer.writerow(obs_regions_row + [str(geojson_by_region[obs_regions_row[region_index]])])
 
-        # Overwrite the original data file.
-        os.rename(obs_regions_data_file_path + '.tmp', obs_regions_data_file_path)
+    #####################################################################
+    ### Generate the TopoJSON of the countries and regions at each zoom level
+    metrics.begin('topology')
+
+    topology_datatables = [
+        (settings["panoptesObsCountriesTopologyTable"], settings["panoptesObsCountriesTable"], settings["panoptesObsCountriesTableCountryField"], settings["panoptesObsCountriesTableGeoJsonField"]),
+        (settings["panoptesObsRegionsTopologyTable"], settings["panoptesObsRegionsTable"], settings["panoptesObsRegionsTableRegionField"], settings["panoptesObsRegionsTableGeoJsonField"])
+    ]
+    for (topology_datatable, datatable, id_field, geojson_field) in topology_datatables:
+        if topology_datatable in dirty:
+            with metrics.stage('topology:' + topology_datatable):
+                writeTopologyLevels(store, topology_datatable, datatable, id_field, geojson_field)
+
+    #####################################################################
+    ### Record what the rebuilt datatables were built from
+    metrics.begin('manifest')
+
+    for datatable in dirty:
+        manifest.record(datatable, datatableMarkers(datatable))
+    manifest.save()
+
+    # The TSV files for loading into Postgres, if the datatables are kept as Arrow files.
+    if export_tsv:
+        store.export_tsv(sources_by_datatable.keys())
 
 ###################### Functions
 
 
-def fetchLdapPeople(ldapServer, ldapUserDN, ldapUserPass, ldapPeopleBaseDN, ldapPeopleFilterString, ldapPeopleFields):
+def runFetchStage(fetches, max_workers, stage):
+    # Run each fetch as a task in a thread pool, returning their results keyed by source name.
+    # If any fetch fails those not yet started are cancelled and an error naming the source is raised. Those
+    # already running can't be stopped, so aren't waited for, but each connection and request they make has the
+    # fetchTimeout, so they end soon after without keeping the process from exiting for long.
+    # Each fetch is measured as the stage "<stage>:<source>".
+    def measured(source, fetch):
+        with metrics.stage(stage + ':' + source):
+            return fetch()
+
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = OrderedDict((executor.submit(measured, source, fetch), source) for source, fetch in fetches.items())
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                results[source] = future.result()
+            except Exception as e:
+                for pending in futures:
+                    pending.cancel()
+                raise ValueError('Fetch failed for source: ' + source + ': ' + str(e)) from e
+            print("Fetched from " + source)
+    finally:
+        if sys.version_info >= (3, 9):
+            executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            executor.shutdown(wait=False)
+    return results
+
+
+def observatoryConnectionParams():
+    # http://initd.org/psycopg/docs/module.html#psycopg2.connect
+    return dict(
+        host = settings["observatoryDbServerHost"],
+        port = str(settings["observatoryDbServerPort"]),
+        sslmode = settings["observatoryDbServerSSL"],
+        database = settings["observatoryDbServerDatabase"],
+        user = settings["observatoryDbServerUser"],
+        password = settings["observatoryDbServerPass"],
+        connect_timeout = int(float(settings["fetchTimeout"])),
+        options = '-c statement_timeout=' + str(int(float(settings["fetchTimeout"]) * 1000))
+    )
+
+
+def fetchObservatory(store, observatoryDbViews, fetch_country_geojson):
+
+    # Try to connect to the database,
+    # http://initd.org/psycopg/docs/
+    conn = psycopg2.connect(**observatoryConnectionParams())
+    # Everything read from the Observatory is read inside this one transaction's snapshot, which is exported
+    # so that the pooled connections exporting the views see exactly the same data.
+    # https://www.postgresql.org/docs/9.5/static/functions-admin.html#FUNCTIONS-SNAPSHOT-SYNCHRONIZATION
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = conn.cursor()
+    cur.execute("SELECT pg_export_snapshot()")
+    snapshot_id = cur.fetchone()[0]
+
+    # Get the authoritative list of studies from the Observatory.
+    study_list_query = "SELECT \"" + settings["observatoryDbStudyField"] + "\" FROM \"" + settings["observatoryDbServerDbSchema"] + "\".\"" + settings["observatoryDbStudiesView"] + "\""
+    cur.execute(study_list_query)
+    obsStudies = [row[0] for row in cur.fetchall()]
+
+    if len(obsStudies) == 0:
+        raise ValueError('observatoryDbStudiesView returned zero obsStudies')
+
+    datatable_for_view = dict(zip(settings["observatoryDbViews"], settings["panoptesObsTables"]))
+    exportObservatoryViews(
+        snapshot_id,
+        OrderedDict((observatoryDbView, datatable_for_view[observatoryDbView]) for observatoryDbView in observatoryDbViews),
+        store,
+        int(settings["observatoryDbExportConnections"])
+    )
+
+    #Get all countries JSON polygons
+    geoJSON_for_country = None
+    if fetch_country_geojson:
+        geoJSON_for_country = {}
+        query = 'SELECT "'+settings["panoptesObsCountriesTableCountryField"] + '","' + settings["panoptesObsCountriesTableGeoJsonField"] + \
+                '" FROM "'+ settings["observatoryDbServerDbSchema"] + '"."' + settings["panoptesObsCountriesTable"] + '"'
+        cur.execute(query)
+        result = cur.fetchall()
+        for (country_id, geoJSON) in result:
+            geoJSON_for_country[country_id] = geoJSON
+
+
+    # Close the db cursor and connection. This ends the transaction, and so the exported snapshot.
+    cur.close()
+    conn.rollback()
+    conn.close()
+
+    return obsStudies, geoJSON_for_country
+
+
+def exportObservatoryViews(snapshot_id, datatables_by_view, store, max_connections):
+    # COPY each view into its datatable's staging file, in parallel over a pool of connections that
+    # all import the snapshot exported by the caller, so the views are consistent with each other.
+    # The caller's transaction must stay open until this returns.
+    # http://initd.org/psycopg/docs/pool.html
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_connections, **observatoryConnectionParams())
+
+    def exportView(observatoryDbView, datatable):
+        data_file_path = store.staging_path(datatable)
+
+        conn = pool.getconn()
+        try:
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            cur = conn.cursor()
+            # SET TRANSACTION SNAPSHOT has to be the first statement of the transaction.
+            cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+
+            # Open the data file for writing.
+            with open(data_file_path, 'w') as data_file:
+                # http://initd.org/psycopg/docs/cursor.html#cursor.copy_expert
+                ## Mogrify throws a syntax error when I try to interpolate the params.
+                # http://initd.org/psycopg/docs/cursor.html#cursor.mogrify
+                # https://www.postgresql.org/docs/9.5/static/sql-copy.html
+                ## Such queries can be checked first using the psql CLI, e.g.
+                # COPY (SELECT * FROM observatory."Samples with types") TO STDOUT (FORMAT csv, HEADER TRUE, DELIMITER E'\t');
+                copy_data_query = "COPY (SELECT * FROM \"" + settings["observatoryDbServerDbSchema"] + "\".\"" + observatoryDbView + "\") TO STDOUT (FORMAT csv, HEADER TRUE, DELIMITER E'\t', QUOTE E'\b', ESCAPE E'\b', NULL '')"''
+                with metrics.stage('fetch:Observatory db server:' + observatoryDbView):
+                    cur.copy_expert(copy_data_query, data_file)
+                    metrics.add('rows_in', cur.rowcount)
+                    metrics.add('network_bytes', data_file.tell())
+
+            cur.close()
+            conn.rollback()
+        finally:
+            pool.putconn(conn)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            futures = {executor.submit(exportView, view, datatable): view for view, datatable in datatables_by_view.items()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    raise ValueError('Failed to export observatoryDbView: ' + futures[future] + ': ' + str(e)) from e
+    finally:
+        pool.closeall()
+
+
+def fetchAlfrescoStudies():
+    response = requests.get(settings["alfrescoStudiesURL"], auth=(settings["alfrescoUserId"], settings["alfrescoUserPass"]), timeout=float(settings["fetchTimeout"]))
+    metrics.add('network_bytes', len(response.content))
+    return parseAlfrescoStudies(response.json())
+
+
+def parseAlfrescoStudies(data):
+    alfStudies = data["collaborationNodes"]
+
+    if len(alfStudies) == 0:
+        raise ValueError('fetchAlfrescoStudies returned zero collaborationNodes')
+
+    # Collect the studies by name, to facilitate a subsequent parse.
+    studiesByName = {}
+    for study in alfStudies:
+      if study["name"] not in studiesByName:
+        studiesByName[study["name"]] = study
+      else:
+        raise ValueError('Duplicate study name: ', str(study['name']))
+
+    return alfStudies
+
+
+def authorizeGSheets():
+    return establishGSheetsCredentials(
+        settings["gsheetsClientSecretPath"],
+        settings["gsheetsCredentialsPath"],
+        settings["gsheetsAuthHost"],
+        settings["gsheetsAuthPort"]
+    ).authorize(httplib2.Http(timeout=float(settings["fetchTimeout"])))
+
+
+def fetchGSheets(gsheets, gsheetsId_indexes, source_markers):
+    # The rows for each of the given indexes into settings["gsheetsIds"], with the ranges of each spreadsheet
+    # fetched together, for the version of the spreadsheet that was probed.
+    ranges_by_gsheet_id = OrderedDict()
+    for gsheetsId_index in gsheetsId_indexes:
+        ranges_by_gsheet_id.setdefault(settings["gsheetsIds"][gsheetsId_index], []).append(gsheetsId_index)
+
+    gsheets_rows = {}
+    for gsheet_id, indexes in ranges_by_gsheet_id.items():
+        values = gsheets.values(gsheet_id, [settings["gsheetsRanges"][index] for index in indexes], source_markers['gsheets:' + gsheet_id])
+        gsheets_rows.update(zip(indexes, values))
+
+    return gsheets_rows
+
+
+def fetchSangerFiles(fetch_cache, names):
+    # Read the given files out of settings["sangerFtpFiles"], keyed by name, through the local fetch_cache.
+    # The per-sample files are indexed by sample for joining onto the samples, see indexSamplesFile.
+    sanger_files = {}
+    for name in names:
+        path = fetch_cache.path(settings["sangerFtpFiles"][name])
+        if name in ['markers', 'fws']:
+            sanger_files[name] = indexSamplesFile(pandas.read_csv(path, delimiter='\t', dtype=str, keep_default_na=False))
+        else:
+            sanger_files[name] = pandas.read_csv(path, delimiter='\t')
+
+    return sanger_files
+
+
+def indexSamplesFile(sample_file):
+    # Returns the columns other than "Sample", and a dict of each sample's values for them. The values are kept
+    # as the strings in the file, so they are written out exactly as they were read.
+    columns = [column for column in sample_file.columns if column != "Sample"]
+    return columns, {sample_id: values for sample_id, values in zip(sample_file["Sample"], sample_file[columns].itertuples(index=False, name=None))}
+
+
+class RegionAggregates:
+    # The distinct countries for each distinct region appearing in the samples, and the distinct sample points,
+    # collected a sample at a time.
+
+    def __init__(self):
+        self.region_counts_by_country = {}
+        self.sample_points = set()
+
+    def add(self, region_id, country_id, lng, lat):
+        region_counts = self.region_counts_by_country.setdefault(country_id, {})
+        region_counts[region_id] = region_counts.get(region_id, 0) + 1
+        self.sample_points.add((float(lng), float(lat)))
+
+    def countries_by_region(self):
+        #If a country is in more than one region then just keep it in the modal region
+        countries_by_region = {}
+        for country_id, region_counts in self.region_counts_by_country.items():
+            for region_id in region_counts:
+                countries_by_region.setdefault(region_id, set())
+            modal_region_id = sorted(region_counts.keys(), key=lambda r: region_counts[r])[-1]
+            countries_by_region[modal_region_id].add(country_id)
+        return countries_by_region
+
+
+def regionAggregatesColumns(columns):
+    region_field = settings["panoptesObsSamplesTableRegionField"]
+    country_field = settings["panoptesObsSamplesTableCountryField"]
+    if region_field not in columns or country_field not in columns:
+        raise ValueError('panoptesObsSamplesTableRegionField and panoptesObsSamplesTableCountryField are not in data: ', str(columns))
+    return [columns.index(field) for field in [region_field, country_field, settings["panoptesObsSamplesTableLngField"], settings["panoptesObsSamplesTableLatField"]]]
+
+
+def processSamples(store, webStudies, markers, fws):
+    # Read the samples as exported by COPY, and write them into the store once with the studies with a "webStudy"
+    # masquerading as that study and the columns of the marker genotypes and Fws joined on by sample.
+    # Returns the RegionAggregates of the samples.
+    (marker_columns, markers_by_sample) = markers
+    (fws_columns, fws_by_sample) = fws
+    missing_markers = ('',) * len(marker_columns)
+    missing_fws = ('',) * len(fws_columns)
+    region_aggregates = RegionAggregates()
+
+    data_file_path = store.staging_path(settings["panoptesObsSamplesTable"])
+    with open(data_file_path, 'r') as data_in:
+        # COPY doesn't quote its output (see copy_data_query), so neither should the reader.
+        reader = csv.reader(data_in, delimiter=csv_value_separator, quoting=csv.QUOTE_NONE)
+        columns = next(reader)
+
+        sample_index = columns.index("sample_id")
+        study_index = columns.index(settings["panoptesObsSamplesTableStudyField"])
+        (region_index, country_index, lng_index, lat_index) = regionAggregatesColumns(columns)
+
+        with store.writer(settings["panoptesObsSamplesTable"], columns + marker_columns + fws_columns) as writer:
+            for row in reader:
+                #Rewrite web studies
+                if row[study_index] in webStudies:
+                    print(row[study_index], webStudies[row[study_index]])
+                    row[study_index] = webStudies[row[study_index]]
+                region_aggregates.add(row[region_index], row[country_index], row[lng_index], row[lat_index])
+                sample_id = row[sample_index]
+                writer.writerow(row + list(markers_by_sample.get(sample_id, missing_markers)) + list(fws_by_sample.get(sample_id, missing_fws)))
+
+    os.remove(data_file_path)
+    return region_aggregates
+
+
+def readRegionAggregates(store):
+    # The RegionAggregates of samples already processed by a previous run.
+    region_aggregates = RegionAggregates()
+    (columns, rows) = store.reader(settings["panoptesObsSamplesTable"])
+    (region_index, country_index, lng_index, lat_index) = regionAggregatesColumns(columns)
+    for row in rows:
+        region_aggregates.add(row[region_index], row[country_index], row[lng_index], row[lat_index])
+    return region_aggregates
+
+
+def writeTopologyLevels(store, topology_datatable, datatable, id_field, geojson_field):
+    # The shapes in the datatable's GeoJSON column as a TopoJSON topology at each of the geometryLevels, so the site
+    # can fetch the one for its zoom level rather than every shape at full detail. The topology is built once, at
+    # the finest quantization, and each level made from it.
+    (columns, rows) = store.reader(datatable)
+    (id_index, geojson_index) = (columns.index(id_field), columns.index(geojson_field))
+    geometries = OrderedDict()
+    for row in rows:
+        shape = json.loads(row[geojson_index]) if row[geojson_index] != '' else None
+        geometries[row[id_index]] = shape['geometry'] if shape is not None and shape['type'] == 'Feature' else shape
+
+    levels = sorted(settings["geometryLevels"].items(), key=lambda level: int(level[0]))
+    shapes = topology.Topology(geometries, max(int(level['quantization']) for (zoom, level) in levels))
+    with store.writer(topology_datatable, ['zoom', 'tolerance', 'quantization', 'topojson']) as writer:
+        for (zoom, level) in levels:
+            writer.writerow([zoom, level['tolerance'], level['quantization'], shapes.level(datatable, level['tolerance'], level['quantization'])])
+
+
+def datatableSources():
+    # The sources each datatable is built from, as keys into the markers returned by the probes below.
+    sources = OrderedDict()
+    datatable_for_view = OrderedDict(zip(settings["observatoryDbViews"], settings["panoptesObsTables"]))
+    view_for_datatable = dict(zip(settings["panoptesObsTables"], settings["observatoryDbViews"]))
+    for observatoryDbView, datatable in datatable_for_view.items():
+        sources[datatable] = ['observatory:' + observatoryDbView]
+    for gsheet_id, datatable in zip(settings["gsheetsIds"], settings["panoptesGsheetsTables"]):
+        sources.setdefault(datatable, []).append('gsheets:' + gsheet_id)
+        if datatable in datatable_for_view.values():
+            sources[datatable].append('settings:gsheetsMerge')
+    for datatable in [settings["panoptesAlfStudiesTable"], settings["panoptesAlfStudyPublicationsTable"], settings["panoptesAlfStudyLdapPeopleTable"]]:
+        sources[datatable] = ['observatory:' + settings["observatoryDbStudiesView"], 'alfresco', 'ldap']
+    # And the fields of each that are written.
+    sources[settings["panoptesAlfStudiesTable"]].append('settings:alfrescoStudiesFields')
+    sources[settings["panoptesAlfStudyPublicationsTable"]].append('settings:alfrescoStudyPublicationsFields')
+    sources[settings["panoptesAlfStudyLdapPeopleTable"]] += ['settings:ldapPeopleFields', 'settings:panoptesAlfStudyLdapPeopleFields', 'settings:panoptesAlfStudyLdapPeopleGroups']
+    sources[settings["panoptesObsSamplesTable"]] += ['observatory:' + settings["observatoryDbStudiesView"], 'alfresco', 'sanger:markers', 'sanger:fws']
+    if settings["panoptesObsRegionsTable"]:
+        sources[settings["panoptesObsRegionsTable"]] += [
+            'observatory:' + view_for_datatable[settings["panoptesObsSamplesTable"]],
+            'observatory:' + settings["panoptesObsCountriesTable"],
+            'settings:panoptesObsRegionsAdditionalCountries'
+        ]
+    sources[settings["panoptesObsCountriesTopologyTable"]] = sources[settings["panoptesObsCountriesTable"]] + ['settings:geometryLevels']
+    if settings["panoptesObsRegionsTable"]:
+        sources[settings["panoptesObsRegionsTopologyTable"]] = sources[settings["panoptesObsRegionsTable"]] + ['settings:geometryLevels']
+    sources['gene_diff'] = ['sanger:gene_diff']
+    for datatable in settings["prevalenceDatatables"]:
+        sources[datatable] = sources[settings["panoptesObsSamplesTable"]] + ['settings:prevalenceDatatables']
+    return sources
+
+
+def settingMarker(name):
+    return hashlib.sha1(json.dumps(settings[name], sort_keys=True).encode()).hexdigest()
+
+
+def probeObservatory():
+    # A row count and checksum of every view, the studies view and the table holding the country GeoJSON.
+    conn = psycopg2.connect(**observatoryConnectionParams())
+    cur = conn.cursor()
+    markers = {}
+    for relation in settings["observatoryDbViews"] + [settings["observatoryDbStudiesView"], settings["panoptesObsCountriesTable"]]:
+        cur.execute("SELECT count(*), md5(string_agg(md5(t::text), '' ORDER BY md5(t::text))) FROM \"" + settings["observatoryDbServerDbSchema"] + "\".\"" + relation + "\" t")
+        (count, checksum) = cur.fetchone()
+        markers['observatory:' + relation] = str(count) + ':' + str(checksum)
+    cur.close()
+    conn.close()
+    return markers
+
+
+def probeAlfrescoStudies(etag):
+    # Returns the marker for the Alfresco studies and, as the GET is conditional on the last ETag, the studies
+    # themselves only if they have changed. Without an ETag from the server the marker is a hash of the content.
+    headers = {'If-None-Match': etag} if etag else {}
+    response = requests.get(settings["alfrescoStudiesURL"], auth=(settings["alfrescoUserId"], settings["alfrescoUserPass"]), headers=headers,
+                            timeout=float(settings["fetchTimeout"]))
+    if response.status_code == 304:
+        return etag, None
+    response.raise_for_status()
+    metrics.add('network_bytes', len(response.content))
+    marker = response.headers.get('ETag') or hashlib.sha1(response.content).hexdigest()
+    return marker, parseAlfrescoStudies(response.json())
+
+
+def probeLdapPeople(previous_marker):
+    # The latest modifyTimestamp of anyone, which is all that is transferred. Once there is one, only the people
+    # modified since are searched for, a page at a time. (A person removed from LDAP doesn't change it, but the
+    # people fetched are those in the studies' groups, so removing them from a study changes the Alfresco marker.)
+    filterString = settings["ldapPeopleFilterString"]
+    # (The markers of earlier runs were hashes rather than LDAP GeneralizedTimes, which end in Z.)
+    if previous_marker is not None and not previous_marker.endswith('Z'):
+        previous_marker = None
+    if previous_marker:
+        filterString = '(&' + filterString + '(modifyTimestamp>=' + escape_filter_chars(previous_marker) + '))'
+    ldapConnection = connectLdap(settings["ldapServerURL"], settings["ldapUserDN"], settings["ldapUserPass"])
+    searchResults = searchLdapPaged(ldapConnection, settings["ldapPeopleBaseDN"], filterString, ['modifyTimestamp'], int(settings["ldapPageSize"]))
+    ldapConnection.unbind()
+    modifyTimestamps = [str(ldapEntry['modifyTimestamp'][0], "utf-8") for dn, ldapEntry in searchResults if 'modifyTimestamp' in ldapEntry]
+    return max(modifyTimestamps + ([previous_marker] if previous_marker else []), default='')
+
+
+def probeGSheets(gsheets):
+    # The Drive version of each spreadsheet, which increases whenever the spreadsheet is edited.
+    return {'gsheets:' + gsheet_id: gsheets.version(gsheet_id) for gsheet_id in set(settings["gsheetsIds"])}
+
+
+def probeSangerFiles(fetch_cache):
+    return {'sanger:' + name: fetch_cache.remote_marker(url) for name, url in settings["sangerFtpFiles"].items()}
+
+
+def getWebStudies(alfStudies, obsStudies):
+    # Studies with a "webStudy" masquerade as that study. The web studies are appended to obsStudies.
+    webStudies = {}
+    for study in alfStudies:
+        if study['name'] not in obsStudies:
+            continue
+        if "webStudy" in study:
+            webStudies[study['name']] = study['webStudy']['name']
+            print("appending", study['webStudy']['name'])
+            if study['webStudy']['name'] not in obsStudies:
+                obsStudies.append(study['webStudy']['name'])
+    return webStudies
+
+
+def connectLdap(ldapServer, ldapUserDN, ldapUserPass):
 
     ldapConnection = ldap.initialize(ldapServer)
+    # The timeouts of connecting, and of waiting for the results of each operation.
+    ldapConnection.set_option(ldap.OPT_NETWORK_TIMEOUT, float(settings["fetchTimeout"]))
+    ldapConnection.set_option(ldap.OPT_TIMEOUT, float(settings["fetchTimeout"]))
+    ldapConnection.timeout = float(settings["fetchTimeout"])
 
     try:
         ldapConnection.bind_s(ldapUserDN, ldapUserPass)
@@ -478,30 +840,93 @@ def fetchLdapPeople(ldapServer, ldapUserDN, ldapUserPass, ldapPeopleBaseDN, ldap
         else:
             print(str(e))
 
-    searchResults = ldapConnection.search_s(
-        ldapPeopleBaseDN
-        , ldap.SCOPE_SUBTREE
-        , ldapPeopleFilterString
-        , [str(x) for x in ldapPeopleFields]
-    )
-
-    ldapPeople = {}
-
-    for dn, ldapEntry in searchResults:
-      if 'malariagenUID' not in ldapEntry:
-          print(("No malariagenUID in DN: ", dn, ", ldapEntry: ", str(ldapEntry)))
-          continue
-
+    return ldapConnection
+
+
+def getAlfStudiesMalariagenUIDs(alfStudies, panoptesAlfStudyLdapPeopleGroups):
+    # The malariagenUIDs of everyone in the groups of the studies.
+    return sorted(set(study_person['malariagenUID'] for alfStudy in alfStudies
+                      for group_type in panoptesAlfStudyLdapPeopleGroups
+                      for study_person in alfStudy["group" + group_type]))
+
+
+def searchLdapPeople(ldapConnection, ldapPeopleBaseDN, ldapPeopleFilterString, malariagenUIDs, attributes, ldapPageSize):
+    # Search for the people with the malariagenUIDs, a page of UIDs per search. The searches are all sent before
+    # any results are read, so the server works through them together, and each is paged with the Simple Paged
+    # Results control.
+    searches = deque()
+    for i in range(0, len(malariagenUIDs), ldapPageSize):
+        filterString = '(&' + ldapPeopleFilterString + '(|' + ''.join(
+            '(malariagenUID=' + escape_filter_chars(malariagenUID) + ')' for malariagenUID in malariagenUIDs[i:i + ldapPageSize]) + '))'
+        pageControl = SimplePagedResultsControl(True, size=ldapPageSize, cookie='')
+        searches.append((ldapConnection.search_ext(ldapPeopleBaseDN, ldap.SCOPE_SUBTREE, filterString, attributes, serverctrls=[pageControl]), filterString, pageControl))
+
+    searchResults = []
+    while len(searches) > 0:
+        (msgid, filterString, pageControl) = searches.popleft()
+        (resultType, resultData, resultMsgid, serverControls) = ldapConnection.result3(msgid)
+        searchResults += resultData
+        cookies = [control.cookie for control in serverControls if control.controlType == SimplePagedResultsControl.controlType]
+        if len(cookies) > 0 and cookies[0]:
+            pageControl.cookie = cookies[0]
+            searches.append((ldapConnection.search_ext(ldapPeopleBaseDN, ldap.SCOPE_SUBTREE, filterString, attributes, serverctrls=[pageControl]), filterString, pageControl))
+    return searchResults
+
+
+def searchLdapPaged(ldapConnection, baseDN, filterString, attributes, ldapPageSize):
+    # Search with the Simple Paged Results control, ldapPageSize entries at a time.
+    pageControl = SimplePagedResultsControl(True, size=ldapPageSize, cookie='')
+    searchResults = []
+    while True:
+        msgid = ldapConnection.search_ext(baseDN, ldap.SCOPE_SUBTREE, filterString, attributes, serverctrls=[pageControl])
+        (resultType, resultData, resultMsgid, serverControls) = ldapConnection.result3(msgid)
+        searchResults += resultData
+        cookies = [control.cookie for control in serverControls if control.controlType == SimplePagedResultsControl.controlType]
+        if len(cookies) == 0 or not cookies[0]:
+            return searchResults
+        pageControl.cookie = cookies[0]
+
+
+def fetchLdapPeople(ldapServer, ldapUserDN, ldapUserPass, ldapPeopleBaseDN, ldapPeopleFilterString, ldapPeopleFields, malariagenUIDs, ldapCache, ldapPageSize):
+    # The people with the malariagenUIDs, by malariagenUID. Each person is kept in the ldapCache with their
+    # modifyTimestamp and the fields fetched, so only the people modified since they were cached, or cached with
+    # other ldapPeopleFields, are fetched in full.
+
+    ldapConnection = connectLdap(ldapServer, ldapUserDN, ldapUserPass)
+
+    # Each field once, in order.
+    ldapPeopleFields = list(OrderedDict.fromkeys(ldapPeopleFields))
+
+    modifyTimestamps = {}
+    for dn, ldapEntry in searchLdapPeople(ldapConnection, ldapPeopleBaseDN, ldapPeopleFilterString, malariagenUIDs, ['malariagenUID', 'modifyTimestamp'], ldapPageSize):
+        modifyTimestamps[str(ldapEntry['malariagenUID'][0], "utf-8")] = ldapEntry.get('modifyTimestamp', [b''])[0]
+
+    # (Entries cached before the fields were kept with them have only the modifyTimestamp and person.)
+    modifiedUIDs = [malariagenUID for malariagenUID, modifyTimestamp in modifyTimestamps.items()
+                    if tuple(ldapCache.get(malariagenUID, ())[:2]) != (modifyTimestamp, ldapPeopleFields)]
+    metrics.add('cache_hits', len(modifyTimestamps) - len(modifiedUIDs))
+    metrics.add('cache_misses', len(modifiedUIDs))
+    if len(modifiedUIDs) > 0:
+        print('Fetching ' + str(len(modifiedUIDs)) + ' of ' + str(len(modifyTimestamps)) + ' people from LDAP')
+
+    for dn, ldapEntry in searchLdapPeople(ldapConnection, ldapPeopleBaseDN, ldapPeopleFilterString, modifiedUIDs, ldapPeopleFields + ['modifyTimestamp'], ldapPageSize):
       malariagenUID = str(ldapEntry['malariagenUID'][0],"utf-8")
-      ldapPeople[malariagenUID] = {'dn': dn}
+      person = {'dn': dn}
 
       for ldapPeopleField in ldapPeopleFields:
           if ldapPeopleField in ldapEntry:
-              ldapPeople[malariagenUID][ldapPeopleField] = str(ldapEntry[ldapPeopleField][0],"utf-8")
+              person[ldapPeopleField] = str(ldapEntry[ldapPeopleField][0],"utf-8")
 
+      ldapCache[malariagenUID] = (ldapEntry.get('modifyTimestamp', [b''])[0], ldapPeopleFields, person)
 
     ldapConnection.unbind()
 
+    ldapPeople = {}
+    for malariagenUID in modifyTimestamps:
+        cached = ldapCache.get(malariagenUID)
+        if cached is not None:
+            ldapPeople[malariagenUID] = cached[-1]
+
     return ldapPeople
 
 
@@ -510,42 +935,44 @@ def getStudyNumber(study_name, csv_value_separator):
 
 
 def getAlfStudyLdapPeople(ldapPeople, alfStudy, panoptesAlfStudyLdapPeopleGroups):
-
-    study_people = {}
-    alfStudyLdapPeople = []
+    # The LDAP people in the study's groups, each a copy of their LDAP entry with the 'class' of groups they are in,
+    # so the classes of one study don't end up on the people of another.
+    study_people = OrderedDict()
 
     for group_type in panoptesAlfStudyLdapPeopleGroups:
         group = alfStudy["group" + group_type]
         for study_person in group:
             malariagenUID = study_person['malariagenUID']
             if malariagenUID in ldapPeople:
-                person = ldapPeople[malariagenUID]
                 if malariagenUID in study_people:
-                    for p in alfStudyLdapPeople:
-                        if p['malariagenUID'] == malariagenUID:
-                            p['class'].append(group_type)
+                    study_people[malariagenUID]['class'].append(group_type)
                 else:
-                    person['class'] = [group_type]
-                    study_people[malariagenUID] = person
-                    alfStudyLdapPeople.append(person)
+                    study_people[malariagenUID] = dict(ldapPeople[malariagenUID], **{'class': [group_type]})
 
-    return alfStudyLdapPeople
+    return list(study_people.values())
 
 
-def writeRelatedRecords(records, foreign_key_value, fields, file, csv_list_separator, csv_row_separator, csv_value_separator):
-  for record in records:
-      record_values = []
-      record_values.append(foreign_key_value)
-      for record_field in fields:
-          record_field_value = ''
-          if record_field in record:
-              if isinstance(record[record_field], str):
-                  record_field_value = record[record_field]
-              elif isinstance(record[record_field], (list, tuple)):
-                  record_field_value = csv_list_separator.join(record[record_field])
-          record_values.append(record_field_value)
-      # Write the record_values to the CSV file.
-      file.write((csv_value_separator.join(record_values).replace("\n", " ").replace("\r", " ") + csv_row_separator).encode('ascii', 'xmlcharrefreplace').decode())
+def relatedRows(records, foreign_key_value, fields, csv_list_separator):
+    # The rows of related records, e.g. a study's people or publications, each starting with the foreign key.
+    rows = []
+    for record in records:
+        row = [foreign_key_value]
+        for record_field in fields:
+            value = record.get(record_field, '')
+            if isinstance(value, (list, tuple)):
+                value = csv_list_separator.join(value)
+            elif not isinstance(value, str):
+                value = ''
+            row.append(value)
+        rows.append(row)
+    return rows
+
+
+def writeRows(rows, file, csv_row_separator, csv_value_separator):
+    # Write the rows in one go, with any line breaks in values replaced by spaces and non-ASCII characters as
+    # XML character references.
+    lines = [csv_value_separator.join(row).replace("\n", " ").replace("\r", " ") + csv_row_separator for row in rows]
+    file.write(''.join(lines).encode('ascii', 'xmlcharrefreplace').decode())
 
 
 def establishGSheetsCredentials(client_secret_path, credentials_path, auth_host_name, auth_host_port):
@@ -553,8 +980,10 @@ def establishGSheetsCredentials(client_secret_path, credentials_path, auth_host_
     credentials = None
     if os.path.isfile(credentials_path):
         credentials = store.get()
-    if credentials is None or credentials.invalid:
-        flow = client.flow_from_clientsecrets(client_secret_path, 'https://www.googleapis.com/auth/spreadsheets.readonly')
+    # The Drive metadata scope is needed to probe the version of each spreadsheet.
+    scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly', 'https://www.googleapis.com/auth/drive.metadata.readonly']
+    if credentials is None or credentials.invalid or not credentials.has_scopes(scopes):
+        flow = client.flow_from_clientsecrets(client_secret_path, scopes)
         flow.user_agent = 'malobs'
         # http://oauth2client.readthedocs.io/en/latest/source/oauth2client.tools.html
         # https://docs.python.org/2/library/argparse.html
@@ -568,4 +997,22 @@ def establishGSheetsCredentials(client_secret_path, credentials_path, auth_host_
     return credentials
 
 
-run()
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the data for the merged database into output/, rebuilding only the datatables whose sources have changed.')
+    parser.add_argument('--force', action='store_true', help='Rebuild every datatable, whether or not its sources have changed.')
+    parser.add_argument('--offline', action='store_true', help='Read the Sanger FTP files from the local fetch cache only.')
+    parser.add_argument('--tsv', action='store_true', help='Write the TSV data files for loading into Postgres, when intermediateFormat is arrow.')
+    parser.add_argument('--profile', metavar='STAGE', help='Profile the named stage of the metrics report, e.g. samples or regions:outlines.')
+    parser.add_argument('--profiler', choices=['cprofile', 'pyinstrument'], default='cprofile', help='The profiler for --profile.')
+    args = parser.parse_args()
+    metrics.profile_stage = args.profile
+    metrics.profiler = args.profiler
+    metrics.profile_path = settings["metricsPath"]
+    try:
+        with metrics.stage('run'):
+            try:
+                run(force=args.force, offline=args.offline, export_tsv=args.tsv)
+            finally:
+                metrics.end()
+    finally:
+        metrics.write(settings["metricsPath"], settings["metricsPrometheusPath"])
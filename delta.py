@@ -0,0 +1,247 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import os
+import shutil
+from os.path import join, isdir, isfile
+
+import yaml
+
+import sqlschema
+# (Which also lets the csv module read the GeoJSON columns.)
+import tablestore
+from metrics import metrics
+
+with open('settings_nosecrets', 'r') as f:
+    settings = yaml.load(f, Loader=yaml.BaseLoader)
+
+with open('settings_local', 'r') as f:
+    settings = {**settings, **yaml.load(f, Loader=yaml.BaseLoader)}
+
+datatables_path = join('output')
+
+# The files of the delta package are read by COPY ... (FORMAT csv, DELIMITER E'\t', HEADER true), as in load.py.
+copy_options = "(FORMAT csv, DELIMITER E'\\t', HEADER true)"
+
+
+def run(reset=False):
+    # Compare each datatable in output/ with the previous build, as recorded by its rows' fingerprints, and write
+    # the rows inserted or updated and the primary keys of the rows deleted since then to the delta package, with
+    # apply.sql to apply them to the merged database in one transaction. The fingerprints are then replaced by the
+    # current build's. With reset, only the fingerprints are recorded, after sending a full dump instead.
+    tables = sqlschema.parse()
+    derived = sqlschema.parse_derived()
+    for table in tables.values():
+        if not isfile(dataPath(table.name)):
+            raise ValueError('Datatable to compare does not exist at path: ', dataPath(table.name))
+        if len(table.primary_key) == 0:
+            raise ValueError('A delta needs every table to have a primary key, this does not: ', table.name)
+
+    fingerprints_path = settings["deltaFingerprintsPath"]
+    delta_path = settings["deltaPath"]
+    if isdir(delta_path):
+        shutil.rmtree(delta_path)
+    os.makedirs(delta_path)
+    if isdir(fingerprints_path + '.tmp'):
+        shutil.rmtree(fingerprints_path + '.tmp')
+    os.makedirs(fingerprints_path + '.tmp')
+
+    changes = {}
+    row_counts = {}
+    data_columns = {}
+    for table in tables.values():
+        with metrics.stage('delta:' + table.name):
+            previous = None if reset else readFingerprints(fingerprints_path, table)
+            if not reset and previous is None:
+                raise ValueError('There are no fingerprints of the previous build to compare with, or its columns differ, for: ', table.name)
+            (changes[table.name], row_counts[table.name], data_columns[table.name]) = compareTable(table, previous, delta_path, fingerprints_path + '.tmp')
+        if not reset:
+            print(table.name + ': ' + ', '.join(str(count) + ' ' + change for change, count in changes[table.name].items()))
+
+    if reset:
+        shutil.rmtree(delta_path)
+    else:
+        writeApplyScript(join(delta_path, 'apply.sql'), tables, derived, changes, row_counts, data_columns)
+
+    # The fingerprints are only replaced once the delta package is complete.
+    if isdir(fingerprints_path):
+        shutil.rmtree(fingerprints_path)
+    os.replace(fingerprints_path + '.tmp', fingerprints_path)
+
+
+def dataPath(table_name):
+    return join(datatables_path, table_name, 'data')
+
+
+def quoted(names):
+    return ', '.join('"' + name + '"' for name in names)
+
+
+def fingerprint(values):
+    return hashlib.sha1('\x1f'.join(values).encode()).hexdigest()
+
+
+def readFingerprints(fingerprints_path, table):
+    # The fingerprint of each row of the table in the previous build, by primary key, or None if there are none or
+    # the table's columns have changed since, when the database has to be sent in full. The file's first line is
+    # the table's columns, then each row's primary key and fingerprint.
+    path = join(fingerprints_path, table.name)
+    if not isfile(path):
+        return None
+    with open(path, 'r') as f:
+        reader = csv.reader(f, delimiter='\t')
+        if next(reader) != list(table.columns):
+            return None
+        return {tuple(row[:-1]): row[-1] for row in reader}
+
+
+def compareTable(table, previous, delta_path, fingerprints_path):
+    # Stream the table's rows, writing the new fingerprints and, if there are previous ones, the rows that are new
+    # or have changed to <table>.upsert.gz and the primary keys of the rows that have gone to <table>.delete.gz.
+    # The previous fingerprints and the primary keys seen so far, to catch duplicates, are held in memory, but not
+    # the rows. Returns the number of each change, the number of rows and the data's columns.
+    columns = list(table.columns)
+    changes = {'inserts': 0, 'updates': 0, 'deletes': 0}
+    row_count = 0
+    upsert_path = join(delta_path, table.name + '.upsert.gz')
+    with open(dataPath(table.name), 'rb') as data_in, open(join(fingerprints_path, table.name), 'w') as fingerprints_out, \
+            (gzip.open(upsert_path, 'wb') if previous is not None else open(os.devnull, 'wb')) as upserts_out:
+        # The upserts are the data's own lines, as they are, for COPY to read them just as load.py did: parsing
+        # them and writing them out again could change values, as the csv module doesn't parse quotes as
+        # Postgres does. The reader takes a line at a time, so the lines of each row are the ones read for it.
+        row_lines = []
+
+        def lines():
+            for line in data_in:
+                row_lines.append(line)
+                yield line.decode()
+
+        reader = csv.reader(lines(), delimiter='\t')
+        # The data's columns may be in any order, the fingerprints' are in the order of schema.sql.
+        header = next(reader)
+        missing = [column for column in columns if column not in header]
+        if len(missing) > 0:
+            raise ValueError('Datatable is missing columns of ' + table.name + ' in schema.sql: ', str(missing))
+        indexes = [header.index(column) for column in columns]
+        key_indexes = [columns.index(column) for column in table.primary_key]
+        upserts_out.write(b''.join(row_lines))
+        del row_lines[:]
+
+        fingerprints_writer = csv.writer(fingerprints_out, delimiter='\t', lineterminator='\n')
+        fingerprints_writer.writerow(columns)
+        keys = set()
+        for row in reader:
+            values = [row[i] for i in indexes]
+            key = tuple(values[i] for i in key_indexes)
+            if key in keys:
+                raise ValueError('Duplicate primary key in ' + table.name + ': ', str(key))
+            keys.add(key)
+            row_fingerprint = fingerprint(values)
+            fingerprints_writer.writerow(list(key) + [row_fingerprint])
+            row_count += 1
+            if previous is not None:
+                previous_fingerprint = previous.pop(key, None)
+                if previous_fingerprint != row_fingerprint:
+                    changes['inserts' if previous_fingerprint is None else 'updates'] += 1
+                    upserts_out.write(b''.join(row_lines))
+            del row_lines[:]
+        metrics.add('rows_in', row_count)
+
+    if previous is None:
+        return changes, row_count, header
+    # What is left of the previous fingerprints is the rows that have been deleted.
+    changes['deletes'] = len(previous)
+    if changes['deletes'] > 0:
+        with gzip.open(join(delta_path, table.name + '.delete.gz'), 'wt') as deletes_out:
+            deletes_writer = csv.writer(deletes_out, delimiter='\t', lineterminator='\n')
+            deletes_writer.writerow(table.primary_key)
+            deletes_writer.writerows(sorted(previous))
+    if changes['inserts'] + changes['updates'] == 0:
+        os.remove(upsert_path)
+    metrics.add('rows_out', changes['inserts'] + changes['updates'] + changes['deletes'])
+    metrics.add('bytes_out', sum(os.path.getsize(join(delta_path, table.name + '.' + change + '.gz'))
+                                 for change in ['upsert', 'delete'] if isfile(join(delta_path, table.name + '.' + change + '.gz'))))
+    return changes, row_count, header
+
+
+def tablesInDependencyOrder(tables):
+    # The tables, each after the tables its foreign keys refer to.
+    ordered = []
+
+    def add(name, visiting):
+        if name in ordered or name in visiting:
+            return
+        visiting.add(name)
+        for (columns, referenced, referenced_columns) in tables[name].foreign_keys:
+            add(referenced, visiting)
+        ordered.append(name)
+
+    for name in tables:
+        add(name, set())
+    return [tables[name] for name in ordered]
+
+
+def writeApplyScript(path, tables, derived, changes, row_counts, data_columns):
+    # A psql script applying the delta in one transaction: the inserts and updates first, of the tables referred to
+    # before those referring to them, so that new rows exist before anything refers to them, then the deletes the
+    # other way round, once nothing refers to the rows any more. Each table's row count is then checked against
+    # the build's, which fails if the database wasn't at the previous build, and the materialized views refreshed.
+    # The upserts are read in the columns of each table's data.
+    ordered = tablesInDependencyOrder(tables)
+    lines = [
+        '-- The changes to the merged database since the previous build, made by delta.py. From this directory:',
+        '--   psql ' + settings["mergedDbServerDatabase"] + ' -f apply.sql',
+        '\\set ON_ERROR_STOP on',
+        'BEGIN;',
+    ]
+    for table in ordered:
+        if changes[table.name]['inserts'] + changes[table.name]['updates'] == 0:
+            continue
+        columns = list(table.columns)
+        updated = [column for column in columns if column not in table.primary_key]
+        lines += [
+            '',
+            '-- ' + table.name + ': ' + str(changes[table.name]['inserts']) + ' inserts, ' + str(changes[table.name]['updates']) + ' updates',
+            'CREATE TEMP TABLE "upsert_' + table.name + '" ON COMMIT DROP AS SELECT ' + quoted(columns) + ' FROM "' + table.name + '" WITH NO DATA;',
+            '\\copy "upsert_' + table.name + '" (' + quoted(data_columns[table.name]) + ') FROM PROGRAM \'gzip -dc ' + table.name + '.upsert.gz\' WITH ' + copy_options,
+            'INSERT INTO "' + table.name + '" (' + quoted(columns) + ') SELECT ' + quoted(columns) + ' FROM "upsert_' + table.name + '"',
+            '  ON CONFLICT (' + quoted(table.primary_key) + ') DO ' +
+            ('UPDATE SET ' + ', '.join('"' + column + '" = EXCLUDED."' + column + '"' for column in updated) if len(updated) > 0 else 'NOTHING') + ';',
+        ]
+    for table in reversed(ordered):
+        if changes[table.name]['deletes'] == 0:
+            continue
+        key = table.primary_key
+        lines += [
+            '',
+            '-- ' + table.name + ': ' + str(changes[table.name]['deletes']) + ' deletes',
+            'CREATE TEMP TABLE "delete_' + table.name + '" ON COMMIT DROP AS SELECT ' + quoted(key) + ' FROM "' + table.name + '" WITH NO DATA;',
+            '\\copy "delete_' + table.name + '" FROM PROGRAM \'gzip -dc ' + table.name + '.delete.gz\' WITH ' + copy_options,
+            'DELETE FROM "' + table.name + '" t USING "delete_' + table.name + '" d WHERE ' +
+            ' AND '.join('t."' + column + '" = d."' + column + '"' for column in key) + ';',
+        ]
+    lines.append('')
+    for table in ordered:
+        lines.append('DO $$ BEGIN IF (SELECT count(*) FROM "' + table.name + '") <> ' + str(row_counts[table.name]) +
+                     ' THEN RAISE EXCEPTION \'' + table.name + ' does not have the ' + str(row_counts[table.name]) +
+                     ' rows of the build, was the database at the previous build?\'; END IF; END $$;')
+    if any(sum(table_changes.values()) > 0 for table_changes in changes.values()):
+        lines.append('')
+        for (statement, view) in derived:
+            if view is not None:
+                lines.append('REFRESH MATERIALIZED VIEW "' + view + '";')
+    lines.append('COMMIT;')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the changes to the datatables in output/ since the previous build, as a package to apply to a copy of the merged database.')
+    parser.add_argument('--reset', action='store_true', help='Only record the current build to compare the next one with, e.g. after sending a full dump of it.')
+    args = parser.parse_args()
+    try:
+        with metrics.stage('delta'):
+            run(args.reset)
+    finally:
+        metrics.write(settings["deltaMetricsPath"], prefix='delta')
@@ -0,0 +1,94 @@
+import ftplib
+import os
+from os.path import join, dirname, isfile, getsize
+from urllib.parse import urlparse
+
+from diskcache import Cache
+
+from metrics import metrics
+
+
+class FetchCache:
+    """Local copies of files on FTP servers, such as the Sanger Pf release files.
+
+    A cached copy is only downloaded again when the SIZE or MDTM of the remote file has changed. An interrupted
+    download is resumed from where it stopped, as long as the remote file hasn't changed in the meantime. When
+    offline, files are served from the cache only and no connections are made. With a timeout, in seconds, any
+    connection or transfer that stalls for that long raises an error.
+    """
+
+    def __init__(self, directory, offline=False, timeout=None):
+        self.directory = directory
+        self.offline = offline
+        self.timeout = timeout
+        # The (size, modified) of each cached file, and of each partially downloaded file under "<url>#partial".
+        self.metadata = Cache(join(directory, 'metadata'))
+
+    def local_path(self, url):
+        url = urlparse(url)
+        return join(self.directory, url.hostname + url.path)
+
+    def remote_marker(self, url):
+        # The size and modification time of the remote file, or when offline those of the cached copy.
+        if self.offline:
+            (size, modified) = self._cached_metadata(url)
+        else:
+            with self._connect(url) as ftp:
+                (size, modified) = self._remote_metadata(ftp, url)
+        return str(size) + ':' + modified
+
+    def path(self, url):
+        # The path of an up to date local copy of url, downloading it first if need be.
+        local_path = self.local_path(url)
+        if self.offline:
+            self._cached_metadata(url)
+            return local_path
+
+        with self._connect(url) as ftp:
+            metadata = self._remote_metadata(ftp, url)
+            if self.metadata.get(url) == metadata and isfile(local_path) and getsize(local_path) == metadata[0]:
+                metrics.add('cache_hits')
+                return local_path
+            metrics.add('cache_misses')
+
+            os.makedirs(dirname(local_path), exist_ok=True)
+            partial_path = local_path + '.part'
+            # Only resume a partial download of the same version of the file.
+            if self.metadata.get(url + '#partial') != metadata or not isfile(partial_path):
+                open(partial_path, 'wb').close()
+                self.metadata[url + '#partial'] = metadata
+            offset = getsize(partial_path)
+            if offset > 0:
+                print('Resuming download of ' + url + ' from byte ' + str(offset))
+            else:
+                print('Downloading ' + url)
+            with open(partial_path, 'ab') as f:
+                if offset < metadata[0]:
+                    ftp.retrbinary('RETR ' + urlparse(url).path, f.write, rest=offset or None)
+                    metrics.add('network_bytes', metadata[0] - offset)
+
+        if getsize(partial_path) != metadata[0]:
+            raise IOError('Downloaded ' + str(getsize(partial_path)) + ' bytes of ' + url + ' but expected ' + str(metadata[0]))
+        os.replace(partial_path, local_path)
+        self.metadata[url] = metadata
+        del self.metadata[url + '#partial']
+        return local_path
+
+    def _cached_metadata(self, url):
+        metadata = self.metadata.get(url)
+        if metadata is None or not isfile(self.local_path(url)):
+            raise LookupError('Running offline but there is no cached copy of: ' + url)
+        return metadata
+
+    def _connect(self, url):
+        url = urlparse(url)
+        ftp = ftplib.FTP()
+        ftp.connect(url.hostname, url.port or ftplib.FTP_PORT, timeout=self.timeout)
+        ftp.login()
+        return ftp
+
+    def _remote_metadata(self, ftp, url):
+        path = urlparse(url).path
+        # SIZE is only reliable in binary mode.
+        ftp.voidcmd('TYPE I')
+        return ftp.size(path), ftp.sendcmd('MDTM ' + path).split()[-1]
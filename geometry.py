@@ -0,0 +1,114 @@
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import shapely.geometry
+import shapely.ops
+import shapely.wkb
+from shapely.geometry import JOIN_STYLE, Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from metrics import metrics
+
+# Changing how a region's outline is made (see region_outline) must change this, so cached outlines aren't reused.
+region_outline_version = 'buffer 0.001 mitre, simplify 0.1'
+
+
+class PointIndex:
+    """A spatial index over a set of (lng, lat) points, such as the sample sites.
+
+    Built once and then asked which points fall inside each polygon, so that the work scales with the number of
+    points near a polygon rather than with every point for every polygon.
+    """
+
+    def __init__(self, points):
+        self.points = [Point(lng, lat) for (lng, lat) in points]
+        self.tree = STRtree(self.points)
+
+    def candidates(self, geometry):
+        # The points whose envelopes intersect the geometry's envelope.
+        # (Shapely 2 returns indexes into the points, earlier versions the points themselves.)
+        return [self.points[candidate] if not hasattr(candidate, 'geom_type') else candidate
+                for candidate in self.tree.query(geometry)]
+
+    def within(self, polygon):
+        prepared = prep(polygon)
+        return [point for point in self.candidates(polygon) if prepared.contains(point)]
+
+    def any_within(self, polygon):
+        prepared = prep(polygon)
+        return any(prepared.contains(point) for point in self.candidates(polygon))
+
+
+def polygons(shape):
+    # The polygons making up a Polygon or MultiPolygon.
+    return list(shape.geoms) if hasattr(shape, 'geoms') else [shape]
+
+
+def polygons_containing_points(shape, point_index):
+    # The union of the polygons in the shape that contain at least one of the indexed points.
+    return shapely.ops.unary_union([polygon for polygon in polygons(shape) if point_index.any_within(polygon)])
+
+
+class CountryShapes:
+    """The shape of each country, parsed from its GeoJSON only once.
+
+    Each country's key is its country_id and a hash of its geometry, so anything derived from a country's shape
+    can be cached under that key and is only recomputed if the geometry changes.
+    """
+
+    def __init__(self, geojson_for_country):
+        self.geojson_for_country = geojson_for_country
+        self._keys = {}
+        self._shapes = {}
+
+    def has_shape(self, country_id):
+        return self.geojson_for_country[country_id] not in [None, '']
+
+    def key(self, country_id):
+        if country_id not in self._keys:
+            geometry = json.dumps(self.geojson_for_country[country_id]['geometry'], sort_keys=True)
+            self._keys[country_id] = country_id + ':' + hashlib.sha1(geometry.encode()).hexdigest()
+        return self._keys[country_id]
+
+    def shape(self, country_id):
+        key = self.key(country_id)
+        if key not in self._shapes:
+            self._shapes[key] = shapely.geometry.shape(self.geojson_for_country[country_id]['geometry'])
+        return self._shapes[key]
+
+
+def region_outline(country_wkbs):
+    # The union of the countries' shapes in one go, with the slivers between neighbouring countries closed up by
+    # a small buffer out and back in, then simplified. Takes and returns WKB so it can run in another process.
+    shape = shapely.ops.unary_union([shapely.wkb.loads(wkb) for wkb in country_wkbs])
+    return shape.buffer(0.001, join_style=JOIN_STYLE.mitre).buffer(-0.001, join_style=JOIN_STYLE.mitre).simplify(0.1).wkb
+
+
+def region_outlines(country_ids_by_region, country_shapes, cache, max_workers):
+    # The outline of each region, or None for a region without any countries. Outlines are kept in the cache keyed
+    # by the region's countries and their geometries, and the rest are computed in parallel in a process pool.
+    outlines = {}
+    pending = {}
+    for region_id, country_ids in country_ids_by_region.items():
+        if len(country_ids) == 0:
+            outlines[region_id] = None
+            continue
+        key = hashlib.sha1(' '.join([region_outline_version] + sorted(country_shapes.key(country_id) for country_id in country_ids)).encode()).hexdigest()
+        wkb = cache.get('region_outline:' + key)
+        metrics.add('cache_hits' if wkb is not None else 'cache_misses')
+        if wkb is not None:
+            outlines[region_id] = shapely.wkb.loads(wkb)
+        else:
+            pending[region_id] = (key, [country_shapes.shape(country_id).wkb for country_id in sorted(country_ids)])
+
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {region_id: executor.submit(region_outline, country_wkbs) for region_id, (key, country_wkbs) in pending.items()}
+            for region_id, future in futures.items():
+                wkb = future.result()
+                cache['region_outline:' + pending[region_id][0]] = wkb
+                outlines[region_id] = shapely.wkb.loads(wkb)
+
+    return outlines
@@ -0,0 +1,56 @@
+import json
+
+from apiclient import discovery
+
+from metrics import metrics
+
+
+class GSheets:
+    """The Google Sheets and Drive APIs, with their discovery documents and the values of spreadsheets cached.
+
+    The values of a spreadsheet are cached by its Drive version, which changes whenever it is edited, so fetching
+    an unchanged spreadsheet only costs the request for its version. authorize is called, once, for the HTTP
+    object to make the requests with: the authorized Http, or an HttpMockSequence to test against.
+    """
+
+    def __init__(self, authorize, cache, sheets_discovery_url, drive_discovery_url):
+        self.authorize = authorize
+        self.cache = cache
+        self.discovery_urls = {'sheets': sheets_discovery_url, 'drive': drive_discovery_url}
+        self._http = None
+        self._services = {}
+
+    def http(self):
+        if self._http is None:
+            self._http = self.authorize()
+        return self._http
+
+    def service(self, name):
+        # The API built from its discovery document, which is only requested if not already cached.
+        if name not in self._services:
+            url = self.discovery_urls[name]
+            document = self.cache.get('discovery:' + url)
+            if document is None:
+                (response, document) = self.http().request(url)
+                if int(response.status) != 200:
+                    raise ValueError('Failed to fetch the discovery document: ', url)
+                document = document.decode() if isinstance(document, bytes) else document
+                self.cache['discovery:' + url] = document
+            self._services[name] = discovery.build_from_document(document, http=self.http())
+        return self._services[name]
+
+    def version(self, spreadsheet_id):
+        # The Drive version of the spreadsheet. (The headRevisionId field is not populated for Google Sheets.)
+        return str(self.service('drive').files().get(fileId=spreadsheet_id, fields='version').execute()['version'])
+
+    def values(self, spreadsheet_id, ranges, version=None):
+        # The rows of each of the ranges of the spreadsheet, all fetched in one request unless cached for the version.
+        key = 'values:' + spreadsheet_id + ':' + (version or self.version(spreadsheet_id)) + ':' + json.dumps(ranges)
+        values = self.cache.get(key)
+        metrics.add('cache_hits' if values is not None else 'cache_misses')
+        if values is None:
+            value_ranges = self.service('sheets').spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id, ranges=ranges).execute()['valueRanges']
+            values = [value_range.get('values', []) for value_range in value_ranges]
+            self.cache[key] = values
+        return values
@@ -0,0 +1,132 @@
+import argparse
+import csv
+import io
+
+import psycopg2
+import yaml
+
+from fetch_cache import FetchCache
+from metrics import metrics
+
+with open('settings_nosecrets', 'r') as f:
+    settings = yaml.load(f, Loader=yaml.BaseLoader)
+
+with open('settings_local', 'r') as f:
+    settings = {**settings, **yaml.load(f, Loader=yaml.BaseLoader)}
+
+
+def run(tables, offline=False):
+    # Replace each of the Observatory tables with the rows of its Sanger FTP file, mapped as set in ingestTables.
+    # Each file is streamed from its local copy and each table filled with COPY FROM STDIN in batches of
+    # ingestBatchRows rows, so neither the file nor the table is ever held in memory. Each table is emptied and
+    # filled in one transaction, so the Observatory never has a partly ingested table.
+    fetch_cache = FetchCache(settings["fetchCachePath"], offline=offline, timeout=float(settings["fetchTimeout"]))
+    for table in tables:
+        if table not in settings["ingestTables"]:
+            raise ValueError('No such table in ingestTables: ', table)
+
+    conn = psycopg2.connect(**observatoryConnectionParams())
+    try:
+        for table in tables:
+            config = settings["ingestTables"][table]
+            with metrics.stage('ingest:' + table):
+                with metrics.stage('fetch:' + table):
+                    path = fetch_cache.path(config["url"])
+                with conn, conn.cursor() as cursor, open(path, 'r') as data_in:
+                    reader = csv.reader(data_in, delimiter='\t')
+                    (columns, rows) = mappedRows(next(reader), reader, config)
+                    print('Ingesting ' + config["url"] + ' into ' + table)
+                    row_count = copyInBatches(cursor, table, columns, rows, int(settings["ingestBatchRows"]))
+                    print(table + ': ' + str(row_count) + ' rows')
+    finally:
+        conn.close()
+
+
+def observatoryConnectionParams():
+    # http://initd.org/psycopg/docs/module.html#psycopg2.connect
+    return dict(
+        host = settings["observatoryDbServerHost"],
+        port = str(settings["observatoryDbServerPort"]),
+        sslmode = settings["observatoryDbServerSSL"],
+        database = settings["observatoryDbServerDatabase"],
+        user = settings["observatoryDbServerUser"],
+        password = settings["observatoryDbServerPass"],
+        connect_timeout = int(float(settings["fetchTimeout"])),
+        options = '-c statement_timeout=' + str(int(float(settings["fetchTimeout"]) * 1000))
+    )
+
+
+def mappedRows(header, rows, config):
+    # The columns and an iterator over the rows of a file once its columns are renamed, those to drop left out and,
+    # if melted, each row made into one row per remaining column other than the id columns.
+    rename = config.get("rename", {})
+    drop = config.get("drop", [])
+    missing = [column for column in drop if column not in header]
+    if len(missing) > 0:
+        raise ValueError('Columns to drop are not in the file: ', str(missing))
+    kept = [i for i, column in enumerate(header) if column not in drop]
+    columns = [rename.get(header[i], header[i]) for i in kept]
+
+    if "melt" not in config:
+        return columns, ([row[i] for i in kept] for row in rows)
+
+    melt = config["melt"]
+    missing = [column for column in melt["id"] if column not in columns]
+    if len(missing) > 0:
+        raise ValueError('Id columns to melt on are not in the file: ', str(missing))
+    id_indexes = [kept[columns.index(column)] for column in melt["id"]]
+    value_indexes = [(rename.get(header[i], header[i]), i) for i in kept if i not in id_indexes]
+    lower = melt.get("lower") == 'true'
+
+    def melted():
+        for row in rows:
+            ids = [row[i] for i in id_indexes]
+            for (name, i) in value_indexes:
+                yield ids + [name, row[i].lower() if lower else row[i]]
+
+    return melt["id"] + [melt["name"], melt["value"]], melted()
+
+
+def copyInBatches(cursor, table, columns, rows, batch_rows):
+    # Empty the table and COPY the rows into it, batch_rows at a time, each batch buffered as CSV in memory.
+    cursor.execute('TRUNCATE "' + settings["observatoryDbServerDbSchema"] + '"."' + table + '"')
+    copy_query = 'COPY "' + settings["observatoryDbServerDbSchema"] + '"."' + table + '" (' + ', '.join('"' + column + '"' for column in columns) + \
+                 ") FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t')"
+    row_count = 0
+    batch = io.StringIO()
+    writer = csv.writer(batch, delimiter='\t', lineterminator='\n')
+    batch_count = 0
+    for row in rows:
+        if len(row) != len(columns):
+            raise ValueError('Row ' + str(row_count + 1) + ' of ' + table + ' does not have ' + str(len(columns)) + ' values: ', str(row))
+        writer.writerow(row)
+        row_count += 1
+        batch_count += 1
+        if batch_count == batch_rows:
+            copyBatch(cursor, copy_query, batch)
+            batch = io.StringIO()
+            writer = csv.writer(batch, delimiter='\t', lineterminator='\n')
+            batch_count = 0
+    if batch_count > 0:
+        copyBatch(cursor, copy_query, batch)
+    metrics.add('rows_out', row_count)
+    return row_count
+
+
+def copyBatch(cursor, copy_query, batch):
+    metrics.add('bytes_out', batch.tell())
+    batch.seek(0)
+    # http://initd.org/psycopg/docs/cursor.html#cursor.copy_expert
+    cursor.copy_expert(copy_query, batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the Sanger FTP files into the Observatory tables.')
+    parser.add_argument('tables', nargs='*', help='The tables to ingest, of those in ingestTables. By default all of them.')
+    parser.add_argument('--offline', action='store_true', help='Read the Sanger FTP files from the local fetch cache only.')
+    args = parser.parse_args()
+    try:
+        with metrics.stage('ingest'):
+            run(args.tables or list(settings["ingestTables"]), args.offline)
+    finally:
+        metrics.write(settings["ingestMetricsPath"], prefix='ingest')
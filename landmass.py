@@ -0,0 +1,105 @@
+import os
+import struct
+import sys
+import threading
+from os.path import join, dirname, abspath, isfile
+
+import shapely.ops
+import shapely.wkb
+from shapely.geometry import box
+from shapely.strtree import STRtree
+
+my_path = abspath(dirname(__file__))
+wkb_path = join(my_path, 'landmass.wkb')
+tiles_path = join(my_path, 'landmass.tiles')
+
+# The tiles file is this header, then (minx, miny, maxx, maxy, offset, length) for each tile, then the WKB of each
+# tile's part of the landmass at the given offset into the file.
+magic = b'LANDTILE'
+header = struct.Struct('<8sdI')
+tile_entry = struct.Struct('<4dQQ')
+
+
+def build(wkb_path=wkb_path, tiles_path=tiles_path, tile_size=10.0):
+    # Cut the landmass into tile_size degree squares, keeping only those with some land in.
+    with open(wkb_path, 'rb') as f:
+        landmass = shapely.wkb.loads(f.read())
+    tiles = []
+    lng = -180.0
+    while lng < 180.0:
+        lat = -90.0
+        while lat < 90.0:
+            cell = box(lng, lat, lng + tile_size, lat + tile_size)
+            if landmass.intersects(cell):
+                tile = landmass.intersection(cell)
+                if not tile.is_empty:
+                    tiles.append((cell.bounds, tile.wkb))
+            lat += tile_size
+        lng += tile_size
+
+    offset = header.size + tile_entry.size * len(tiles)
+    with open(tiles_path + '.tmp', 'wb') as f:
+        f.write(header.pack(magic, tile_size, len(tiles)))
+        for bounds, wkb in tiles:
+            f.write(tile_entry.pack(*bounds, offset, len(wkb)))
+            offset += len(wkb)
+        for bounds, wkb in tiles:
+            f.write(wkb)
+    os.replace(tiles_path + '.tmp', tiles_path)
+
+
+class Landmass:
+    """The world's landmass, cut into tiles that are only read from landmass.tiles when something overlaps them.
+
+    Clipping a polygon to the landmass then only involves the few tiles under the polygon, rather than the
+    whole world's coastline. The tiles file is built from landmass.wkb the first time it is needed, if missing.
+    """
+
+    def __init__(self, tiles_path=tiles_path, wkb_path=wkb_path):
+        self.tiles_path = tiles_path
+        self.wkb_path = wkb_path
+        self.lock = threading.Lock()
+        self.tree = None
+
+    def _load_index(self):
+        if not isfile(self.tiles_path):
+            print('Building ' + self.tiles_path + ' from ' + self.wkb_path)
+            build(self.wkb_path, self.tiles_path)
+        with open(self.tiles_path, 'rb') as f:
+            (file_magic, tile_size, count) = header.unpack(f.read(header.size))
+            if file_magic != magic:
+                raise ValueError('Not a landmass tiles file: ', self.tiles_path)
+            entries = [tile_entry.unpack(f.read(tile_entry.size)) for i in range(count)]
+        self.boxes = [box(*entry[:4]) for entry in entries]
+        self.locations = [entry[4:] for entry in entries]
+        self.tiles = [None] * count
+        self.index_of_box = {id(tile_box): i for i, tile_box in enumerate(self.boxes)}
+        self.tree = STRtree(self.boxes)
+
+    def _tile(self, i):
+        if self.tiles[i] is None:
+            (offset, length) = self.locations[i]
+            with open(self.tiles_path, 'rb') as f:
+                f.seek(offset)
+                self.tiles[i] = shapely.wkb.loads(f.read(length))
+        return self.tiles[i]
+
+    def tiles_overlapping(self, geometry):
+        with self.lock:
+            if self.tree is None:
+                self._load_index()
+            # (Shapely 2 returns indexes into the boxes, earlier versions the boxes themselves.)
+            candidates = [candidate if not hasattr(candidate, 'geom_type') else self.index_of_box[id(candidate)]
+                          for candidate in self.tree.query(box(*geometry.bounds))]
+            return [self._tile(i) for i in sorted(candidates)]
+
+    def intersection(self, geometry):
+        # The part of the geometry that is on land.
+        if geometry.is_empty:
+            return geometry
+        pieces = [geometry.intersection(tile) for tile in self.tiles_overlapping(geometry)]
+        return shapely.ops.unary_union([piece for piece in pieces if not piece.is_empty])
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:3])
@@ -0,0 +1,266 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isfile
+
+import psycopg2
+import psycopg2.pool
+import yaml
+
+import sqlschema
+from metrics import metrics
+
+with open('settings_nosecrets', 'r') as f:
+    settings = yaml.load(f, Loader=yaml.BaseLoader)
+
+with open('settings_local', 'r') as f:
+    settings = {**settings, **yaml.load(f, Loader=yaml.BaseLoader)}
+
+datatables_path = join('output')
+
+
+def run(jobs):
+    # Load the datatables in output/ into a new schema, pf_build_<timestamp>, creating the tables from schema.sql.
+    # The tables are created without their keys and the data streamed in with COPY, and the primary keys, foreign
+    # keys, indexes and materialized summary views are only added once all of the data is in. The new schema is then analyzed and checked, and
+    # swapped in for the live schema in a single transaction, so the site never sees partly loaded tables. The
+    # schema it replaces is kept as the previous schema, for rollback.
+    tables = sqlschema.parse()
+    derived = sqlschema.parse_derived()
+    for table in tables.values():
+        if not isfile(dataPath(table.name)):
+            raise ValueError('Datatable to load does not exist at path: ', dataPath(table.name))
+
+    build_schema = 'pf_build_' + time.strftime('%Y%m%d%H%M%S')
+    # The number of rows in each datatable, counted as it is copied in, to check the tables against.
+    row_counts = {}
+    pool = psycopg2.pool.ThreadedConnectionPool(1, jobs, **mergedDbConnectionParams())
+    try:
+        runInTransaction(pool, None, lambda cursor: cursor.execute('CREATE SCHEMA "' + build_schema + '"'))
+        if jobs == 1:
+            # Everything in one transaction.
+            def load(cursor):
+                createTables(cursor, tables)
+                with metrics.stage('copy'):
+                    for table in tables.values():
+                        row_counts[table.name] = copyTable(cursor, table)
+                addConstraints(cursor, tables)
+                createDerived(cursor, derived)
+                validate(cursor, tables, derived, row_counts)
+            runInTransaction(pool, build_schema, load)
+        else:
+            # The tables are loaded in parallel over several connections, each in its own transaction.
+            runInTransaction(pool, build_schema, lambda cursor: createTables(cursor, tables))
+            with metrics.stage('copy'), ThreadPoolExecutor(max_workers=jobs) as executor:
+                # list() to raise the first error, if any.
+                list(executor.map(lambda table: runInTransaction(pool, build_schema, lambda cursor: row_counts.update({table.name: copyTable(cursor, table)})), tables.values()))
+            runInTransaction(pool, build_schema, lambda cursor: (addConstraints(cursor, tables), createDerived(cursor, derived), validate(cursor, tables, derived, row_counts)))
+        runInTransaction(pool, None, lambda cursor: swapIn(cursor, build_schema))
+    except Exception:
+        # Drop what there is of the new schema, but raise the error the load failed with, even if that fails too.
+        try:
+            runInTransaction(pool, None, lambda cursor: cursor.execute('DROP SCHEMA IF EXISTS "' + build_schema + '" CASCADE'))
+        except Exception as e:
+            print('Could not drop ' + build_schema + ': ' + str(e))
+        raise
+    finally:
+        pool.closeall()
+
+
+def rollback():
+    # Swap the previous schema back in for the live one, which becomes the previous schema in turn.
+    connection = psycopg2.connect(**mergedDbConnectionParams())
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                live_schema = settings["mergedDbServerDbSchema"]
+                previous_schema = settings["mergedDbPreviousSchema"]
+                cursor.execute('SELECT 1 FROM pg_namespace WHERE nspname = %s', (previous_schema,))
+                if cursor.fetchone() is None:
+                    raise ValueError('There is no previous schema to roll back to: ', previous_schema)
+                cursor.execute('ALTER SCHEMA "' + live_schema + '" RENAME TO "pf_rollback"')
+                cursor.execute('ALTER SCHEMA "' + previous_schema + '" RENAME TO "' + live_schema + '"')
+                cursor.execute('ALTER SCHEMA "pf_rollback" RENAME TO "' + previous_schema + '"')
+    finally:
+        connection.close()
+
+
+def mergedDbConnectionParams():
+    # http://initd.org/psycopg/docs/module.html#psycopg2.connect
+    return dict(
+        host = settings["mergedDbServerHost"],
+        port = str(settings["mergedDbServerPort"]),
+        sslmode = settings["mergedDbServerSSL"],
+        database = settings["mergedDbServerDatabase"],
+        user = settings["mergedDbServerUser"],
+        password = settings["mergedDbServerPass"]
+    )
+
+
+def runInTransaction(pool, schema, statements):
+    # Unqualified table names refer to tables in the schema, if given.
+    connection = pool.getconn()
+    try:
+        with connection:
+            with connection.cursor() as cursor:
+                if schema is not None:
+                    cursor.execute('SET LOCAL search_path TO "' + schema + '"')
+                statements(cursor)
+    finally:
+        pool.putconn(connection)
+
+
+def dataPath(table_name):
+    return join(datatables_path, table_name, 'data')
+
+
+def quoted(names):
+    return ', '.join('"' + name + '"' for name in names)
+
+
+def createTables(cursor, tables):
+    with metrics.stage('create tables'):
+        for table in tables.values():
+            cursor.execute('CREATE TABLE "' + table.name + '" (' + ', '.join(
+                '"' + column + '" ' + sql_type for column, sql_type in table.columns.items()) + ')')
+
+
+def copyTable(cursor, table):
+    # Returns the number of rows in the table's data, as COPY read them.
+    # Each table is measured as the stage "copy:<table>".
+    print('Loading ' + dataPath(table.name))
+    with metrics.stage('copy:' + table.name), open(dataPath(table.name), 'r') as data:
+        columns = data.readline().rstrip('\n').split('\t')
+        data.seek(0)
+        rows = RowCountingFile(data)
+        cursor.copy_expert('COPY "' + table.name + '" (' + quoted(columns) + ") FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', HEADER true)", rows)
+        metrics.add('bytes_in', data.tell())
+        metrics.add('rows_in', rows.row_count())
+        return rows.row_count()
+
+
+class RowCountingFile:
+    """A CSV file being read, counting its rows as COPY's CSV format does: a line break ends a row unless it is
+    within quotes, and every quote starts or ends quoting, "" included, so that counts twice."""
+
+    def __init__(self, file):
+        self.file = file
+        self.in_quotes = False
+        self.line_breaks = 0
+        self.last = ''
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        for i, part in enumerate(data.split('"')):
+            if i > 0:
+                self.in_quotes = not self.in_quotes
+            if not self.in_quotes:
+                self.line_breaks += part.count('\n')
+        if len(data) > 0:
+            self.last = data[-1]
+        return data
+
+    def row_count(self):
+        # Not counting the header, and counting a last row without a line break.
+        rows = self.line_breaks + (1 if self.last not in ['', '\n'] else 0)
+        return max(rows - 1, 0)
+
+
+def addConstraints(cursor, tables):
+    with metrics.stage('constraints'):
+        # Primary keys first, as the foreign keys reference them.
+        for table in tables.values():
+            if len(table.primary_key) > 0:
+                cursor.execute('ALTER TABLE "' + table.name + '" ADD PRIMARY KEY (' + quoted(table.primary_key) + ')')
+        for table in tables.values():
+            for (columns, referenced, referenced_columns) in table.foreign_keys:
+                cursor.execute('ALTER TABLE "' + table.name + '" ADD FOREIGN KEY (' + quoted(columns) + ') REFERENCES "' +
+                               referenced + '" (' + quoted(referenced_columns) + ')')
+
+
+def createDerived(cursor, derived):
+    # The indexes and materialized views in schema.sql. The views are filled from the loaded data as they're created.
+    with metrics.stage('derived'):
+        for (statement, view) in derived:
+            cursor.execute(statement)
+
+
+def validate(cursor, tables, derived, row_counts):
+    # Analyze the new tables and views, for the query planner, and check each table has all the rows of its data,
+    # and that none came out empty. The foreign keys have already been checked as they were added.
+    with metrics.stage('validate'):
+        for (statement, view) in derived:
+            if view is not None:
+                cursor.execute('ANALYZE "' + view + '"')
+        for table in tables.values():
+            cursor.execute('ANALYZE "' + table.name + '"')
+            cursor.execute('SELECT count(*) FROM "' + table.name + '"')
+            (row_count,) = cursor.fetchone()
+            print(table.name + ': ' + str(row_count) + ' rows')
+            if row_count != row_counts[table.name]:
+                raise ValueError('Loaded table does not have the ' + str(row_counts[table.name]) + ' rows of its data, but ' + str(row_count) + ': ', table.name)
+            if row_count == 0:
+                raise ValueError('Loaded table is empty: ', table.name)
+
+
+def swapIn(cursor, build_schema):
+    # Rename the live schema to the previous schema, replacing any older one, and the new schema to the live one.
+    with metrics.stage('swap'):
+        live_schema = settings["mergedDbServerDbSchema"]
+        previous_schema = settings["mergedDbPreviousSchema"]
+        cursor.execute('DROP SCHEMA IF EXISTS "' + previous_schema + '" CASCADE')
+        cursor.execute('SELECT 1 FROM pg_namespace WHERE nspname = %s', (live_schema,))
+        if cursor.fetchone() is not None:
+            copyPrivileges(cursor, live_schema, build_schema)
+            cursor.execute('ALTER SCHEMA "' + live_schema + '" RENAME TO "' + previous_schema + '"')
+        cursor.execute('ALTER SCHEMA "' + build_schema + '" RENAME TO "' + live_schema + '"')
+
+
+def copyPrivileges(cursor, from_schema, to_schema):
+    # Grant on the new schema and its tables and views what is granted on the live ones, and give it the same default
+    # privileges, so that the roles reading the live schema, such as the site's, still can once the new one is
+    # swapped in. (A new schema only has its owner's privileges; a schema or table without any grants has the defaults.)
+    def grantTo(role, is_grantable):
+        return ' TO ' + ('PUBLIC' if role is None else '"' + role + '"') + (' WITH GRANT OPTION' if is_grantable else '')
+
+    cursor.execute('SELECT a.privilege_type, a.is_grantable, r.rolname FROM pg_namespace n '
+                   "CROSS JOIN LATERAL aclexplode(coalesce(n.nspacl, acldefault('n', n.nspowner))) a LEFT JOIN pg_roles r ON r.oid = a.grantee "
+                   'WHERE n.nspname = %s', (from_schema,))
+    for (privilege, is_grantable, role) in cursor.fetchall():
+        cursor.execute('GRANT ' + privilege + ' ON SCHEMA "' + to_schema + '"' + grantTo(role, is_grantable))
+
+    # Of the tables, views and materialized views, those in both schemas.
+    cursor.execute('SELECT c.relname, a.privilege_type, a.is_grantable, r.rolname FROM pg_class c '
+                   'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                   "CROSS JOIN LATERAL aclexplode(coalesce(c.relacl, acldefault('r', c.relowner))) a LEFT JOIN pg_roles r ON r.oid = a.grantee "
+                   "WHERE n.nspname = %s AND c.relkind IN ('r', 'v', 'm') AND c.relname IN ("
+                   'SELECT c2.relname FROM pg_class c2 JOIN pg_namespace n2 ON n2.oid = c2.relnamespace WHERE n2.nspname = %s)',
+                   (from_schema, to_schema))
+    for (table, privilege, is_grantable, role) in cursor.fetchall():
+        cursor.execute('GRANT ' + privilege + ' ON "' + to_schema + '"."' + table + '"' + grantTo(role, is_grantable))
+
+    object_types = {'r': 'TABLES', 'S': 'SEQUENCES', 'f': 'FUNCTIONS', 'T': 'TYPES'}
+    cursor.execute('SELECT pg_get_userbyid(d.defaclrole), d.defaclobjtype, a.privilege_type, a.is_grantable, r.rolname FROM pg_default_acl d '
+                   'JOIN pg_namespace n ON n.oid = d.defaclnamespace '
+                   'CROSS JOIN LATERAL aclexplode(d.defaclacl) a LEFT JOIN pg_roles r ON r.oid = a.grantee '
+                   'WHERE n.nspname = %s', (from_schema,))
+    for (owner, object_type, privilege, is_grantable, role) in cursor.fetchall():
+        if object_type in object_types:
+            cursor.execute('ALTER DEFAULT PRIVILEGES FOR ROLE "' + owner + '" IN SCHEMA "' + to_schema + '" GRANT ' + privilege +
+                           ' ON ' + object_types[object_type] + grantTo(role, is_grantable))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the datatables in output/ into the merged database.')
+    parser.add_argument('--jobs', type=int, default=int(settings["mergedDbLoadConnections"]),
+                        help='Number of tables to load at once, each in its own transaction. By default 1, when the whole load is a single transaction.')
+    parser.add_argument('--rollback', action='store_true', help='Swap the previous schema back in instead of loading.')
+    args = parser.parse_args()
+    if args.rollback:
+        rollback()
+    else:
+        try:
+            with metrics.stage('load'):
+                run(args.jobs)
+        finally:
+            metrics.write(settings["mergedDbLoadMetricsPath"], settings["mergedDbLoadMetricsPrometheusPath"], prefix='load')
@@ -0,0 +1,40 @@
+import json
+import os
+
+
+class Manifest:
+    """The version markers of the sources each datatable in output/ was last built from.
+
+    Each source (an Observatory view, the Alfresco studies, LDAP, a Google Sheet, a Sanger FTP file...) is
+    probed for a cheap marker such as a checksum, ETag or revision, and a datatable only needs rebuilding
+    when the markers of its sources differ from those recorded here.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        self.sources = manifest.get('sources', {})
+        self.datatables = manifest.get('datatables', {})
+
+    def source_marker(self, source):
+        # The marker last seen for a source, e.g. to send as If-None-Match.
+        return self.sources.get(source)
+
+    def is_current(self, datatable, markers):
+        return self.datatables.get(datatable) == markers
+
+    def record(self, datatable, markers):
+        self.datatables[datatable] = markers
+
+    def record_sources(self, markers):
+        self.sources.update(markers)
+
+    def save(self):
+        # Write to a temporary file first, so an interrupted run can't leave a truncated manifest.
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'sources': self.sources, 'datatables': self.datatables}, f, indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+
+# Which value is kept when the base and the overlay both have the column:
+# overlay - the overlay's, even if it is empty;
+# fill - the base's, unless it is empty;
+# error - either, as long as they don't differ when neither is empty.
+conflict_policies = ['overlay', 'fill', 'error']
+
+
+def join_key(columns, overlay_columns, key=None):
+    # The column to join on: the key, if given, which must be in both, or else the only column in both.
+    if key:
+        if key not in columns or key not in overlay_columns:
+            raise ValueError('The merge key is not in both the datatable and the overlay: ', key)
+        return key
+    matching_columns = [column for column in overlay_columns if column in columns]
+    if len(matching_columns) != 1:
+        raise ValueError('When merging a gsheet there should be one and only one column to match on, we got:', str(matching_columns))
+    return matching_columns[0]
+
+
+def merged_columns(columns, overlay_columns, schema_columns=()):
+    # The columns of the base and the overlay in the order of the schema's, e.g. the datatable's in schema.sql, then
+    # any others in the order they first appear, so the layout is the same on every run.
+    all_columns = list(OrderedDict.fromkeys(list(columns) + list(overlay_columns)))
+    return [column for column in schema_columns if column in all_columns] + [column for column in all_columns if column not in schema_columns]
+
+
+def merge(columns, rows, overlay_columns, overlay_rows, key=None, conflict='overlay', schema_columns=()):
+    # Merge the overlay's rows, e.g. from a Google Sheet, into the base's, e.g. an Observatory datatable, on the join
+    # key. Returns the merged columns and an iterator over the merged rows. Only the overlay is held in memory,
+    # indexed by key, and the base's rows are streamed through one at a time, so they can be written straight back.
+    # Every row of the base is kept, with empty values for the overlay's columns if the overlay doesn't have its key;
+    # overlay rows with keys that aren't in the base are dropped, and of overlay rows with the same key the last is used.
+    if conflict not in conflict_policies:
+        raise ValueError('Unknown merge conflict policy: ', conflict)
+    key = join_key(columns, overlay_columns, key)
+    columns_out = merged_columns(columns, overlay_columns, schema_columns)
+
+    overlay_key_index = overlay_columns.index(key)
+    overlay_by_key = {}
+    for overlay_row in overlay_rows:
+        # (Rows from the Sheets API leave out the empty cells at the end.)
+        overlay_row = list(overlay_row) + [''] * (len(overlay_columns) - len(overlay_row))
+        overlay_by_key[overlay_row[overlay_key_index]] = overlay_row
+
+    # Where each of the merged columns is in the base's rows and in the overlay's, or None.
+    positions = [(columns.index(column) if column in columns else None, overlay_columns.index(column) if column in overlay_columns else None)
+                 for column in columns_out]
+    empty_overlay_row = [''] * len(overlay_columns)
+    key_index = columns.index(key)
+
+    def value(column, row, overlay_row, base_index, overlay_index):
+        if overlay_index is None:
+            return row[base_index]
+        if base_index is None:
+            return overlay_row[overlay_index]
+        (base_value, overlay_value) = (row[base_index], overlay_row[overlay_index])
+        if conflict == 'overlay':
+            return overlay_value
+        if conflict == 'error' and base_value != '' and overlay_value != '' and base_value != overlay_value:
+            raise ValueError('Conflicting values to merge in column ' + column + ' for ' + key + ': ', row[key_index])
+        return base_value if base_value != '' else overlay_value
+
+    def merged_rows():
+        for row in rows:
+            overlay_row = overlay_by_key.get(row[key_index])
+            if overlay_row is None:
+                yield [row[base_index] if base_index is not None else '' for (base_index, overlay_index) in positions]
+            else:
+                yield [value(column, row, overlay_row, base_index, overlay_index) for column, (base_index, overlay_index) in zip(columns_out, positions)]
+
+    return columns_out, merged_rows()
@@ -0,0 +1,159 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Metrics:
+    """What each stage of a run took: wall and CPU time, peak RSS, and counts such as rows and bytes in and out,
+    network bytes and cache hits and misses.
+
+    Stages are timed with stage(), or with begin() for the sections of a long function, each of which ends when the
+    next begins. Counts added with add() go to the innermost stage running in the same thread. A stage run several
+    times, such as a function called per site, is accumulated into one record with the number of calls.
+
+    The CPU time of a stage is that of the thread it runs in, so stages running at the same time, like the fetches,
+    each have their own. The process CPU time is that of the whole process while the stage ran: all its threads, and
+    its child processes, such as the geometry process pool's, once they have exited.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+        self.local = threading.local()
+        # The stage to profile, and with which profiler: cprofile, or pyinstrument if it is installed.
+        self.profile_stage = None
+        self.profiler = 'cprofile'
+        self.profile_path = None
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _record(self, name):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = OrderedDict([('calls', 0), ('wall_seconds', 0.0), ('cpu_seconds', 0.0), ('process_cpu_seconds', 0.0), ('peak_rss_bytes', 0)])
+            return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        record = self._record(name)
+        stack = self._stack()
+        stack.append(name)
+        profiler = self._start_profiler() if name == self.profile_stage else None
+        (wall, cpu, process_cpu) = (time.perf_counter(), time.thread_time(), process_cpu_seconds())
+        try:
+            yield
+        finally:
+            (wall, cpu, process_cpu) = (time.perf_counter() - wall, time.thread_time() - cpu, process_cpu_seconds() - process_cpu)
+            if profiler is not None:
+                self._stop_profiler(profiler)
+            stack.pop()
+            with self.lock:
+                record['calls'] += 1
+                record['wall_seconds'] += wall
+                record['cpu_seconds'] += cpu
+                record['process_cpu_seconds'] += process_cpu
+                record['peak_rss_bytes'] = max(record['peak_rss_bytes'], peak_rss_bytes())
+
+    def begin(self, name):
+        # End the section begun last, if any, and begin the named one.
+        self.end()
+        self.local.section = self.stage(name)
+        self.local.section.__enter__()
+
+    def end(self):
+        section = getattr(self.local, 'section', None)
+        if section is not None:
+            self.local.section = None
+            section.__exit__(None, None, None)
+
+    def add(self, counter, amount=1):
+        # Add to a counter of the current stage, e.g. rows_out, network_bytes or cache_hits.
+        stack = self._stack()
+        record = self._record(stack[-1] if len(stack) > 0 else 'other')
+        with self.lock:
+            record[counter] = record.get(counter, 0) + amount
+
+    def _start_profiler(self):
+        if self.profiler == 'pyinstrument':
+            import pyinstrument
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            # (cProfile only profiles the thread the stage runs in.)
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, profiler):
+        if self.profiler == 'pyinstrument':
+            profiler.stop()
+            print(profiler.output_text())
+            if self.profile_path:
+                with open(self.profile_path + '.html', 'w') as f:
+                    f.write(profiler.output_html())
+            return
+        profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+        print(out.getvalue())
+        if self.profile_path:
+            profiler.dump_stats(self.profile_path + '.prof')
+
+    def report(self):
+        with self.lock:
+            return OrderedDict([('time', time.time()), ('stages', json.loads(json.dumps(self.stages)))])
+
+    def write(self, json_path, prometheus_path=None, prefix='create_files'):
+        # The report as JSON, and optionally as a Prometheus textfile (for the node exporter's textfile collector)
+        # with the metric names starting with the prefix.
+        report = self.report()
+        with open(json_path + '.tmp', 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(json_path + '.tmp', json_path)
+        if prometheus_path:
+            with open(prometheus_path + '.tmp', 'w') as f:
+                f.write(prometheus_text(report, prefix))
+            os.replace(prometheus_path + '.tmp', prometheus_path)
+
+
+def prometheus_text(report, prefix='create_files'):
+    lines = []
+    for stage, record in report['stages'].items():
+        label = '{stage="' + stage.replace('\\', '\\\\').replace('"', '\\"') + '"}'
+        for name, value in record.items():
+            lines.append(prefix + '_stage_' + name + label + ' ' + repr(value))
+    lines.append(prefix + '_last_run_timestamp_seconds ' + repr(report['time']))
+    return '\n'.join(lines) + '\n'
+
+
+def process_cpu_seconds():
+    # The user and system CPU time of the process and of its child processes that have exited and been waited for.
+    # (Without the resource module, e.g. on Windows, only that of the process.)
+    if resource is None:
+        return time.process_time()
+    return sum(usage.ru_utime + usage.ru_stime for usage in [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+
+def peak_rss_bytes():
+    # The peak resident set size of the process so far. (ru_maxrss is in kilobytes on Linux, bytes on macOS.)
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == 'Darwin' else maxrss * 1024
+
+
+# The metrics of this run, shared by the modules it uses.
+metrics = Metrics()
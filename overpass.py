@@ -1,16 +1,25 @@
+import hashlib
 import sys
+import threading
 import time
-from collections import Counter
-from os.path import join, dirname, abspath
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
 import requests
 import json
 import unicodedata
 from math import sqrt
 
-from shapely.geometry import mapping
+from shapely.geometry import mapping, Point
 from shapely.ops import polygonize, cascaded_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 import pandas
-import shapely.wkb
+import shapely
+import shapely.errors
+
+from landmass import Landmass
+from metrics import metrics
 
 from diskcache import Cache
 try:
@@ -23,9 +32,27 @@ except ImportError:
 overpass_url = "http://overpass-api.de/api/interpreter"
 # overpass_url = "https://overpass.kumi.systems/api/interpreter"
 
-my_path = abspath(dirname(__file__))
-with open(join(my_path, 'landmass.wkb'), 'rb') as f:
-    landmass = shapely.wkb.loads(f.read())
+admin_level_filter = '[boundary=administrative][admin_level~"^[3456]$"]'
+# How many points to ask about in one query, how many queries to have in flight at once and how many to start a second.
+points_per_query = 20
+max_concurrent_queries = 2
+queries_per_second = 1
+# How many processed relation records to keep in memory, in front of those in the cache.
+relation_records_in_memory = 4096
+# Retries on 429 (too many requests) and 504 (gateway timeout) back off exponentially up to this, then give up.
+max_sleep_time = 300
+max_retries = 8
+
+# The errors Shapely raises for geometries GEOS can't handle, e.g. a boundary ring that crosses itself. (Which there
+# are depends on the version of Shapely.)
+shapely_errors = tuple(getattr(shapely.errors, name) for name in ['ShapelyError', 'TopologicalError', 'GEOSException'] if hasattr(shapely.errors, name))
+
+# Loaded a tile at a time, as admin polygons are clipped to it.
+landmass = Landmass()
+
+# Changing how a relation's record is made (see get_polygon and admin_level_record) must change this, so cached
+# records aren't reused.
+relation_record_version = 'outer ways, clipped to landmass tiles, simplify 0.01'
 
 def get_polygon(element):
     # Some polys have a gap in, just deal with one gap for now
@@ -45,10 +72,10 @@ def get_polygon(element):
     if len(unmatched) > 0:
         extra_lines.append(unmatched)
 
-    return cascaded_union(list(
+    return landmass.intersection(cascaded_union(list(
         polygonize(extra_lines + [
             [(p['lon'], p['lat']) for p in m['geometry']]
-            for m in members]))).simplify(0.01).intersection(landmass)
+            for m in members]))).simplify(0.01))
 
 def filter_unwanted(name):
     for unwanted in ['province', 'Province', 'district', 'District', 'division', 'Division', 'region', 'Region', 'state', 'State']:
@@ -57,43 +84,194 @@ def filter_unwanted(name):
     name = name.strip()
     return name
 
-def admin_levels_for_point(lat, lng):
-    cache_key = str(lat) + ',' + str(lng)
-    try:
-        result = cache[cache_key]
-    except KeyError:
-        query = '[out:json];is_in({}, {});relation(pivot)[boundary=administrative][admin_level~"^[3456]$"];out geom;'.format(
-            lat, lng)
-        sleep_time = 5
-        while True:
-            result = requests.get(overpass_url,
-                                  params={'data': query})
-            if result.status_code == 429 or result.status_code == 504:  # TOO MANY REQUESTS
-                print('Too many OSM requests, sleeping for ' + str(sleep_time))
-                time.sleep(sleep_time)
-                sleep_time = sleep_time * 2
-                continue
-            result.raise_for_status()
-            result = result.json()['elements']
+class RateLimiter:
+    """Spaces out requests so that no more than a given number start each second, across threads."""
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+def new_session(pool_size=max_concurrent_queries):
+    # A session keeps connections to the Overpass server open between queries.
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def query_elements(query, url=overpass_url, session=requests, rate_limiter=None):
+    sleep_time = 5
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        result = session.post(url, data={'data': query})
+        if (result.status_code == 429 or result.status_code == 504) and attempt < max_retries:  # TOO MANY REQUESTS
+            print('Too many OSM requests, sleeping for ' + str(sleep_time))
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, max_sleep_time)
+            continue
+        result.raise_for_status()
+        metrics.add('network_bytes', len(result.content))
+        return result.json()['elements']
+
+
+def cache_key_for_point(lat, lng):
+    return str(lat) + ',' + str(lng)
+
+
+def query_points(points, url=overpass_url, session=requests, rate_limiter=None):
+    # The admin relations containing each of the (lat, lng) points, in one query. After the relations for each
+    # point a "point" element is made with the index of that point, to tell whose relations are whose.
+    query = '[out:json];'
+    for index, (lat, lng) in enumerate(points):
+        query += 'is_in({}, {})->.areas;relation(pivot.areas){};out meta geom;make point index="{}";out;'.format(
+            lat, lng, admin_level_filter, index)
+    elements_for_point = {}
+    elements = []
+    for element in query_elements(query, url, session, rate_limiter):
+        if element['type'] == 'point':
+            elements_for_point[points[int(element['tags']['index'])]] = elements
+            elements = []
+        else:
+            elements.append(element)
+    if len(elements_for_point) != len(points):
+        raise ValueError('Overpass response is missing points: ', str([point for point in points if point not in elements_for_point]))
+    return elements_for_point
+
+
+def admin_levels_for_point(lat, lng, url=overpass_url):
+    with metrics.stage('overpass.admin_levels_for_point'):
+        if admin_boundaries is not None:
+            return admin_boundaries.admin_levels_for_point(lat, lng)
+        cache_key = cache_key_for_point(lat, lng)
+        try:
+            result = cache[cache_key]
+            metrics.add('cache_hits')
+        except KeyError:
+            metrics.add('cache_misses')
+            result = query_points([(lat, lng)], url)[(lat, lng)]
             cache[cache_key] = result
-            break
+        return admin_levels_for_elements(lat, lng, result)
+
+
+def admin_levels_for_sites(sites, lat_column='lat', lng_column='lng', url=overpass_url, session=None,
+                           concurrency=max_concurrent_queries, per_query=points_per_query, per_second=queries_per_second):
+    # The province and district of each site, as a DataFrame with the same index as sites, e.g. the pf_sites
+    # datatable. Each distinct point is only looked up once, points not already cached are asked about several to
+    # a query, and the queries are made over one session, a few at a time and no faster than per_second.
+    if admin_boundaries is not None:
+        return admin_boundaries.admin_levels_for_sites(sites, lat_column, lng_column)
+    points = list(zip(sites[lat_column], sites[lng_column]))
+    elements_for_point = {}
+    uncached = []
+    for point in set(points):
+        try:
+            elements_for_point[point] = cache[cache_key_for_point(*point)]
+        except KeyError:
+            uncached.append(point)
+    metrics.add('cache_hits', len(elements_for_point))
+    metrics.add('cache_misses', len(uncached))
+
+    if len(uncached) > 0:
+        session = session or new_session(concurrency)
+        rate_limiter = RateLimiter(per_second)
+        batches = [uncached[i:i + per_query] for i in range(0, len(uncached), per_query)]
+        print('Fetching admin levels from OSM for ' + str(len(uncached)) + ' points in ' + str(len(batches)) + ' queries')
+        def query(batch):
+            with metrics.stage('overpass.query_points'):
+                return query_points(batch, url, session, rate_limiter)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch_elements in executor.map(query, batches):
+                for point, elements in batch_elements.items():
+                    cache[cache_key_for_point(*point)] = elements
+                    elements_for_point[point] = elements
+
+    record_for_point = {}
+    for (lat, lng), elements in elements_for_point.items():
+        record_for_point[(lat, lng)] = site_record(*admin_levels_for_elements(lat, lng, elements))
+    return pandas.DataFrame([record_for_point[point] for point in points], index=sites.index)
+
+
+def site_record(province, district):
+    # The province and district of a site as one flat record, e.g. province_id, province_name... district_name...
+    record = {}
+    for (level, admin_level) in [('province', province), ('district', district)]:
+        for key, value in admin_level.items():
+            record[key if key.endswith('_id') else level + '_' + key] = value
+    return record
+
+
+def admin_level_record(e, polygon=None):
+    # The record of an admin relation, from its polygon if already made.
+    if polygon is None:
+        polygon = get_polygon(e)
+    centre = polygon.centroid
+    name_en = e['tags'].get('name:en', e['tags']['name'])
+    return {
+        'id': unicodedata.normalize('NFKD', name_en).encode("ascii", 'replace').replace(
+            b' ', b'_').decode('ascii') + '_' + str(e['id'])[:4], # Extra id numbers to improve chances of unique
+        'name': filter_unwanted(name_en),
+        'local_name': e['tags']['name'],
+        'latitude': centre.y,
+        'longitude': centre.x,
+        'geojson': json.dumps(mapping(polygon))
+    }
+
+
+def relation_key(e):
+    # Relations are queried with their version, except in responses cached before that, which are hashed instead.
+    # Either way with the version of how records are made.
+    salt = hashlib.sha1(relation_record_version.encode()).hexdigest()[:8]
+    if 'version' in e:
+        return 'relation:' + salt + ':' + str(e['id']) + ':' + str(e['version'])
+    return 'relation:' + salt + ':' + str(e['id']) + ':' + hashlib.sha1(json.dumps(e, sort_keys=True).encode()).hexdigest()
+
+
+relation_records = OrderedDict()
+
+
+def relation_record(e):
+    # The record of an admin relation, made once per version of the relation. Neighbouring sites share their
+    # provinces and districts, so most are found in memory, and the rest in the cache before being made.
+    key = relation_key(e)
+    record = relation_records.get(key)
+    if record is not None:
+        metrics.add('relation_memory_hits')
+        relation_records.move_to_end(key)
+        return record
+    record = cache.get(key)
+    metrics.add('relation_cache_hits' if record is not None else 'relation_cache_misses')
+    if record is None:
+        record = admin_level_record(e)
+        cache[key] = record
+    relation_records[key] = record
+    if len(relation_records) > relation_records_in_memory:
+        relation_records.popitem(last=False)
+    return record
+
+
+def admin_levels_for_elements(lat, lng, result):
     admin_levels = {}
     for e in result:
         if 'admin_level' in e['tags']:
-            polygon = get_polygon(e)
-            centre = polygon.centroid
-            if 'name:en' not in e['tags']:
-                e['tags']['name:en'] = e['tags']['name']
-            admin_levels[e['tags']['admin_level']] = {
-                'id': unicodedata.normalize('NFKD', e['tags']['name:en']).encode("ascii", 'replace').replace(
-                    b' ', b'_').decode('ascii') + '_' + str(e['id'])[:4], # Extra id numbers to improve chances of unique
-                'name': filter_unwanted(e['tags']['name:en']),
-                'local_name': e['tags']['name'],
-                'latitude': centre.y,
-                'longitude': centre.x,
-                'geojson': json.dumps(mapping(polygon))
-            }
+            admin_levels[e['tags']['admin_level']] = relation_record(e)
+    return province_and_district(lat, lng, admin_levels)
 
+
+def province_and_district(lat, lng, admin_levels):
+    # Pick the province and district from the records of the admin levels containing a point, by admin_level.
+    admin_levels = {level: dict(record) for level, record in admin_levels.items()}
     ret = {}
     five_used = False
     if '4' in admin_levels:
@@ -123,9 +301,92 @@ def admin_levels_for_point(lat, lng):
     return ret['province'], ret['district']
 
 
+class AdminBoundaryIndex:
+    """The admin boundaries (levels 3 to 6) from a local extract, spatially indexed to look sites up offline.
+
+    The extract is the JSON output of an Overpass query for the relations with their geometry, e.g.
+    [out:json];relation[boundary=administrative][admin_level~"^[3456]$"](south,west,north,east);out geom;
+    Each relation is made into a polygon once, when loaded, and its record only made the first time it is needed.
+    """
+
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            elements = json.load(f)['elements']
+        self.elements = []
+        self.polygons = []
+        for e in elements:
+            if e['type'] != 'relation' or e.get('tags', {}).get('admin_level') not in ['3', '4', '5', '6']:
+                continue
+            try:
+                polygon = get_polygon(e)
+            except (AssertionError, ValueError) + shapely_errors as error:
+                print('Ignoring relation ' + str(e['id']) + ' as its polygon can not be made: ' + str(error))
+                continue
+            if polygon.is_empty:
+                continue
+            self.elements.append(e)
+            self.polygons.append(polygon)
+        self.prepared = [prep(polygon) for polygon in self.polygons]
+        self.tree = STRtree(self.polygons)
+        self.index_of_polygon = {id(polygon): i for i, polygon in enumerate(self.polygons)}
+        self.records = {}
+
+    def containing(self, point):
+        # The indexes of the polygons containing the point.
+        # (Shapely 2 returns indexes into the polygons, earlier versions the polygons themselves.)
+        candidates = [candidate if not hasattr(candidate, 'geom_type') else self.index_of_polygon[id(candidate)]
+                      for candidate in self.tree.query(point)]
+        return [i for i in candidates if self.prepared[i].contains(point)]
+
+    def containing_points(self, points):
+        # The indexes of the polygons containing each of the (lat, lng) points. Shapely 2 can query the tree with
+        # all of the points at once.
+        if not hasattr(shapely, 'points'):
+            return [self.containing(Point(lng, lat)) for (lat, lng) in points]
+        containing = [[] for point in points]
+        (point_indexes, polygon_indexes) = self.tree.query(
+            shapely.points([lng for (lat, lng) in points], [lat for (lat, lng) in points]), predicate='within')
+        for point_index, polygon_index in zip(point_indexes, polygon_indexes):
+            containing[point_index].append(polygon_index)
+        return containing
+
+    def record(self, i):
+        if i not in self.records:
+            self.records[i] = admin_level_record(self.elements[i], self.polygons[i])
+        return self.records[i]
+
+    def admin_levels(self, lat, lng, containing):
+        admin_levels = {}
+        for i in containing:
+            admin_levels[self.elements[i]['tags']['admin_level']] = self.record(i)
+        return province_and_district(lat, lng, admin_levels)
+
+    def admin_levels_for_point(self, lat, lng):
+        return self.admin_levels(lat, lng, self.containing(Point(lng, lat)))
+
+    def admin_levels_for_sites(self, sites, lat_column='lat', lng_column='lng'):
+        # As overpass.admin_levels_for_sites, with the distinct points looked up all together.
+        points = list(zip(sites[lat_column], sites[lng_column]))
+        distinct_points = list(set(points))
+        record_for_point = {}
+        for (lat, lng), containing in zip(distinct_points, self.containing_points(distinct_points)):
+            record_for_point[(lat, lng)] = site_record(*self.admin_levels(lat, lng, containing))
+        return pandas.DataFrame([record_for_point[point] for point in points], index=sites.index)
+
+
+# When set, by load_admin_boundaries, sites are looked up in this rather than by querying Overpass.
+admin_boundaries = None
+
+
+def load_admin_boundaries(path):
+    global admin_boundaries
+    admin_boundaries = AdminBoundaryIndex(path)
+    return admin_boundaries
+
+
 if __name__ == '__main__':
-    locations = pandas.read_csv(sys.argv[1], delimiter='\t')
-    for index, row in locations.iterrows():
-        print(row['location_id'], row['country_id'], row['latitude'], row['longitude'])
-        a = admin_levels_for_point(row['latitude'], row['longitude'])
-        print(a)
+    if len(sys.argv) > 2:
+        load_admin_boundaries(sys.argv[2])
+    sites = pandas.read_csv(sys.argv[1], delimiter='\t')
+    admin_levels = admin_levels_for_sites(sites)
+    print(pandas.concat([sites[['site_id', 'country_id', 'lat', 'lng']], admin_levels], axis=1).to_string())
@@ -0,0 +1,61 @@
+import pandas
+
+# The resistance and deletion classification columns of pf_samples, and the prevalence column each gives, named as in
+# pf_sites, countries and pf_regions.
+classifications = [
+    ('ARTresistant', 'ARTresistance'),
+    ('ASMQresistant', 'ASMQresistance'),
+    ('CQresistant', 'CQresistance'),
+    ('DHAPPQresistant', 'DHAPPQresistance'),
+    ('MQresistant', 'MQresistance'),
+    ('PPQresistant', 'PPQresistance'),
+    ('PYRresistant', 'PYRresistance'),
+    ('SDXresistant', 'SDXresistance'),
+    ('SPIPTpresistant', 'SPIPTpresistance'),
+    ('SPresistant', 'SPresistance'),
+    ('HRP2deletion', 'HRP2deletion'),
+    ('HRP3deletion', 'HRP3deletion'),
+    ('HRP23deletion', 'HRP23deletion'),
+]
+# Compared case-insensitively, as the statuses are e.g. lower cased by the ingest of sampletypes.
+positive_statuses = ['resistant', 'deletion']
+undetermined_statuses = ['', 'undetermined']
+
+
+def passes_qc(samples):
+    # qc_pass is a bool when read from an Arrow file, and Postgres' t/f (or True/False, as older runs wrote it) when
+    # read from TSV.
+    return samples['qc_pass'].astype(str).isin(['True', 'true', 't'])
+
+
+def prevalence(samples, keys):
+    # The number of samples passing QC in each group of samples with the same values of the keys, and the percentage
+    # of those classified (not Undetermined) for each classification that are resistant or have the deletion, as
+    # in the prevalence columns of pf_sites. Samples with no value for one of the keys aren't in any group.
+    samples = samples[passes_qc(samples)]
+    present = [(column, prevalence_column) for column, prevalence_column in classifications if column in samples.columns]
+    statuses = samples[[column for column, prevalence_column in present]].apply(
+        lambda column: column.where(column.isnull(), column.astype(str).str.casefold()))
+    classified = statuses.notnull() & ~statuses.isin(undetermined_statuses)
+    positive = statuses.isin(positive_statuses)
+
+    # Sum the classified and positive counts of every classification, and count the samples, in one groupby.
+    counts = pandas.concat([
+        classified.add_suffix(':classified'),
+        positive.add_suffix(':positive'),
+        pandas.Series(1, index=samples.index, name='num_samples'),
+        samples[keys]
+    ], axis=1).groupby(keys).sum()
+
+    result = pandas.DataFrame(index=counts.index)
+    result['num_samples'] = counts['num_samples']
+    for column, prevalence_column in present:
+        # NaN, an empty value in the datatable, where none of the group's samples were classified.
+        result[prevalence_column] = 100.0 * counts[column + ':positive'] / counts[column + ':classified'].where(counts[column + ':classified'] > 0)
+    result = result.reset_index()
+
+    # Keys such as year are read as floats when some samples have no value, but those samples aren't in any group.
+    for key in keys:
+        if result[key].dtype.kind == 'f' and (result[key] % 1 == 0).all():
+            result[key] = result[key].astype('int64')
+    return result
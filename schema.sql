@@ -214,6 +214,61 @@ CREATE TABLE "pf_resgenes" (
 );
 
 
+CREATE TABLE "pf_site_year_prevalence" (
+  "site_id" Text,
+  "year" Int,
+  "num_samples" Int,
+  "ARTresistance" Float,
+  "ASMQresistance" Float,
+  "CQresistance" Float,
+  "DHAPPQresistance" Float,
+  "MQresistance" Float,
+  "PPQresistance" Float,
+  "PYRresistance" Float,
+  "SDXresistance" Float,
+  "SPIPTpresistance" Float,
+  "SPresistance" Float,
+  "HRP2deletion" Float,
+  "HRP3deletion" Float,
+  "HRP23deletion" Float,
+  PRIMARY KEY ("site_id", "year")
+);
+
+CREATE TABLE "pf_country_year_prevalence" (
+  "country_id" Text,
+  "year" Int,
+  "num_samples" Int,
+  "ARTresistance" Float,
+  "ASMQresistance" Float,
+  "CQresistance" Float,
+  "DHAPPQresistance" Float,
+  "MQresistance" Float,
+  "PPQresistance" Float,
+  "PYRresistance" Float,
+  "SDXresistance" Float,
+  "SPIPTpresistance" Float,
+  "SPresistance" Float,
+  "HRP2deletion" Float,
+  "HRP3deletion" Float,
+  "HRP23deletion" Float,
+  PRIMARY KEY ("country_id", "year")
+);
+
+CREATE TABLE "countries_topology" (
+  "zoom" Int PRIMARY KEY,
+  "tolerance" Float,
+  "quantization" Int,
+  "topojson" Text
+);
+
+CREATE TABLE "pf_regions_topology" (
+  "zoom" Int PRIMARY KEY,
+  "tolerance" Float,
+  "quantization" Int,
+  "topojson" Text
+);
+
+
 ALTER TABLE "pf_drug_regions" ADD FOREIGN KEY ("drug_id") REFERENCES "pf_drugs" ("drug_id");
 ALTER TABLE "pf_drug_regions" ADD FOREIGN KEY ("region_id") REFERENCES "pf_regions" ("region_id");
 ALTER TABLE "pf_sites" ADD FOREIGN KEY ("country_id") REFERENCES "countries" ("country_id");
@@ -228,20 +283,25 @@ ALTER TABLE "pf_samples" ADD FOREIGN KEY ("study_id") REFERENCES "studies" ("stu
 ALTER TABLE "pf_drug_gene" ADD FOREIGN KEY ("drug_id") REFERENCES "pf_drugs" ("drug_id");
 ALTER TABLE "pf_drug_gene" ADD FOREIGN KEY ("gene_id") REFERENCES "pf_resgenes" ("gene_id");
 ALTER TABLE "pf_resgenes" ADD FOREIGN KEY ("gene_id") REFERENCES "gene_diff" ("gene_id");
+ALTER TABLE "pf_site_year_prevalence" ADD FOREIGN KEY ("site_id") REFERENCES "pf_sites" ("site_id");
+ALTER TABLE "pf_country_year_prevalence" ADD FOREIGN KEY ("country_id") REFERENCES "countries" ("country_id");
+
 
+-- Indexes for the site's filters on pf_samples, and summaries it can read instead of scanning pf_samples.
+-- load.py creates these once the data is in, and they are created with their data, so each load refreshes them.
+CREATE INDEX "pf_samples_site_id" ON "pf_samples" ("site_id");
+CREATE INDEX "pf_samples_country_id" ON "pf_samples" ("country_id");
+CREATE INDEX "pf_samples_region_id" ON "pf_samples" ("region_id");
+CREATE INDEX "pf_samples_study_id" ON "pf_samples" ("study_id");
+CREATE INDEX "pf_samples_year" ON "pf_samples" ("year");
 
-\COPY countries ("country_id", "lat", "lng", "name", "alpha_3_code", "geojson", "num_samples", "CQresistance", "PYRresistance", "SDXresistance", "MQresistance", "ARTresistance", "PPQresistance") FROM 'output/countries/data' DELIMITER E'\t' CSV HEADER;
-\COPY gene_diff ("gene_id", "gene_name", "chrom", "start", "end", "global_differentiation_score", "local_differentiation_score", "distance_to_higher_local_diff_score") FROM 'output/gene_diff/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_drugs ("drug_id", "is_combination", "name", "short_description", "description") FROM 'output/pf_drugs/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_features ("feature_id", "name", "category", "description") FROM 'output/pf_features/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_featuretypes ("feature_id", "type_id", "description", "feature") FROM 'output/pf_featuretypes/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_regions ("region_id", "lat", "lng", "name", "description", "num_samples", "web_colour", "CQresistance", "PYRresistance", "SDXresistance", "MQresistance", "ARTresistance", "PPQresistance", "SPIPTpresistance", "ASMQresistance", "DHAPPQresistance", "HRP2deletion", "HRP3deletion", "HRP23deletion", "SPresistance", "geojson") FROM 'output/pf_regions/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_resgenes ("gene_id", "name", "long_name", "short_description", "description", "marker_name") FROM 'output/pf_resgenes/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_sites ("site_id", "lat", "lng", "name", "num_samples", "pf_region_id", "country_id", "CQresistance", "PYRresistance", "SDXresistance", "MQresistance", "ARTresistance", "PPQresistance", "SPIPTpresistance", "ASMQresistance", "DHAPPQresistance", "HRP2deletion", "HRP3deletion", "HRP23deletion", "SPresistance", "AnyHRPdeletion") FROM 'output/pf_sites/data' DELIMITER E'\t' CSV HEADER;
-\COPY studies ("study", "study_number", "webTitle", "description") FROM 'output/studies/data' DELIMITER E'\t' CSV HEADER;
-\COPY study_ldap_people ("study", "jobTitle1", "jobTitle2", "jobTitle3", "uid", "researchGateURL", "scholarURL", "twitterURL", "malariagenUID", "oProfile1", "oProfile2", "oProfile3", "ORCID", "sn", "mail", "givenName", "o1", "o2", "o3") FROM 'output/study_ldap_people/data' DELIMITER E'\t' CSV HEADER;
-\COPY study_publications ("study", "doi", "name", "title", "citation", "pmid") FROM 'output/study_publications/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_drug_gene ("gene_id", "drug_id") FROM 'output/pf_drug_gene/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_drug_regions ("region_id", "drug_region_id", "text", "resistance", "drug_id") FROM 'output/pf_drug_regions/data' DELIMITER E'\t' CSV HEADER;
-\COPY pf_samples ("sample_id", "PYRresistant", "MQresistant", "country_lat", "country_lng", "region_lng", "HRP23deletion", "ARTresistant", "site_id", "site_lng", "year", "country", "CQresistant", "pc_genome_callable", "ASMQresistant", "HRP2deletion", "qc_pass", "site_lat", "region_lat", "DHAPPQresistant", "SPresistant", "SPIPTpresistant", "mean_coverage", "HRP3deletion", "site", "PPQresistant", "region_id", "SDXresistant", "run_accessions", "region", "study_id", "country_id", "crt_76[K]", "crt_72-76[CVMNK]", "dhfr_51[N]", "dhfr_59[C]", "dhfr_108[S]", "dhfr_164[I]", "dhps_437[G]", "dhps_540[K]", "dhps_581[A]", "dhps_613[A]", "k13_class", "k13_alleles", "cn_mdr1", "cn_pm2", "cn_gch1", "breakpoint_mdr1", "breakpoint_pm2", "breakpoint_gch1", "Fws") FROM 'output/pf_samples/data' DELIMITER E'\t' CSV HEADER;
+-- The prevalence of each resistance/deletion classification per site and year isn't a view here: it is the
+-- pf_site_year_prevalence table, computed from the samples by prevalence.py.
 
+-- The number of samples passing QC from each study in each country.
+CREATE MATERIALIZED VIEW "pf_study_country_samples" AS
+SELECT "study_id", "country_id", count(*) AS "num_samples"
+FROM "pf_samples"
+WHERE "qc_pass"
+GROUP BY "study_id", "country_id";
+CREATE INDEX "pf_study_country_samples_country_id" ON "pf_study_country_samples" ("country_id");
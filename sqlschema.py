@@ -0,0 +1,83 @@
+"""The tables, keys, indexes and materialized views of schema.sql, for load.py and delta.py.
+
+load.py creates the tables from what is parsed here, not from schema.sql itself, so only what is modelled here can be
+in schema.sql: CREATE TABLE with each column's name and type, and PRIMARY KEY, ALTER TABLE ... ADD FOREIGN KEY,
+CREATE INDEX and CREATE MATERIALIZED VIEW. Anything else, e.g. a DEFAULT, CHECK or NOT NULL, or a comment within a
+CREATE TABLE, is an error rather than being left out of the database.
+"""
+import re
+from collections import OrderedDict
+from os.path import join, dirname, abspath
+
+schema_path = join(abspath(dirname(__file__)), 'schema.sql')
+
+
+class Table:
+    def __init__(self, name):
+        self.name = name
+        # Column name -> SQL type, in the order declared.
+        self.columns = OrderedDict()
+        self.primary_key = []
+        # (columns, referenced table, referenced columns)
+        self.foreign_keys = []
+
+
+def _names(names):
+    return [name.strip().strip('"') for name in names.split(',')]
+
+
+def parse(path=schema_path):
+    # The tables declared in schema.sql, by name. Only the subset of SQL used in schema.sql is understood:
+    # CREATE TABLE with column and PRIMARY KEY definitions, and ALTER TABLE ... ADD FOREIGN KEY. The indexes and
+    # materialized views are in parse_derived.
+    with open(path, 'r') as f:
+        sql = f.read()
+
+    _check_statements(sql)
+
+    tables = OrderedDict()
+    for name, body in re.findall(r'CREATE TABLE\s+"?(\w+)"?\s*\((.*?)\);', sql, re.DOTALL):
+        table = tables[name] = Table(name)
+        for definition in body.split('\n'):
+            definition = definition.strip().rstrip(',').strip()
+            if definition == '':
+                continue
+            primary_key = re.match(r'PRIMARY KEY\s*\((.*)\)$', definition, re.IGNORECASE)
+            column = re.match(r'"([^"]+)"\s+(\w+)(\s+PRIMARY KEY)?$', definition, re.IGNORECASE)
+            if primary_key:
+                table.primary_key = _names(primary_key.group(1))
+            elif column:
+                table.columns[column.group(1)] = column.group(2)
+                if column.group(3):
+                    table.primary_key = [column.group(1)]
+            else:
+                raise ValueError('Definition in CREATE TABLE "' + name + '" in schema.sql not understood: ', definition)
+
+    for name, columns, referenced, referenced_columns in re.findall(
+            r'ALTER TABLE\s+"?(\w+)"?\s+ADD FOREIGN KEY\s*\((.*?)\)\s*REFERENCES\s+"?(\w+)"?\s*\((.*?)\)', sql, re.IGNORECASE):
+        tables[name].foreign_keys.append((_names(columns), referenced, _names(referenced_columns)))
+
+    return tables
+
+
+def _check_statements(sql):
+    # Every statement, once comment lines are left out, must be one of those understood.
+    sql = '\n'.join(line for line in sql.split('\n') if not line.strip().startswith('--'))
+    for statement in sql.split(';'):
+        statement = ' '.join(statement.split())
+        if statement != '' and not re.match(r'(CREATE TABLE|ALTER TABLE\s+"?\w+"?\s+ADD FOREIGN KEY|CREATE (UNIQUE )?INDEX|CREATE MATERIALIZED VIEW)\b',
+                                            statement, re.IGNORECASE):
+            raise ValueError('Statement in schema.sql not understood: ', statement)
+
+
+def parse_derived(path=schema_path):
+    # The CREATE INDEX and CREATE MATERIALIZED VIEW statements in schema.sql, in order, as (statement, name of the
+    # materialized view or None).
+    with open(path, 'r') as f:
+        sql = f.read()
+
+    statements = []
+    for statement in re.findall(r'^(CREATE (?:UNIQUE )?(?:INDEX|MATERIALIZED VIEW)\b.*?;)', sql, re.DOTALL | re.MULTILINE):
+        view = re.match(r'CREATE MATERIALIZED VIEW\s+"?(\w+)"?', statement)
+        statements.append((statement, view.group(1) if view else None))
+    return statements
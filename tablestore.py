@@ -0,0 +1,296 @@
+import csv
+import json
+import math
+import os
+import sys
+from os.path import join, isdir, isfile
+
+import pandas
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+import sqlschema
+from metrics import metrics
+
+# The GeoJSON columns are larger than the csv module allows by default. This is set here, for the whole process, as
+# the datatables are read through the store.
+csv.field_size_limit(sys.maxsize)
+
+
+class TableStore:
+    """The datatables in output/, each in its own directory, stored either as TSV or as typed Arrow files.
+
+    In "tsv" format each datatable is the "data" TSV file, as loaded into Postgres. In "arrow" format each is a
+    "data.arrow" Arrow IPC file typed according to schema.sql, which is memory-mapped when read back so that
+    re-reading a datatable doesn't mean parsing it again. The TSV files are then only written by export_tsv.
+
+    Rows read from and written to the store are lists of strings either way, as in the TSV files. The values of the
+    Float, Int and Boolean columns are written to TSV as Postgres would output them, and each datatable with the
+    quoting it was written with, so the TSV files are the same whichever format the datatables were kept in.
+    """
+
+    batch_size = 50000
+
+    def __init__(self, datatables_path, format='tsv', value_separator='\t', row_separator='\n'):
+        if format not in ['tsv', 'arrow']:
+            raise ValueError('Unknown datatable format: ', format)
+        if format == 'arrow' and pyarrow is None:
+            raise ValueError('The arrow datatable format needs pyarrow to be installed')
+        self.datatables_path = datatables_path
+        self.format = format
+        self.value_separator = value_separator
+        self.row_separator = row_separator
+        self.schema = sqlschema.parse()
+
+    def tsv_path(self, datatable):
+        return join(self.datatables_path, datatable, 'data')
+
+    def arrow_path(self, datatable):
+        return join(self.datatables_path, datatable, 'data.arrow')
+
+    def path(self, datatable):
+        return self.arrow_path(datatable) if self.format == 'arrow' else self.tsv_path(datatable)
+
+    def staging_path(self, datatable):
+        # Where to write a TSV file that is then brought into the store with import_tsv.
+        if not isdir(join(self.datatables_path, datatable)):
+            os.makedirs(join(self.datatables_path, datatable), exist_ok=True)
+        return join(self.datatables_path, datatable, 'data.staging')
+
+    def exists(self, datatable):
+        return isfile(self.path(datatable))
+
+    def import_tsv(self, datatable, tsv_path):
+        # Move an unquoted TSV file, such as COPY output, into the store.
+        if self.format == 'tsv':
+            os.replace(tsv_path, self.tsv_path(datatable))
+            return
+        with open(tsv_path, 'r') as data_in:
+            reader = csv.reader(data_in, delimiter=self.value_separator, quoting=csv.QUOTE_NONE)
+            # Exported again unquoted, as it was.
+            with self.writer(datatable, next(reader), quoting=csv.QUOTE_NONE, quotechar=None) as writer:
+                writer.writerows(reader)
+        os.remove(tsv_path)
+
+    def writer(self, datatable, columns, **csv_options):
+        # A context manager writing the rows of a datatable, which replaces any existing data when it closes.
+        # The csv_options are how the TSV file is quoted, and in the arrow format are kept with the datatable for
+        # export_tsv.
+        if not isdir(join(self.datatables_path, datatable)):
+            os.makedirs(join(self.datatables_path, datatable), exist_ok=True)
+        if self.format == 'arrow':
+            schema = self._arrow_schema(datatable, columns).with_metadata({'csv_options': json.dumps(csv_options)})
+            return _ArrowWriter(self.arrow_path(datatable), columns, schema)
+        return self._tsv_writer(datatable, columns, csv_options)
+
+    def _tsv_writer(self, datatable, columns, csv_options):
+        sql_types = self.schema[datatable].columns if datatable in self.schema else {}
+        return _TsvWriter(self.tsv_path(datatable), columns, dict(dict(delimiter=self.value_separator, lineterminator=self.row_separator), **csv_options),
+                          [_formatters.get(sql_types.get(column, 'text').lower()) for column in columns])
+
+    def reader(self, datatable):
+        # The columns of a datatable and an iterator over its rows.
+        if self.format == 'arrow':
+            reader = pyarrow.ipc.open_file(pyarrow.memory_map(self.arrow_path(datatable)))
+            return reader.schema.names, _counted(_arrow_rows(reader))
+        data_in = open(self.tsv_path(datatable), 'r')
+        reader = csv.reader(data_in, delimiter=self.value_separator)
+        return next(reader), _counted(_closing(data_in, reader))
+
+    def read_frame(self, datatable):
+        # A datatable as a DataFrame. Numeric columns without nulls are read straight out of the memory-mapped file.
+        # The Int columns are nullable integers in both formats, rather than floats where they have nulls.
+        if self.format == 'arrow':
+            return pyarrow.ipc.open_file(pyarrow.memory_map(self.arrow_path(datatable))).read_pandas(types_mapper={pyarrow.int64(): pandas.Int64Dtype()}.get)
+        sql_types = self.schema[datatable].columns if datatable in self.schema else {}
+        with open(self.tsv_path(datatable), 'r') as f:
+            columns = next(csv.reader(f, delimiter=self.value_separator))
+        return pandas.read_csv(self.tsv_path(datatable), delimiter=self.value_separator,
+                               dtype={column: 'Int64' for column in columns if sql_types.get(column, 'text').lower() == 'int'})
+
+    def write_frame(self, datatable, frame):
+        # Written through the same writer as rows, so typed and formatted as they are.
+        with self.writer(datatable, list(frame.columns)) as writer:
+            writer.writerows([_format(value) for value in row] for row in frame.itertuples(index=False, name=None))
+
+    def export_tsv(self, datatables):
+        # Write the TSV file of each datatable from its Arrow file, for loading into Postgres, with the writer and
+        # quoting it would have been written with in the tsv format.
+        if self.format == 'tsv':
+            return
+        for datatable in datatables:
+            reader = pyarrow.ipc.open_file(pyarrow.memory_map(self.arrow_path(datatable)))
+            csv_options = json.loads((reader.schema.metadata or {}).get(b'csv_options', b'{}'))
+            with self._tsv_writer(datatable, reader.schema.names, csv_options) as writer:
+                writer.writerows(_arrow_rows(reader))
+
+    def _arrow_schema(self, datatable, columns):
+        types = {'float': pyarrow.float64(), 'int': pyarrow.int64(), 'boolean': pyarrow.bool_()}
+        sql_types = self.schema[datatable].columns if datatable in self.schema else {}
+        return pyarrow.schema([(column, types.get(sql_types.get(column, 'text').lower(), pyarrow.string())) for column in columns])
+
+
+class _TsvWriter:
+    # Writes rows of strings, with the values of each typed column formatted as Postgres outputs them.
+
+    def __init__(self, path, columns, csv_options, formatters):
+        self.path = path
+        self.file = open(path + '.tmp', 'w')
+        self.writer = csv.writer(self.file, **csv_options)
+        self.writer.writerow(columns)
+        self.formatters = [(i, formatter) for i, formatter in enumerate(formatters) if formatter is not None]
+        self.rows_out = 0
+
+    def writerow(self, row):
+        if len(self.formatters) > 0:
+            row = list(row)
+            for (i, formatter) in self.formatters:
+                row[i] = formatter(row[i])
+        self.writer.writerow(row)
+        self.rows_out += 1
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.path + '.tmp', self.path)
+            metrics.add('rows_out', self.rows_out)
+            metrics.add('bytes_out', os.path.getsize(self.path))
+        else:
+            os.remove(self.path + '.tmp')
+
+
+class _ArrowWriter:
+    # Buffers rows of strings and writes them as record batches, converted to the types of the schema.
+
+    def __init__(self, path, columns, schema):
+        self.path = path
+        self.columns = columns
+        self.schema = schema
+        self.rows = []
+        self.rows_out = 0
+        self.writer = pyarrow.ipc.new_file(path + '.tmp', schema)
+
+    def writerow(self, row):
+        self.rows.append(row)
+        self.rows_out += 1
+        if len(self.rows) >= TableStore.batch_size:
+            self._write_batch()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _write_batch(self):
+        frame = pandas.DataFrame(self.rows, columns=self.columns, dtype=str)
+        for field in self.schema:
+            frame[field.name] = _typed(frame[field.name], field.type)
+        self.writer.write_batch(pyarrow.RecordBatch.from_pandas(frame, schema=self.schema, preserve_index=False))
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            if len(self.rows) > 0:
+                self._write_batch()
+            self.writer.close()
+            os.replace(self.path + '.tmp', self.path)
+            metrics.add('rows_out', self.rows_out)
+            metrics.add('bytes_out', os.path.getsize(self.path))
+        else:
+            self.writer.close()
+            os.remove(self.path + '.tmp')
+
+
+def _typed(values, arrow_type):
+    # Empty strings are nulls, as in COPY's output (NULL '').
+    values = values.where(values != '')
+    if arrow_type == pyarrow.float64():
+        return pandas.to_numeric(values, errors='coerce')
+    if arrow_type == pyarrow.int64():
+        return pandas.to_numeric(values, errors='coerce').astype('Int64')
+    if arrow_type == pyarrow.bool_():
+        #Postgres outputs bools as t/f
+        return values.map({'t': True, 'True': True, 'true': True, 'f': False, 'False': False, 'false': False})
+    return values
+
+
+def _format(value):
+    # (pandas.isna for the missing values of DataFrames: None, NaN and pandas.NA.)
+    if value is None or (not isinstance(value, str) and pandas.isna(value)):
+        return ''
+    return str(value)
+
+
+def _float_text(value):
+    # A float as Postgres outputs it: the shortest text that reads back as the same float, in exponent form from
+    # 1e15 or below 1e-4, as Python does from 1e16.
+    try:
+        number = float(value)
+    except ValueError:
+        return ''
+    if math.isnan(number):
+        return ''
+    if math.isinf(number):
+        return 'Infinity' if number > 0 else '-Infinity'
+    text = repr(number)
+    if 'e' not in text and abs(number) >= 1e15:
+        (digits, exponent) = ('%.16e' % number).split('e')
+        digits = repr(float(digits))
+        text = digits + 'e' + exponent[0] + exponent[1:].lstrip('0').rjust(2, '0')
+    if 'e' in text:
+        (digits, exponent) = text.split('e')
+        text = (digits[:-2] if digits.endswith('.0') else digits) + 'e' + exponent
+    return text[:-2] if text.endswith('.0') else text
+
+
+def _int_text(value):
+    try:
+        return str(int(value))
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            return ''
+        return str(int(number)) if number.is_integer() else ''
+
+
+def _bool_text(value):
+    return {'t': 't', 'True': 't', 'true': 't', 'f': 'f', 'False': 'f', 'false': 'f'}.get(value, '')
+
+
+# How the values of each type in schema.sql are written to TSV, or by default as they are.
+_formatters = {'float': _float_text, 'int': _int_text, 'boolean': _bool_text}
+
+
+def _arrow_rows(reader):
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        for row in zip(*[column.to_pylist() for column in batch.columns]):
+            yield [_format(value) for value in row]
+
+
+def _counted(rows):
+    count = 0
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    finally:
+        metrics.add('rows_in', count)
+
+
+def _closing(file, rows):
+    with file:
+        yield from rows
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname, join
+
+# The modules are at the top level of the repository, not in a package.
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
@@ -0,0 +1,83 @@
+import gzip
+import importlib
+import shutil
+import sys
+from os.path import abspath, dirname, join
+
+import pytest
+
+import sqlschema
+
+repository_path = abspath(join(dirname(__file__), '..'))
+
+schema = '''CREATE TABLE "sites" (
+  "site_id" Text PRIMARY KEY,
+  "name" Text,
+  "lat" Float
+);
+'''
+
+
+@pytest.fixture
+def delta(tmp_path, monkeypatch):
+    # delta.py reads its settings, and the datatables in output/, from the working directory.
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(join(repository_path, 'settings_nosecrets'), 'settings_nosecrets')
+    with open('settings_local', 'w') as f:
+        f.write('{}\n')
+    (tmp_path / 'output' / 'sites').mkdir(parents=True)
+    (tmp_path / 'delta').mkdir()
+    (tmp_path / 'fingerprints').mkdir()
+    (tmp_path / 'schema.sql').write_text(schema)
+    sys.modules.pop('delta', None)
+    return importlib.import_module('delta')
+
+
+def compare(delta, tmp_path, data, previous):
+    (tmp_path / 'output' / 'sites' / 'data').write_bytes(data)
+    table = sqlschema.parse(str(tmp_path / 'schema.sql'))['sites']
+    # (compareTable takes the rows it finds out of the previous fingerprints.)
+    result = delta.compareTable(table, dict(previous) if previous is not None else None, 'delta', 'fingerprints')
+    return result, delta.readFingerprints('fingerprints', table)
+
+
+def gunzipped(path):
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+def test_inserts_updates_and_deletes(delta, tmp_path):
+    (changes, row_count, columns), previous = compare(delta, tmp_path, b'site_id\tname\tlat\nS1\tOne\t1.5\nS2\tTwo\t2\nS3\tThree\t3\n', None)
+    assert changes == {'inserts': 0, 'updates': 0, 'deletes': 0}
+    assert (row_count, sorted(previous)) == (3, [('S1',), ('S2',), ('S3',)])
+
+    # S2 renamed, S3 gone and S4 new, with the columns in another order.
+    (changes, row_count, columns), fingerprints = compare(delta, tmp_path, b'lat\tsite_id\tname\n1.5\tS1\tOne\n2\tS2\tDeux\n4\tS4\tFour\n', previous)
+    assert changes == {'inserts': 1, 'updates': 1, 'deletes': 1}
+    assert (row_count, columns) == (3, ['lat', 'site_id', 'name'])
+    assert gunzipped(join('delta', 'sites.upsert.gz')) == b'lat\tsite_id\tname\n2\tS2\tDeux\n4\tS4\tFour\n'
+    assert gunzipped(join('delta', 'sites.delete.gz')) == b'site_id\nS3\n'
+    # The same rows have the same fingerprints whatever the order of the columns.
+    assert fingerprints[('S1',)] == previous[('S1',)]
+
+
+def test_upserts_are_the_data_lines_as_they_are(delta, tmp_path):
+    (changes, row_count, columns), previous = compare(delta, tmp_path, b'site_id\tname\tlat\n', None)
+    data = b'site_id\tname\tlat\nS1\tSt "John\'s"\t1\nS2\t"Quoted\tname"\t2\n'
+    (changes, row_count, columns), fingerprints = compare(delta, tmp_path, data, previous)
+    assert changes['inserts'] == 2
+    assert gunzipped(join('delta', 'sites.upsert.gz')) == data
+
+
+def test_nothing_changed(delta, tmp_path):
+    data = b'site_id\tname\tlat\nS1\tOne\t1.5\n'
+    (changes, row_count, columns), previous = compare(delta, tmp_path, data, None)
+    (changes, row_count, columns), fingerprints = compare(delta, tmp_path, data, previous)
+    assert changes == {'inserts': 0, 'updates': 0, 'deletes': 0}
+    assert not (tmp_path / 'delta' / 'sites.upsert.gz').exists()
+    assert not (tmp_path / 'delta' / 'sites.delete.gz').exists()
+
+
+def test_duplicate_keys(delta, tmp_path):
+    with pytest.raises(ValueError):
+        compare(delta, tmp_path, b'site_id\tname\tlat\nS1\tOne\t1\nS1\tUno\t1\n', None)
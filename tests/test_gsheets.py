@@ -0,0 +1,102 @@
+import json
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from googleapiclient.http import HttpMockSequence
+
+from gsheets import GSheets
+from metrics import metrics
+
+sheets_discovery_url = 'https://sheets.example/discovery'
+drive_discovery_url = 'https://drive.example/discovery'
+
+
+def discovery_document(name):
+    # Just enough of the discovery documents of the Sheets and Drive APIs for the calls gsheets.py makes.
+    if name == 'sheets':
+        resources = {'spreadsheets': {'resources': {'values': {'methods': {'batchGet': {
+            'id': 'sheets.spreadsheets.values.batchGet',
+            'path': 'v4/spreadsheets/{spreadsheetId}/values:batchGet',
+            'httpMethod': 'GET',
+            'parameters': {'spreadsheetId': {'type': 'string', 'location': 'path', 'required': True},
+                           'ranges': {'type': 'string', 'location': 'query', 'repeated': True}},
+            'parameterOrder': ['spreadsheetId'],
+            'response': {'$ref': 'BatchGetValuesResponse'},
+        }}}}}}
+    else:
+        resources = {'files': {'methods': {'get': {
+            'id': 'drive.files.get',
+            'path': 'files/{fileId}',
+            'httpMethod': 'GET',
+            'parameters': {'fileId': {'type': 'string', 'location': 'path', 'required': True},
+                           'fields': {'type': 'string', 'location': 'query'}},
+            'parameterOrder': ['fileId'],
+            'response': {'$ref': 'File'},
+        }}}}
+    return json.dumps({'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'name': name, 'version': 'v4' if name == 'sheets' else 'v3',
+                       'rootUrl': 'https://' + name + '.example/', 'servicePath': '' if name == 'sheets' else 'drive/v3/', 'resources': resources,
+                       'schemas': {'BatchGetValuesResponse': {'id': 'BatchGetValuesResponse', 'type': 'object'}, 'File': {'id': 'File', 'type': 'object'}}})
+
+
+class RecordingHttp(HttpMockSequence):
+    """An HttpMockSequence that keeps the URIs requested."""
+
+    def __init__(self, responses):
+        super().__init__(responses)
+        self.uris = []
+
+    def request(self, uri, *args, **kwargs):
+        self.uris.append(uri)
+        return super().request(uri, *args, **kwargs)
+
+
+def ok(content):
+    return ({'status': '200'}, content)
+
+
+def test_ranges_of_a_spreadsheet_are_fetched_together_and_cached_by_version():
+    cache = {}
+    value_ranges = json.dumps({'spreadsheetId': 'SHEET', 'valueRanges': [
+        {'range': 'drugs!A1:B2', 'values': [['drug_id', 'name'], ['ART', 'Artemisinin']]},
+        {'range': 'genes!A1:A2', 'values': [['gene_id'], ['kelch13']]},
+    ]})
+    http = RecordingHttp([
+        ok(discovery_document('drive')),
+        ok(json.dumps({'version': '7'})),
+        ok(discovery_document('sheets')),
+        ok(value_ranges),
+    ])
+    gsheets = GSheets(lambda: http, cache, sheets_discovery_url, drive_discovery_url)
+    version = gsheets.version('SHEET')
+    assert version == '7'
+    with metrics.stage('test_gsheets:first'):
+        values = gsheets.values('SHEET', ['drugs!A1:B2', 'genes!A1:A2'], version)
+    assert values == [[['drug_id', 'name'], ['ART', 'Artemisinin']], [['gene_id'], ['kelch13']]]
+    batch_gets = [urlparse(uri) for uri in http.uris if ':batchGet' in uri]
+    assert len(batch_gets) == 1
+    assert parse_qs(batch_gets[0].query)['ranges'] == ['drugs!A1:B2', 'genes!A1:A2']
+    assert metrics.stages['test_gsheets:first']['cache_misses'] == 1
+
+    # The next run: the discovery documents and the values of the unchanged version are cached, so only the
+    # version is asked for.
+    http = RecordingHttp([ok(json.dumps({'version': '7'}))])
+    gsheets = GSheets(lambda: http, cache, sheets_discovery_url, drive_discovery_url)
+    with metrics.stage('test_gsheets:again'):
+        assert gsheets.values('SHEET', ['drugs!A1:B2', 'genes!A1:A2']) == values
+    assert len(http.uris) == 1 and '/files/SHEET' in http.uris[0]
+    assert metrics.stages['test_gsheets:again']['cache_hits'] == 1
+
+
+def test_an_edited_spreadsheet_is_fetched_again():
+    cache = {'discovery:' + sheets_discovery_url: discovery_document('sheets'), 'discovery:' + drive_discovery_url: discovery_document('drive'),
+             'values:SHEET:7:["drugs!A1:B2"]': [[['drug_id'], ['ART']]]}
+    http = RecordingHttp([
+        ok(json.dumps({'version': '8'})),
+        ok(json.dumps({'spreadsheetId': 'SHEET', 'valueRanges': [{'range': 'drugs!A1:B2', 'values': [['drug_id'], ['CQ']]}]})),
+    ])
+    gsheets = GSheets(lambda: http, cache, sheets_discovery_url, drive_discovery_url)
+    assert gsheets.values('SHEET', ['drugs!A1:B2']) == [[['drug_id'], ['CQ']]]
+    assert len([uri for uri in http.uris if ':batchGet' in uri]) == 1
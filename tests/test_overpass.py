@@ -0,0 +1,115 @@
+import json
+import math
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pandas
+import pytest
+
+pytest.importorskip('shapely')
+pytest.importorskip('requests')
+diskcache = pytest.importorskip('diskcache')
+
+import landmass
+import overpass
+from metrics import metrics
+from shapely.geometry import box
+
+
+def square_relation(relation_id, admin_level, name, minx, miny, size):
+    ring = [(minx, miny), (minx + size, miny), (minx + size, miny + size), (minx, miny + size), (minx, miny)]
+    return {'type': 'relation', 'id': relation_id, 'version': 1, 'tags': {'admin_level': admin_level, 'name': name},
+            'members': [{'type': 'way', 'role': 'outer', 'geometry': [{'lon': lng, 'lat': lat} for (lng, lat) in ring]}]}
+
+
+def admin_relations(lat, lng):
+    # A province for each whole degree and a district for each tenth of a degree.
+    (province_lat, province_lng) = (math.floor(lat), math.floor(lng))
+    (district_lat, district_lng) = (math.floor(lat * 10), math.floor(lng * 10))
+    return [
+        square_relation(1000 + province_lat * 10 + province_lng, '4', 'Alpha ' + str(province_lat) + str(province_lng), province_lng, province_lat, 1),
+        square_relation(2000 + district_lat * 100 + district_lng, '6', 'Beta ' + str(district_lat) + str(district_lng), district_lng / 10, district_lat / 10, 0.1),
+    ]
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    # A local Overpass server answering the queries of query_points, recording the points of each query.
+    queries = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            query = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())['data'][0]
+            elements = []
+            points = []
+            for statement in query.split('is_in(')[1:]:
+                (lat, lng) = [float(value) for value in statement.split(')')[0].split(',')]
+                index = statement.split('index="')[1].split('"')[0]
+                points.append((lat, lng))
+                elements += admin_relations(lat, lng)
+                elements.append({'type': 'point', 'id': int(index) + 1, 'tags': {'index': index}})
+            queries.append(points)
+            body = json.dumps({'version': 0.6, 'elements': elements}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # All land, and nothing cached.
+    with open(str(tmp_path / 'landmass.wkb'), 'wb') as f:
+        f.write(box(-180, -90, 180, 90).wkb)
+    monkeypatch.setattr(overpass, 'landmass', landmass.Landmass(str(tmp_path / 'landmass.tiles'), str(tmp_path / 'landmass.wkb')))
+    monkeypatch.setattr(overpass, 'cache', diskcache.Cache(str(tmp_path / 'overpass_cache')))
+    monkeypatch.setattr(overpass, 'relation_records', OrderedDict())
+    monkeypatch.setattr(overpass, 'admin_boundaries', None)
+    yield 'http://127.0.0.1:' + str(server.server_address[1]) + '/api/interpreter', queries
+    server.shutdown()
+    server.server_close()
+
+
+def sites():
+    return pandas.DataFrame({
+        'site_id': ['S1', 'S2', 'S3', 'S4', 'S5', 'S1b'],
+        'lat': [1.15, 1.25, 1.35, 2.55, -3.45, 1.15],
+        'lng': [5.15, 5.15, 5.85, 6.05, 7.25, 5.15],
+    }, index=[10, 11, 12, 13, 14, 15])
+
+
+def test_query_points_gives_each_point_its_relations(stub):
+    (url, queries) = stub
+    elements_for_point = overpass.query_points([(1.15, 5.15), (2.55, 6.05)], url)
+    assert queries == [[(1.15, 5.15), (2.55, 6.05)]]
+    assert [e['id'] for e in elements_for_point[(1.15, 5.15)]] == [1015, 2000 + 11 * 100 + 51]
+    assert [e['id'] for e in elements_for_point[(2.55, 6.05)]] == [1026, 2000 + 25 * 100 + 60]
+
+
+def test_sites_are_looked_up_several_points_to_a_query(stub):
+    (url, queries) = stub
+    with metrics.stage('test_overpass:first'):
+        admin_levels = overpass.admin_levels_for_sites(sites(), url=url, per_query=2, per_second=100)
+
+    # The five distinct points, two to a query, each asked about once.
+    assert sorted(len(points) for points in queries) == [1, 2, 2]
+    assert sorted(point for points in queries for point in points) == sorted(set(zip(sites()['lat'], sites()['lng'])))
+
+    assert admin_levels.index.tolist() == [10, 11, 12, 13, 14, 15]
+    assert admin_levels['province_name'].tolist() == ['Alpha 15', 'Alpha 15', 'Alpha 15', 'Alpha 26', 'Alpha -47', 'Alpha 15']
+    assert admin_levels['district_name'].tolist() == ['Beta 1151', 'Beta 1251', 'Beta 1358', 'Beta 2560', 'Beta -3572', 'Beta 1151']
+    assert admin_levels.loc[10].equals(admin_levels.loc[15])
+    assert metrics.stages['test_overpass:first']['cache_misses'] == 5
+
+    # All cached now.
+    with metrics.stage('test_overpass:again'):
+        again = overpass.admin_levels_for_sites(sites(), url=url, per_query=2, per_second=100)
+    assert len(queries) == 3
+    assert metrics.stages['test_overpass:again']['cache_hits'] == 5
+    assert again.equals(admin_levels)
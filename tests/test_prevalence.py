@@ -0,0 +1,50 @@
+import pandas
+
+from prevalence import prevalence
+
+
+def samples():
+    return pandas.DataFrame([
+        # site_id, year, qc_pass, ARTresistant, CQresistant, HRP2deletion
+        ['S1', 2012, 'True', 'Resistant', 'Sensitive', 'Deletion'],
+        ['S1', 2012, 'True', 'Sensitive', 'Resistant', 'Undetermined'],
+        ['S1', 2012, 'True', 'Undetermined', 'Resistant', None],
+        ['S1', 2012, 'False', 'Resistant', 'Resistant', 'Deletion'],
+        ['S1', 2013, 't', 'Sensitive', '', 'No deletion'],
+        ['S2', 2012, 'true', 'Resistant', 'Resistant', 'Deletion'],
+        ['S2', None, 'True', 'Resistant', 'Resistant', 'Deletion'],
+    ], columns=['site_id', 'year', 'qc_pass', 'ARTresistant', 'CQresistant', 'HRP2deletion'])
+
+
+def test_prevalence_by_site_and_year():
+    result = prevalence(samples(), ['site_id', 'year']).set_index(['site_id', 'year'])
+    # Worked out by hand: the sample failing QC and the one without a year aren't counted, and the Undetermined
+    # and empty statuses aren't classified.
+    assert result.index.tolist() == [('S1', 2012), ('S1', 2013), ('S2', 2012)]
+    assert result['num_samples'].tolist() == [3, 1, 1]
+    assert result.loc[('S1', 2012), 'ARTresistance'] == 50.0
+    assert result.loc[('S1', 2012), 'CQresistance'] == 100.0 * 2 / 3
+    assert result.loc[('S1', 2012), 'HRP2deletion'] == 100.0
+    assert result.loc[('S1', 2013), 'ARTresistance'] == 0.0
+    assert pandas.isna(result.loc[('S1', 2013), 'CQresistance'])
+    assert result.loc[('S1', 2013), 'HRP2deletion'] == 0.0
+    assert result.loc[('S2', 2012), 'ARTresistance'] == 100.0
+
+
+def test_years_are_ints():
+    result = prevalence(samples(), ['site_id', 'year'])
+    assert result['year'].dtype.kind == 'i'
+
+
+def test_only_the_classifications_present():
+    result = prevalence(samples(), ['site_id'])
+    assert list(result.columns) == ['site_id', 'num_samples', 'ARTresistance', 'CQresistance', 'HRP2deletion']
+    assert result['num_samples'].tolist() == [4, 2]
+
+
+def test_statuses_in_any_case():
+    lowered = samples()
+    for column in ['ARTresistant', 'CQresistant', 'HRP2deletion']:
+        lowered[column] = lowered[column].str.lower()
+    assert prevalence(lowered, ['site_id', 'year']).equals(prevalence(samples(), ['site_id', 'year']))
+    assert prevalence(lowered, ['site_id'])['ARTresistance'].tolist() == [100.0 / 3, 100.0]
@@ -0,0 +1,90 @@
+import csv
+
+import pandas
+import pytest
+
+from tablestore import TableStore
+
+pyarrow = pytest.importorskip('pyarrow')
+
+prevalence_columns = ['site_id', 'year', 'num_samples', 'ARTresistance', 'HRP2deletion']
+prevalence_rows = [
+    ['SITE1', '2012', '3', '33.333333333333336', ''],
+    ['SITE1', '', '1', '100.0', '0.0'],
+    ['SITE2', '2014.0', '12', '', '1e-05'],
+]
+drug_region_columns = ['drug_id', 'drug_region_id', 'region_id', 'resistance', 'text']
+drug_region_rows = [
+    ['ART', 'ART_SEA', 'SEA', '12.5', 'Says "resistant"\tand tabbed'],
+    ['CQ', 'CQ_WAF', 'WAF', '', ''],
+]
+
+
+def write(store):
+    with store.writer('pf_site_year_prevalence', prevalence_columns) as writer:
+        writer.writerows(prevalence_rows)
+    with store.writer('pf_drug_regions', drug_region_columns) as writer:
+        writer.writerows(drug_region_rows)
+    with open(store.staging_path('countries'), 'w') as f:
+        f.write('country_id\tname\nBFA\tBurkina "Faso"\n')
+    store.import_tsv('countries', store.staging_path('countries'))
+    store.export_tsv(['pf_site_year_prevalence', 'pf_drug_regions', 'countries'])
+
+
+@pytest.mark.parametrize('datatable', ['pf_site_year_prevalence', 'pf_drug_regions', 'countries'])
+def test_both_formats_write_the_same_tsv(tmp_path, datatable):
+    tsv_store = TableStore(str(tmp_path / 'tsv'), 'tsv')
+    arrow_store = TableStore(str(tmp_path / 'arrow'), 'arrow')
+    write(tsv_store)
+    write(arrow_store)
+    with open(tsv_store.tsv_path(datatable), 'rb') as tsv, open(arrow_store.tsv_path(datatable), 'rb') as arrow:
+        assert tsv.read() == arrow.read()
+
+
+@pytest.mark.parametrize('format', ['tsv', 'arrow'])
+def test_typed_values_are_written_as_postgres_outputs_them(tmp_path, format):
+    store = TableStore(str(tmp_path), format)
+    write(store)
+    with open(store.tsv_path('pf_site_year_prevalence'), 'r') as f:
+        assert list(csv.reader(f, delimiter='\t')) == [
+            prevalence_columns,
+            ['SITE1', '2012', '3', '33.333333333333336', ''],
+            ['SITE1', '', '1', '100', '0'],
+            ['SITE2', '2014', '12', '', '1e-05'],
+        ]
+
+
+@pytest.mark.parametrize('format', ['tsv', 'arrow'])
+def test_rows_round_trip(tmp_path, format):
+    store = TableStore(str(tmp_path), format)
+    write(store)
+    (columns, rows) = store.reader('pf_drug_regions')
+    assert columns == drug_region_columns
+    assert list(rows) == [
+        ['ART', 'ART_SEA', 'SEA', '12.5', 'Says "resistant"\tand tabbed'],
+        ['CQ', 'CQ_WAF', 'WAF', '', ''],
+    ]
+    (columns, rows) = store.reader('countries')
+    assert list(rows) == [['BFA', 'Burkina "Faso"']]
+
+
+@pytest.mark.parametrize('format', ['tsv', 'arrow'])
+def test_int_columns_with_nulls_are_read_as_nullable_ints(tmp_path, format):
+    store = TableStore(str(tmp_path), format)
+    write(store)
+    frame = store.read_frame('pf_site_year_prevalence')
+    assert str(frame['year'].dtype) == 'Int64'
+    assert frame['year'].tolist()[0] == 2012 and frame['year'].isna().tolist() == [False, True, False]
+
+    # Written back as it was read.
+    store.write_frame('pf_site_year_prevalence', frame)
+    store.export_tsv(['pf_site_year_prevalence'])
+    with open(store.tsv_path('pf_site_year_prevalence'), 'r') as f:
+        assert [row[1] for row in csv.reader(f, delimiter='\t')] == ['year', '2012', '', '2014']
+
+
+def test_frames_keep_their_values(tmp_path):
+    store = TableStore(str(tmp_path), 'arrow')
+    frame = pandas.DataFrame({'site_id': ['SITE1'], 'year': pandas.array([None], dtype='Int64'), 'num_samples': [4]})
+    store.write_frame('pf_site_year_prevalence', frame)
+    assert store.read_frame('pf_site_year_prevalence')['num_samples'].tolist() == [4]
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+pytest.importorskip('shapely')
+
+from topology import Topology
+
+
+def square(x, y, size=1):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+def level(topology, tolerance=0, quantization=None):
+    return json.loads(topology.level('countries', tolerance, quantization or topology.quantization))
+
+
+def decoded(topojson, arc):
+    # The points of an arc, or of the reversed arc for ~index, undoing the delta encoding.
+    points = []
+    for (x, y) in topojson['arcs'][arc if arc >= 0 else ~arc]:
+        points.append((x, y) if len(points) == 0 else (points[-1][0] + x, points[-1][1] + y))
+    return points if arc >= 0 else points[::-1]
+
+
+def test_neighbours_share_their_border():
+    topology = Topology({
+        'A': {'type': 'Polygon', 'coordinates': [square(0, 0)]},
+        'B': {'type': 'Polygon', 'coordinates': [square(1, 0)]},
+    }, 3)
+    topojson = level(topology)
+    (a, b) = topojson['objects']['countries']['geometries']
+    arcs_a = [arc if arc >= 0 else ~arc for arc in a['arcs'][0]]
+    arcs_b = [arc if arc >= 0 else ~arc for arc in b['arcs'][0]]
+    shared = set(arcs_a) & set(arcs_b)
+    assert len(shared) == 1
+    # The border, from (1, 0) to (1, 1) on the grid, used one way round by A and the other by B.
+    (arc,) = shared
+    assert sorted(decoded(topojson, arc)) == [(1, 0), (1, 1)]
+    assert (arc in a['arcs'][0]) != (arc in b['arcs'][0])
+
+
+def test_each_ring_is_closed():
+    topology = Topology({
+        'A': {'type': 'Polygon', 'coordinates': [square(0, 0)]},
+        'B': {'type': 'MultiPolygon', 'coordinates': [[square(1, 0)], [square(3, 3)]]},
+    }, 5)
+    topojson = level(topology)
+    for geometry in topojson['objects']['countries']['geometries']:
+        polygons = [geometry['arcs']] if geometry['type'] == 'Polygon' else geometry['arcs']
+        for polygon in polygons:
+            for ring in polygon:
+                points = [point for arc in ring for point in decoded(topojson, arc)]
+                assert points[0] == points[-1]
+
+
+@pytest.mark.parametrize('geometry', [
+    None,
+    {'type': 'GeometryCollection', 'geometries': []},
+    {'type': 'Polygon', 'coordinates': []},
+    {'type': 'MultiPolygon', 'coordinates': []},
+    {'type': 'MultiPolygon', 'coordinates': [[]]},
+    {'type': 'Point', 'coordinates': [0, 0]},
+])
+def test_features_without_polygons_have_no_shape(geometry):
+    topology = Topology({
+        'A': {'type': 'Polygon', 'coordinates': [square(0, 0)]},
+        'EMPTY': geometry,
+    }, 3)
+    (a, empty) = level(topology)['objects']['countries']['geometries']
+    assert a['type'] == 'Polygon'
+    assert empty == {'type': None, 'id': 'EMPTY'}
+
+
+def test_without_any_polygons():
+    topojson = level(Topology({'EMPTY': {'type': 'GeometryCollection', 'geometries': []}}, 3))
+    assert topojson['arcs'] == []
+    assert topojson['objects']['countries']['geometries'] == [{'type': None, 'id': 'EMPTY'}]
+
+
+def test_small_islands_are_left_out_of_coarse_levels():
+    topology = Topology({
+        'A': {'type': 'MultiPolygon', 'coordinates': [[square(0, 0, 10)], [square(20, 20, 0.1)]]},
+    }, 1001)
+    assert level(topology)['objects']['countries']['geometries'][0]['type'] == 'MultiPolygon'
+    assert level(topology, 0, 11)['objects']['countries']['geometries'][0]['type'] == 'Polygon'
+
+
+def test_quantization_must_be_at_least_2():
+    with pytest.raises(ValueError):
+        Topology({}, 1)
@@ -0,0 +1,176 @@
+import json
+from collections import OrderedDict
+
+from shapely.geometry import LineString
+
+
+class Topology:
+    """The shapes of a set of features as TopoJSON-style arcs, on an integer grid over the extent of all of them.
+
+    Each ring is cut into arcs wherever it meets another ring along a different path, so the border between two
+    neighbouring countries is one arc used by both rather than stored twice. The topology is built once, and then
+    levels of it made at several tolerances and quantizations, each arc simplified on its own so that neighbours
+    still share exactly the same border at every level.
+    https://github.com/topojson/topojson-specification
+    """
+
+    def __init__(self, geometries, quantization):
+        # The geometries are GeoJSON geometries, or None, by feature id. Those without any polygons, such as the empty
+        # GeometryCollection of a region without countries, are left without a shape.
+        geometries = OrderedDict((feature_id, _polygonal(geometry)) for feature_id, geometry in geometries.items())
+        self.quantization = int(quantization)
+        if self.quantization < 2:
+            raise ValueError('The quantization of a topology must be at least 2: ', str(quantization))
+
+        coordinates = [coordinate for geometry in geometries.values() if geometry is not None
+                       for polygon in _polygons(geometry) for ring in polygon for coordinate in ring]
+        if len(coordinates) > 0:
+            (xs, ys) = list(zip(*coordinates))[:2]
+            self.bbox = [min(xs), min(ys), max(xs), max(ys)]
+        else:
+            self.bbox = [0, 0, 0, 0]
+        # The same scale across and up, so that simplifying on the grid is the same as in degrees.
+        self.scale = (max(self.bbox[2] - self.bbox[0], self.bbox[3] - self.bbox[1]) / (self.quantization - 1)) or 1
+
+        # Each feature's polygons, as lists of rings, each a list of points on the grid.
+        polygons_by_id = OrderedDict()
+        for feature_id, geometry in geometries.items():
+            polygons_by_id[feature_id] = []
+            for polygon in (_polygons(geometry) if geometry is not None else []):
+                rings = [self._quantized_ring(ring) for ring in polygon]
+                if rings[0] is not None:
+                    polygons_by_id[feature_id].append([ring for ring in rings if ring is not None])
+
+        junctions = _junctions(ring for polygons in polygons_by_id.values() for polygon in polygons for ring in polygon)
+
+        # The arcs, each a list of points, and each feature's polygons as lists of rings of arcs. An arc used the
+        # other way round is referred to as ~index.
+        self.arcs = []
+        self._arc_indexes = {}
+        self.polygons_by_id = OrderedDict(
+            (feature_id, [[self._ring_arcs(ring, junctions) for ring in polygon] for polygon in polygons])
+            for feature_id, polygons in polygons_by_id.items())
+
+    def _quantized_ring(self, ring):
+        # The ring on the grid, closed and without repeated points, or None if that leaves it without an area.
+        points = []
+        for coordinate in ring:
+            point = (int(round((coordinate[0] - self.bbox[0]) / self.scale)), int(round((coordinate[1] - self.bbox[1]) / self.scale)))
+            if len(points) == 0 or point != points[-1]:
+                points.append(point)
+        if points[0] != points[-1]:
+            points.append(points[0])
+        return points if len(set(points)) >= 3 else None
+
+    def _ring_arcs(self, ring, junctions):
+        # Cut the ring at its junctions, or if it doesn't have any start it at its lowest point, so that the
+        # same ring always gives the same arc whichever feature it is part of.
+        points = ring[:-1]
+        cuts = [i for i, point in enumerate(points) if point in junctions]
+        start = cuts[0] if len(cuts) > 0 else points.index(min(points))
+        points = points[start:] + points[:start] + [points[start]]
+        if len(cuts) == 0:
+            return [self._arc_index(points)]
+        arcs = []
+        begin = 0
+        for i in range(1, len(points)):
+            if points[i] in junctions:
+                arcs.append(self._arc_index(points[begin:i + 1]))
+                begin = i
+        return arcs
+
+    def _arc_index(self, points):
+        key = tuple(points)
+        if key in self._arc_indexes:
+            return self._arc_indexes[key]
+        if key[::-1] in self._arc_indexes:
+            return ~self._arc_indexes[key[::-1]]
+        self._arc_indexes[key] = len(self.arcs)
+        self.arcs.append(points)
+        return len(self.arcs) - 1
+
+    def level(self, name, tolerance, quantization):
+        # The TopoJSON of the topology with each arc simplified to the tolerance, in degrees, and quantized to a
+        # coarser grid of this many steps. Rings that end up without an area are left out, and with them polygons
+        # without an outer ring, and the arcs only they used.
+        quantization = int(quantization)
+        if quantization < 2 or quantization > self.quantization:
+            raise ValueError('The quantization of a level must be from 2 up to that of the topology: ', str(quantization))
+        step = (self.quantization - 1) / (quantization - 1)
+        tolerance = float(tolerance) / self.scale
+
+        arcs = []
+        for points in self.arcs:
+            if tolerance > 0 and len(points) > 2:
+                points = [(int(x), int(y)) for (x, y) in LineString(points).simplify(tolerance, preserve_topology=False).coords]
+            level_points = []
+            for (x, y) in points:
+                point = (int(round(x / step)), int(round(y / step)))
+                if len(level_points) == 0 or point != level_points[-1]:
+                    level_points.append(point)
+            # (An arc between two junctions is kept even if they are now the same point, as its rings need it.)
+            arcs.append(level_points if len(level_points) > 1 else level_points * 2)
+
+        def ring_points(ring):
+            return [point for arc in ring for point in (arcs[arc] if arc >= 0 else arcs[~arc][::-1])]
+
+        # The arcs the remaining rings use, numbered in the order they are first used.
+        used_arcs = OrderedDict()
+
+        def used(ring):
+            return [used_arcs.setdefault(arc, len(used_arcs)) if arc >= 0 else ~used_arcs.setdefault(~arc, len(used_arcs)) for arc in ring]
+
+        geometries = []
+        for feature_id, polygons in self.polygons_by_id.items():
+            level_polygons = []
+            for polygon in polygons:
+                rings = [ring for ring in polygon if len(set(ring_points(ring))) >= 3]
+                if len(rings) > 0 and rings[0] is polygon[0]:
+                    level_polygons.append([used(ring) for ring in rings])
+            if len(level_polygons) == 0:
+                geometries.append({'type': None, 'id': feature_id})
+            elif len(level_polygons) == 1:
+                geometries.append({'type': 'Polygon', 'id': feature_id, 'arcs': level_polygons[0]})
+            else:
+                geometries.append({'type': 'MultiPolygon', 'id': feature_id, 'arcs': level_polygons})
+
+        return json.dumps({
+            'type': 'Topology',
+            'bbox': self.bbox,
+            'transform': {'scale': [self.scale * step, self.scale * step], 'translate': self.bbox[:2]},
+            'objects': {name: {'type': 'GeometryCollection', 'geometries': geometries}},
+            'arcs': [_delta_encoded(arcs[arc]) for arc in used_arcs],
+        }, separators=(',', ':'))
+
+
+def _polygonal(geometry):
+    # The geometry if it is a Polygon or MultiPolygon with at least one ring, otherwise None.
+    if geometry is None or geometry.get('type') not in ['Polygon', 'MultiPolygon']:
+        return None
+    return geometry if len(_polygons(geometry)) > 0 else None
+
+
+def _polygons(geometry):
+    # The polygons of a GeoJSON Polygon or MultiPolygon, each a list of rings, leaving out any without rings.
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    return [polygon for polygon in polygons if len(polygon) > 0 and len(polygon[0]) > 0]
+
+
+def _junctions(rings):
+    # The points where rings meet and then go different ways: a point is a junction if it is reached from or left
+    # for different neighbouring points in different places.
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        last = len(ring) - 1
+        for i in range(last):
+            point = ring[i]
+            pair = frozenset([ring[i - 1] if i > 0 else ring[last - 1], ring[i + 1]])
+            if neighbours.setdefault(point, pair) != pair:
+                junctions.add(point)
+    return junctions
+
+
+def _delta_encoded(points):
+    # The first point, then each point as its difference from the one before.
+    return [list(points[0])] + [[x - previous_x, y - previous_y] for ((previous_x, previous_y), (x, y)) in zip(points, points[1:])]